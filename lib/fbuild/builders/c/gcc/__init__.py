@@ -1,3 +1,4 @@
+import hashlib
 import io
 import re
 from itertools import chain
@@ -463,6 +464,58 @@ class Builder(fbuild.builders.c.Builder):
 
         return obj
 
+    def precompile_header(self, headers, *, buildroot=None):
+        """Precompile a header that includes the headers in order, and cache
+        it in the buildroot. Returns the flags that make a source start by
+        including the precompiled header, after which including the headers
+        again is free. The header is precompiled again when the flags
+        change."""
+        buildroot = buildroot or self.ctx.buildroot
+
+        code = ''.join('#include <%s>\n' % header for header in headers)
+        name = hashlib.md5(
+            repr((code, self.flags, self.compiler.flags)).encode()).hexdigest()
+
+        src = buildroot / 'pch' / name / 'pch.h'
+        if not src.exists():
+            src.parent.makedirs()
+            with open(src, 'w') as f:
+                f.write(code)
+
+        self.compile(src, src + '.gch',
+            suffix='.gch',
+            buildroot=buildroot,
+            quieter=1)
+
+        return ['-include', src]
+
+    def fingerprint(self):
+        """Returns a digest of the compiler, its version and the flags the
+        builder uses, which is the same for any builder on any machine that
+        builds the same way. Returns None if the builder uses relative
+        include or library paths, which depend on the project."""
+        cc = self.compiler.cc
+
+        for path in chain(cc.includes, cc.libpaths, cc.libs):
+            if not Path(path).isabs():
+                return None
+
+        h = hashlib.sha256()
+        h.update(cc.exe.digest().encode())
+        h.update(cc.version().encode())
+        h.update(repr((
+            sorted((key, value) for key, value in vars(cc).items()
+                if key not in ('ctx', 'exe')),
+            self.compiler.flags,
+            self.lib_linker.flags,
+            self.exe_linker.flags,
+            self.flags,
+            self.src_suffix,
+            self.cross_compiler,
+        )).encode())
+
+        return h.hexdigest()
+
     def uncached_compile(self, *args, **kwargs):
         """Compile a c file without caching the results.  This is needed when
         compiling temporary files."""
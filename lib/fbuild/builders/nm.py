@@ -9,24 +9,68 @@ import fbuild.db
 
 # ------------------------------------------------------------------------------
 
+def _parse_symbols(stdout):
+    """Gather the external symbols from the output of nm."""
+
+    defined_symbols = set()
+    undefined_symbols = set()
+
+    regex = re.compile(b'^(\S+) ([ABCDGRSTU])')
+    for line in io.BytesIO(stdout):
+        m = regex.match(line)
+        if m:
+            # Break up the symbols into defined and undefined symbols.
+            symbol = m.group(1)
+            if b'U' in m.group(2):
+                undefined_symbols.add(symbol)
+            else:
+                defined_symbols.add(symbol)
+
+    return defined_symbols, undefined_symbols
+
+# ------------------------------------------------------------------------------
+
 class Nm(fbuild.db.PersistentObject):
     def __init__(self, ctx, exe=None):
         super().__init__(ctx)
 
         self.exe = fbuild.builders.find_program(ctx, [exe or 'nm'])
 
+    def _run(self, obj:fbuild.db.SRC):
+        obj = fbuild.path.Path(obj)
+
+        cmd = [self.exe, '-gP']
+        cmd.append(obj)
+
+        self.ctx.logger.check(' * %s -gP' % self.exe, obj, color='yellow')
+        stdout, stderr = self.ctx.execute(cmd, stdout_quieter=1)
+
+        return self.ctx.scheduler.run_in_process(_parse_symbols, stdout)
+
     @fbuild.db.cachemethod
+    @fbuild.db.depends_on(_run, _parse_symbols)
     def object_dependencies(self, objs:fbuild.db.SRCS):
         defined_symbols_lookup = {}
         undefined_symbols_lookup = {}
 
-        for obj in objs:
-            defined_symbols, undefined_symbols = self._run(obj)
+        # Index the symbols of each object as soon as nm finishes with it,
+        # while nm is still running on the others.
+        for obj, (defined_symbols, undefined_symbols) in \
+                self.ctx.scheduler.imap_unordered(
+                    lambda obj: (obj, self._run(obj)),
+                    objs):
             for symbol in defined_symbols:
-                defined_symbols_lookup[symbol] = obj
+                defined_symbols_lookup.setdefault(symbol, []).append(obj)
 
             undefined_symbols_lookup[obj] = undefined_symbols
 
+        # If more than one object defines a symbol, the last one wins, just
+        # like it would if we ran nm on them one at a time.
+        order = {obj: index for index, obj in enumerate(objs)}
+        defined_symbols_lookup = {
+            symbol: max(defining_objs, key=order.__getitem__)
+            for symbol, defining_objs in defined_symbols_lookup.items()}
+
         new_objs = []
         def f(obj):
             if obj in new_objs:
@@ -47,31 +91,5 @@ class Nm(fbuild.db.PersistentObject):
 
         return reversed(new_objs)
 
-    def _run(self, obj:fbuild.db.SRC):
-        obj = fbuild.path.Path(obj)
-
-        cmd = [self.exe, '-gP']
-        cmd.append(obj)
-
-        self.ctx.logger.check(' * %s -gP' % self.exe, obj, color='yellow')
-        stdout, stderr = self.ctx.execute(cmd, stdout_quieter=1)
-
-        # Gather the external symbols from the object files.
-        defined_symbols = set()
-        undefined_symbols = set()
-
-        regex = re.compile(b'^(\S+) ([ABCDGRSTU])')
-        for line in io.BytesIO(stdout):
-            m = regex.match(line)
-            if m:
-                # Break up the symbols into defined and undefined symbols.
-                symbol = m.group(1)
-                if b'U' in m.group(2):
-                    undefined_symbols.add(symbol)
-                else:
-                    defined_symbols.add(symbol)
-
-        return defined_symbols, undefined_symbols
-
     def __str__(self):
         return str(self.exe.name)
@@ -6,19 +6,7 @@ import fbuild.db
 
 # ------------------------------------------------------------------------------
 
-@fbuild.db.caches
-def substitute(ctx, dst, src:fbuild.db.SRC, patterns, *, buildroot=None) \
-        -> fbuild.db.DST:
-    """L{substitute} replaces the I{patterns} in the file named I{src}
-    and saves the changes into file named I{dst}."""
-
-    buildroot = buildroot or ctx.buildroot
-    src = fbuild.path.Path(src)
-    dst = fbuild.path.Path.addroot(dst, buildroot)
-    dst.parent.makedirs()
-
-    ctx.logger.log(' * creating ' + dst, color='yellow')
-
+def _substitute(dst, src, patterns):
     with open(src, 'r') as src_file:
         code = src_file.read()
         for pattern, text in patterns.items():
@@ -27,13 +15,10 @@ def substitute(ctx, dst, src:fbuild.db.SRC, patterns, *, buildroot=None) \
     with open(dst, 'w') as dst_file:
         dst_file.write(code)
 
-    return dst
-
-# ------------------------------------------------------------------------------
-
 @fbuild.db.caches
-def regex_substitute(ctx, dst, src:fbuild.db.SRC, patterns, *,
-        buildroot=None) -> fbuild.db.DST:
+@fbuild.db.depends_on(_substitute)
+def substitute(ctx, dst, src:fbuild.db.SRC, patterns, *, buildroot=None) \
+        -> fbuild.db.DST:
     """L{substitute} replaces the I{patterns} in the file named I{src}
     and saves the changes into file named I{dst}."""
 
@@ -44,6 +29,13 @@ def regex_substitute(ctx, dst, src:fbuild.db.SRC, patterns, *,
 
     ctx.logger.log(' * creating ' + dst, color='yellow')
 
+    ctx.scheduler.run_in_process(_substitute, dst, src, patterns)
+
+    return dst
+
+# ------------------------------------------------------------------------------
+
+def _regex_substitute(dst, src, patterns):
     with open(src, 'r') as src_file:
         code = src_file.read()
         for items in patterns:
@@ -58,16 +50,12 @@ def regex_substitute(ctx, dst, src:fbuild.db.SRC, patterns, *,
     with open(dst, 'w') as dst_file:
         dst_file.write(code)
 
-    return dst
-
-# ------------------------------------------------------------------------------
-
 @fbuild.db.caches
-def format_substitute(ctx, dst, src:fbuild.db.SRC, patterns, *,
+@fbuild.db.depends_on(_regex_substitute)
+def regex_substitute(ctx, dst, src:fbuild.db.SRC, patterns, *,
         buildroot=None) -> fbuild.db.DST:
-    """L{format_substitute} replaces the I{patterns} in the file named I{src}
-    and saves the changes into file named I{dst}. It uses python's format
-    patterns for finding the insertion points."""
+    """L{substitute} replaces the I{patterns} in the file named I{src}
+    and saves the changes into file named I{dst}."""
 
     buildroot = buildroot or ctx.buildroot
     src = fbuild.path.Path(src)
@@ -76,30 +64,41 @@ def format_substitute(ctx, dst, src:fbuild.db.SRC, patterns, *,
 
     ctx.logger.log(' * creating ' + dst, color='yellow')
 
+    ctx.scheduler.run_in_process(_regex_substitute, dst, src, patterns)
+
+    return dst
+
+# ------------------------------------------------------------------------------
+
+def _format_substitute(dst, src, patterns):
     with open(src, 'r') as src_file:
         code = src_file.read().format(**patterns)
 
     with open(dst, 'w') as dst_file:
         dst_file.write(code)
 
-    return dst
-
-# ------------------------------------------------------------------------------
-
 @fbuild.db.caches
-def autoconf_config_file(ctx, dst, src:fbuild.db.SRC, patterns, *,
+@fbuild.db.depends_on(_format_substitute)
+def format_substitute(ctx, dst, src:fbuild.db.SRC, patterns, *,
         buildroot=None) -> fbuild.db.DST:
-    """L{autoconf_config_file} replaces the I{patterns} in the file named
-    I{src} and saves the changes into file named I{dst}. It uses autoconf
-    AC_CONFIG_FILES @word@ patterns to find the insertion points."""
+    """L{format_substitute} replaces the I{patterns} in the file named I{src}
+    and saves the changes into file named I{dst}. It uses python's format
+    patterns for finding the insertion points."""
 
     buildroot = buildroot or ctx.buildroot
     src = fbuild.path.Path(src)
-    dst = fbuild.path.Path(dst).addroot(buildroot)
+    dst = fbuild.path.Path.addroot(dst, buildroot)
     dst.parent.makedirs()
 
     ctx.logger.log(' * creating ' + dst, color='yellow')
 
+    ctx.scheduler.run_in_process(_format_substitute, dst, src, patterns)
+
+    return dst
+
+# ------------------------------------------------------------------------------
+
+def _autoconf_config_file(dst, src, patterns):
     def replace(match):
         value = patterns[match.group(1)]
         if isinstance(value, str):
@@ -116,25 +115,28 @@ def autoconf_config_file(ctx, dst, src:fbuild.db.SRC, patterns, *,
     with open(dst, 'w') as dst_file:
         dst_file.write(code)
 
-    return dst
-
-# ------------------------------------------------------------------------------
-
 @fbuild.db.caches
-def autoconf_config_header(ctx, dst, src:fbuild.db.SRC, patterns, *,
+@fbuild.db.depends_on(_autoconf_config_file)
+def autoconf_config_file(ctx, dst, src:fbuild.db.SRC, patterns, *,
         buildroot=None) -> fbuild.db.DST:
-    """L{autoconf_config_header} replaces the I{patterns} in the file named
+    """L{autoconf_config_file} replaces the I{patterns} in the file named
     I{src} and saves the changes into file named I{dst}. It uses autoconf
-    AC_CONFIG_HEADERS @word@ and #define patterns to find the insertion
-    points."""
+    AC_CONFIG_FILES @word@ patterns to find the insertion points."""
 
     buildroot = buildroot or ctx.buildroot
     src = fbuild.path.Path(src)
-    dst = fbuild.path.Path.addroot(dst, buildroot)
+    dst = fbuild.path.Path(dst).addroot(buildroot)
     dst.parent.makedirs()
 
     ctx.logger.log(' * creating ' + dst, color='yellow')
 
+    ctx.scheduler.run_in_process(_autoconf_config_file, dst, src, patterns)
+
+    return dst
+
+# ------------------------------------------------------------------------------
+
+def _autoconf_config_header(dst, src, patterns):
     missing_definitions = []
 
     def replace(match):
@@ -182,4 +184,22 @@ def autoconf_config_header(ctx, dst, src:fbuild.db.SRC, patterns, *,
     with open(dst, 'w') as dst_file:
         dst_file.write(code)
 
+@fbuild.db.caches
+@fbuild.db.depends_on(_autoconf_config_header)
+def autoconf_config_header(ctx, dst, src:fbuild.db.SRC, patterns, *,
+        buildroot=None) -> fbuild.db.DST:
+    """L{autoconf_config_header} replaces the I{patterns} in the file named
+    I{src} and saves the changes into file named I{dst}. It uses autoconf
+    AC_CONFIG_HEADERS @word@ and #define patterns to find the insertion
+    points."""
+
+    buildroot = buildroot or ctx.buildroot
+    src = fbuild.path.Path(src)
+    dst = fbuild.path.Path.addroot(dst, buildroot)
+    dst.parent.makedirs()
+
+    ctx.logger.log(' * creating ' + dst, color='yellow')
+
+    ctx.scheduler.run_in_process(_autoconf_config_header, dst, src, patterns)
+
     return dst
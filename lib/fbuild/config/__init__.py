@@ -60,9 +60,21 @@ class TestMeta(fbuild.db.PersistentMeta):
             setattr(cls, key, value)
 
 class Test(metaclass=TestMeta):
+    # The fields that the other fields use, which L{prefetch} evaluates
+    # before the rest.
+    prefetch_first = ()
+
     def __init__(self, ctx):
         self.ctx = ctx
 
+    def __eq__(self, other):
+        # The database stores copies of the tests, so they need to compare
+        # equal to them.
+        return type(self) is type(other) and self.ctx is other.ctx
+
+    def __hash__(self):
+        return hash(type(self))
+
     @classmethod
     def fields(cls):
         for field_name in cls.__field_names__:
@@ -80,3 +92,32 @@ class Test(metaclass=TestMeta):
                 return default
 
         return obj
+
+    def prefetch(self):
+        """Evaluate all of the fields concurrently. See L{prefetch}."""
+        prefetch([self])
+        return self
+
+# ------------------------------------------------------------------------------
+
+def prefetch(tests):
+    """Evaluate all of the fields of the tests concurrently on the scheduler,
+    so that the fields that aren't cached yet are all tested at once rather
+    than one at a time as they're accessed. The results are cached as usual."""
+
+    tests = list(tests)
+    if not tests:
+        return
+
+    first = []
+    rest = []
+    for test in tests:
+        for name, field in test.fields():
+            if name in test.prefetch_first:
+                first.append((test, name))
+            else:
+                rest.append((test, name))
+
+    scheduler = tests[0].ctx.scheduler
+    for fields in first, rest:
+        scheduler.map(lambda field: getattr(*field), fields)
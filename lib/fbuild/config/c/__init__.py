@@ -1,7 +1,14 @@
+import collections
+import functools
+import hashlib
 import textwrap
+import threading
+import types
+import weakref
 
 import fbuild.builders.platform
 import fbuild.config
+import fbuild.config.cache
 import fbuild.db
 
 # ------------------------------------------------------------------------------
@@ -135,6 +142,34 @@ class cacheproperty(fbuild.db.cacheproperty):
         cls.__field_names__.append(key)
         setattr(cls, key, self)
 
+    def call(self, instance):
+        """Look up the field in the config cache if it isn't in the database,
+        and store it there after it's tested."""
+
+        config_cache = instance.ctx.config_cache
+        if config_cache is None or \
+                fbuild.config.cache.digest_field(self.method) is None:
+            return super().call(instance)
+
+        key = instance.config_cache_key()
+        if key is None:
+            return super().call(instance)
+
+        return instance.ctx.db.call_shared(
+            functools.partial(config_cache.get, key, self.__name__,
+                self.method),
+            functools.partial(config_cache.put, key, self.__name__,
+                self.method),
+            types.MethodType(self.method, instance))
+
+# ------------------------------------------------------------------------------
+
+# How far a test has to be built to answer it, from the cheapest stage to the
+# most expensive.
+COMPILE = 'compile'
+LINK = 'link'
+RUN = 'run'
+
 # ------------------------------------------------------------------------------
 
 class AbstractFieldDescriptor:
@@ -142,6 +177,16 @@ class AbstractFieldDescriptor:
     that when accessed, evaluates a cache and returns the appropriate field if
     the cache passes. Otherwise, it returns I{None}."""
 
+    # The headers the test includes before the one under test.
+    includes = ()
+
+    # The number of lines the test prints. Tests that set it can be run in a
+    # L{ProbeBatch} with the other tests.
+    output_lines = None
+
+    # The cheapest stage that answers the test.
+    stage = RUN
+
     def __init__(self, *,
             attribute=None,
             name=None,
@@ -162,6 +207,23 @@ class AbstractFieldDescriptor:
             self.name = key
         cacheproperty(self).contribute_to_class(cls, key)
 
+    def get_stage(self):
+        """Returns the stage the test has to be built to. Handwritten tests
+        and tests that check their input or output are always run."""
+        if self.test is None and self.stdin is None and self.stdout is None:
+            return self.stage
+        return RUN
+
+    @property
+    def batchable(self):
+        """Whether the test can share a program with the other tests."""
+        return \
+            self.output_lines is not None and \
+            self.test is None and \
+            self.stdin is None and \
+            self.stdout is None and \
+            self.timeout is None
+
     def __call__(self, instance):
         # We couldn't find a previous call to this function, so regenerate it.
         if not isinstance(self, header_test) and hasattr(instance, 'header'):
@@ -185,23 +247,39 @@ class AbstractFieldDescriptor:
         instance.ctx.logger.check(msg)
 
         # run the test
-        try:
-            stdout, stderr = instance.builder.tempfile_run(formatted_test,
+        stage = self.get_stage()
+        if stage == RUN and instance.builder.cross_compiler:
+            stdout = self.compute_stdout(instance, header)
+        elif self.batchable and instance.batch_probes:
+            stdout = ProbeBatch.get(instance, header).run(self)
+        else:
+            stdout = _run_test(instance, formatted_test, stage,
+                headers=() if self.test else self.format_headers(header),
                 input=self.stdin,
-                timeout=self.timeout,
-                lkwargs={
-                    'flags': instance.flags,
-                    'libpaths': instance.libpaths,
-                    'libs': instance.libs,
-                    'external_libs': instance.external_libs})
-        except fbuild.ExecutionError:
+                timeout=self.timeout)
+
+        if stdout is None:
             instance.ctx.logger.failed()
         else:
             return self.process_stdout(instance, stdout)
 
-    def format_test(self, instance):
+    def format_headers(self, header=None):
+        """Returns the headers the test starts by including, in order."""
+        return _headers(self.includes, header)
+
+    def format_test(self, header=None):
+        return _format_program(self.includes, header,
+            ['int main() {', self.format_body(), '    return 0;', '}'])
+
+    def format_body(self):
+        """Returns the statements of the test, which are run in I{main}."""
         raise NotImplementedError
 
+    def compute_stdout(self, instance, header):
+        """Returns the output of the test without running it, for builders
+        that can't run what they build, or None if it can't be found."""
+        return None
+
     def process_stdout(self, instance, stdout):
         raise NotImplementedError
 
@@ -234,6 +312,8 @@ class header_test(AbstractFieldDescriptor):
     access. If it exists, the header filename is memoized in the object and
     returned. Otherwise, memoise and return None."""
 
+    stage = COMPILE
+
     def __init__(self, filename, **kwargs):
         super().__init__(**kwargs)
         self.filename = filename
@@ -296,12 +376,10 @@ class function_test(AbstractFieldDescriptor):
             ', '.join(str(a) for a in args),
         )
 
-    def format_test(self, header=None):
-        if header is None:
-            header = ''
-        else:
-            header = '#include <%s>' % header
+    output_lines = 0
+    stage = LINK
 
+    def format_body(self):
         args = []
         defs = []
 
@@ -325,14 +403,7 @@ class function_test(AbstractFieldDescriptor):
         if self.return_type != 'void':
             call = '%s res = %s' % (self.return_type, call)
 
-        return textwrap.dedent('''
-            %s
-            int main() {
-                %s
-                %s;
-                return 0;
-            }
-        ''') % (header, '\n    '.join(defs), call)
+        return _indent(defs + [call + ';'])
 
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
@@ -363,21 +434,14 @@ class macro_test(AbstractFieldDescriptor):
     access. If it exists, an instance of L{Macro} is memoized in the object and
     returned. Otherwise, memoize and return None."""
 
-    def format_test(self, header=None):
-        if header is None:
-            header = ''
-        else:
-            header = '#include <%s>' % header
+    output_lines = 0
+    stage = COMPILE
 
-        return textwrap.dedent('''
-            %s
-            #ifndef %s
-            #error %s is not defined
-            #endif
-            int main() {
-                return 0;
-            }
-        ''') % (header, self.name, self.name)
+    def format_body(self):
+        return _indent([
+            '#ifndef %s' % self.name,
+            '#error %s is not defined' % self.name,
+            '#endif'])
 
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
@@ -393,20 +457,54 @@ class type_test(AbstractFieldDescriptor):
     access. If it exists, an instance of L{Type} is memoized in the object and
     returned. Otherwise, memoize and return None."""
 
-    def format_test(self, header=None):
-        return textwrap.dedent('''
-            #include <stddef.h>
-            #include <stdio.h>
-            %s
-
-            typedef %s type;
-            struct TEST { char c; type mem; };
-            int main() {
-                printf("%%d\\n", (int)offsetof(struct TEST, mem));
-                printf("%%d\\n", (int)sizeof(type));
-                return 0;
-            }
-        ''') % ('' if header is None else '#include <%s>' % header, self.name)
+    includes = ('stddef.h', 'stdio.h')
+
+    # The integer constant expressions the test prints, one per line.
+    exprs = ('(int)offsetof(struct TEST, mem)', '(int)sizeof(type)')
+    output_lines = len(exprs)
+
+    def format_body(self, asserts=()):
+        return _indent([
+            'typedef %s type;' % self.name,
+            'struct TEST { char c; type mem; };'] +
+            ['typedef char fbuild_assert_%d[(%s) ? 1 : -1];' % (i, a)
+                for i, a in enumerate(asserts)] +
+            ['printf("%%d\\n", %s);' % expr for expr in self.exprs])
+
+    def compute_stdout(self, instance, header):
+        """Find the value of each expression at compile time by bisection, by
+        compiling programs that only build if the value is in a range."""
+
+        def compiles(*asserts):
+            code = _format_program(self.includes, header,
+                ['int main() {', self.format_body(asserts), '    return 0;',
+                 '}'])
+            return _run_test(instance, code, COMPILE,
+                headers=self.format_headers(header)) is not None
+
+        if not compiles():
+            return None
+
+        lines = []
+        for expr in self.exprs:
+            # The expressions are never negative, so find an upper bound,
+            # then narrow it down.
+            low = 0
+            high = 1
+            while not compiles('%s <= %d' % (expr, high)):
+                low = high + 1
+                high *= 2
+
+            while low < high:
+                middle = (low + high) // 2
+                if compiles('%s <= %d' % (expr, middle)):
+                    high = middle
+                else:
+                    low = middle + 1
+
+            lines.append(b'%d\n' % low)
+
+        return b''.join(lines)
 
     def process_stdout(self, instance, stdout):
         stdout = stdout.split()
@@ -417,26 +515,13 @@ class type_test(AbstractFieldDescriptor):
 
         return Type(alignment, size)
 
-class int_type_test(AbstractFieldDescriptor):
+class int_type_test(type_test):
     """L{int_type_test} is a descriptor that tests for the function on the
     first access.  If it exists, an instance of L{IntType} is memoized in the
     object and returned.  Otherwise, memoize and return None."""
 
-    def format_test(self, header=None):
-        return textwrap.dedent('''
-            #include <stddef.h>
-            #include <stdio.h>
-            %s
-
-            typedef %s type;
-            struct TEST { char c; type mem; };
-            int main() {
-                printf("%%d\\n", (int)offsetof(struct TEST, mem));
-                printf("%%d\\n", (int)sizeof(type));
-                printf("%%d\\n", (type)~3 < (type)0);
-                return 0;
-            }
-        ''') % ('' if header is None else '#include <%s>' % header, self.name)
+    exprs = type_test.exprs + ('(type)~3 < (type)0',)
+    output_lines = len(exprs)
 
     def process_stdout(self, instance, stdout):
         stdout = stdout.split()
@@ -456,6 +541,9 @@ class struct_test(AbstractFieldDescriptor):
     access.  If it exists, an instance of L{Struct} is memoized in the object
     and returned.  Otherwise, memoize and return None."""
 
+    output_lines = 0
+    stage = COMPILE
+
     def __init__(self, *members, **kwargs):
         super().__init__(**kwargs)
         self.members = members
@@ -466,24 +554,12 @@ class struct_test(AbstractFieldDescriptor):
             self.name = 'struct ' + key
         cacheproperty(self).contribute_to_class(cls, key)
 
-    def format_test(self, header=None):
-        if header is None:
-            header = ''
-        else:
-            header = '#include <%s>' % header
-
-        defs = []
+    def format_body(self):
+        defs = ['%s arg;' % self.name]
         for i, (type, member) in enumerate(self.members):
             defs.append('%s arg_%d = arg.%s;' % (type, i, member))
 
-        return textwrap.dedent('''
-            %s
-            int main() {
-                %s arg;
-                %s
-                return 0;
-            }
-        ''') % (header, self.name, '\n    '.join(defs))
+        return _indent(defs)
 
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
@@ -510,19 +586,11 @@ class variable_test(AbstractFieldDescriptor):
     first access.  If it exists, an instance of L{Variable} is memoized in the
     object and returned.  Otherwise, memoize and return None."""
 
-    def format_test(self, header=None):
-        if header is None:
-            header = ''
-        else:
-            header = '#include <%s>' % header
+    output_lines = 0
+    stage = LINK
 
-        return textwrap.dedent('''
-            %s
-            int main() {
-                %s;
-                return 0;
-            }
-        ''') % (header, self.name)
+    def format_body(self):
+        return _indent(['%s;' % self.name])
 
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
@@ -533,6 +601,206 @@ class variable_test(AbstractFieldDescriptor):
 
 # ------------------------------------------------------------------------------
 
+class ProbeBatch:
+    """
+    Run the batchable tests of a L{Test} in as few programs as possible. Each
+    test becomes a function of the program, and the program prints the output
+    of each test in turn. If the program fails, it's split in half until the
+    tests that fail are found, and those are run on their own like before.
+
+    The batch is run when the first of its tests has to be, so tests that are
+    already cached don't run it.
+    """
+
+    _batches = {}
+    _batches_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, instance, header):
+        """Returns the batch of the tests in the instance."""
+
+        key = id(instance)
+        with cls._batches_lock:
+            try:
+                return cls._batches[key]
+            except KeyError:
+                batch = cls._batches[key] = cls(instance, header)
+
+        weakref.finalize(instance, cls._batches.pop, key, None)
+
+        return batch
+
+    def __init__(self, instance, header):
+        self.instance = instance
+        self.header = header
+        self.programs = 0
+
+        self._lock = threading.Lock()
+        self._results = None
+
+    def run(self, probe):
+        """Returns the output of the test, or None if it failed."""
+
+        with self._lock:
+            if self._results is None:
+                self._results = {}
+
+                # Tests that include different headers or are built to
+                # different stages can't share a program.
+                cross_compiler = self.instance.builder.cross_compiler
+                groups = {}
+                for name, field in self.instance.fields():
+                    if isinstance(field, cacheproperty) and \
+                            isinstance(field.method, AbstractFieldDescriptor) \
+                            and field.method.batchable:
+                        stage = field.method.get_stage()
+                        if stage == RUN and cross_compiler:
+                            continue
+                        groups.setdefault((field.method.includes, stage),
+                            []).append(field.method)
+
+                for (includes, stage), probes in groups.items():
+                    self._run(probes, stage)
+
+        return self._results[probe.__name__]
+
+    def _run(self, probes, stage):
+        headers = probes[0].format_headers(self.header)
+        if len(probes) == 1:
+            self._results[probes[0].__name__] = self._execute(
+                probes[0].format_test(self.header), stage, headers)
+            return
+
+        stdout = self._execute(self.format_program(probes), stage, headers)
+        if stdout is not None:
+            lines = stdout.splitlines(keepends=True)
+            if len(lines) == sum(probe.output_lines for probe in probes):
+                for probe in probes:
+                    self._results[probe.__name__] = \
+                        b''.join(lines[:probe.output_lines])
+                    del lines[:probe.output_lines]
+                return
+
+        # Find the tests that failed.
+        middle = len(probes) // 2
+        self._run(probes[:middle], stage)
+        self._run(probes[middle:], stage)
+
+    def _execute(self, code, stage, headers):
+        self.programs += 1
+        return _run_test(self.instance, code, stage, headers=headers)
+
+    def format_program(self, probes):
+        """Returns a program that runs all of the tests."""
+
+        lines = []
+        for i, probe in enumerate(probes):
+            lines.extend([
+                'static void fbuild_probe_%d(void) {' % i,
+                probe.format_body(),
+                '}'])
+
+        lines.append('int main() {')
+        lines.extend('    fbuild_probe_%d();' % i for i in range(len(probes)))
+        lines.extend(['    return 0;', '}'])
+
+        return _format_program(probes[0].includes, self.header, lines)
+
+def _run_test(instance, code, stage=RUN, *, headers=(), **kwargs):
+    """Build the test program to the stage, and return its output, or None if
+    it failed. Programs that aren't run have no output. If the program starts
+    by including the headers, they may be included from a precompiled
+    header."""
+
+    ckwargs = {}
+    if headers and instance.precompile_headers:
+        flags = _precompile_header(instance.builder, headers)
+        if flags:
+            ckwargs['flags'] = flags
+
+    lkwargs = {
+        'flags': instance.flags,
+        'libpaths': instance.libpaths,
+        'libs': instance.libs,
+        'external_libs': instance.external_libs}
+
+    try:
+        if stage == COMPILE:
+            with instance.builder.tempfile_compile(code, **ckwargs):
+                return b''
+        elif stage == LINK:
+            with instance.builder.tempfile_link_exe(code,
+                    ckwargs=ckwargs,
+                    **lkwargs):
+                return b''
+        else:
+            stdout, stderr = instance.builder.tempfile_run(code,
+                ckwargs=ckwargs,
+                lkwargs=lkwargs,
+                **kwargs)
+    except fbuild.ExecutionError:
+        return None
+    else:
+        return stdout
+
+# The headers that failed to precompile, by the builder.
+_failed_precompiled_headers = set()
+_precompiled_headers_locks = collections.defaultdict(threading.Lock)
+_precompiled_headers_lock = threading.Lock()
+
+def _precompile_header(builder, headers):
+    """Returns the flags that make the builder include the headers from a
+    precompiled header, or None if the builder can't precompile them."""
+
+    try:
+        precompile_header = builder.precompile_header
+    except AttributeError:
+        return None
+
+    # The builders aren't hashable, but they live as long as the build. The
+    # lock stops the tests from precompiling the same header at once, and
+    # the db caches the precompiled header after that.
+    key = (id(builder), headers)
+    with _precompiled_headers_lock:
+        lock = _precompiled_headers_locks[key]
+
+    with lock:
+        if key in _failed_precompiled_headers:
+            return None
+
+        try:
+            return precompile_header(headers)
+        except fbuild.ExecutionError:
+            _failed_precompiled_headers.add(key)
+            return None
+
+def _headers(includes, header):
+    if header is None:
+        return tuple(includes)
+    return tuple(includes) + (header,)
+
+def _format_program(includes, header, lines):
+    return '\n'.join(['#include <%s>' % i for i in _headers(includes, header)] +
+        lines) + '\n'
+
+def _indent(lines):
+    return '\n'.join('    ' + line for line in lines)
+
+_probes_digest = None
+
+def _digest_probes():
+    """Returns a digest of the code that builds and runs the tests, which
+    changes the results in the config cache when it changes."""
+
+    global _probes_digest
+    if _probes_digest is None:
+        _probes_digest = fbuild.config.cache.digest_code(ProbeBatch, _run_test,
+            _precompile_header, _headers, _format_program, _indent)
+
+    return _probes_digest
+
+# ------------------------------------------------------------------------------
+
 class TestMeta(fbuild.config.TestMeta):
     def __call__(cls, builder, *args, **kwargs):
         result, srcs, objs = builder.ctx.db.call(cls.__call_super__, builder,
@@ -542,6 +810,17 @@ class TestMeta(fbuild.config.TestMeta):
 
 
 class Test(fbuild.config.Test, metaclass=TestMeta):
+    # The other tests are skipped if the header is missing.
+    prefetch_first = ('header',)
+
+    # Run the tests that can share a program in a L{ProbeBatch}.
+    batch_probes = True
+
+    # Include the headers of the tests from precompiled headers, when the
+    # builder can precompile them. C headers are quick enough to parse that
+    # it rarely pays off.
+    precompile_headers = False
+
     def __init__(self, builder, *,
             platform=None,
             flags=[],
@@ -560,6 +839,30 @@ class Test(fbuild.config.Test, metaclass=TestMeta):
         self.libs = list(libs)
         self.external_libs = list(external_libs)
 
+    def config_cache_key(self):
+        """Returns the key of the test's results in the config cache, which is
+        the same for tests of the same class and arguments whose builders
+        build the same way. Returns None if they can't be shared, because
+        the builder has no fingerprint or the test links with libraries
+        from the project."""
+
+        if self.libpaths or self.libs:
+            return None
+
+        fingerprint = fbuild.config.cache.fingerprint(self.builder)
+        if fingerprint is None:
+            return None
+
+        return hashlib.sha256(repr((
+            fingerprint,
+            _digest_probes(),
+            self.__class__.__module__,
+            self.__class__.__qualname__,
+            sorted(self.platform),
+            [str(flag) for flag in self.flags],
+            [str(lib) for lib in self.external_libs],
+        )).encode()).hexdigest()
+
     def functions(self):
         for name, field in self.fields():
             if isinstance(field, cacheproperty):
@@ -0,0 +1,227 @@
+"""
+A cache of the results of configuration tests, which is shared between every
+build on the machine, such as in I{~/.cache/fbuild/config}. The results only
+depend on the toolchain, so a test is looked up by a fingerprint of its
+builder and its own arguments, and fresh checkouts don't have to configure
+again.
+
+The cache can't tell when a library is installed, so a test that failed keeps
+failing until the build is run with I{--rebuild}, which tests again and
+replaces the results.
+"""
+
+import hashlib
+import os
+import pickle
+import threading
+import uuid
+import weakref
+
+import fbuild
+import fbuild.db.database
+import fbuild.inspect
+import fbuild.path
+
+# ------------------------------------------------------------------------------
+
+def default_directory():
+    """Returns the user's config cache directory."""
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+
+    return fbuild.path.Path(cache_home, 'fbuild', 'config')
+
+# ------------------------------------------------------------------------------
+
+class ConfigCache:
+    """
+    Store the results of the tests in a directory, with a file for each test
+    and arguments. If I{read} is false, the tests are run again, and their
+    results replace the ones in the cache.
+    """
+
+    def __init__(self, directory, *, read=True):
+        self.directory = fbuild.path.Path(directory)
+        self.read = read
+
+        self._lock = threading.Lock()
+
+        # The results we loaded, by the key of the test.
+        self._results = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, name, method):
+        """Returns the result of the test's field. Raises I{KeyError} if we
+        don't have it."""
+
+        field_key = (name, digest_field(method))
+
+        with self._lock:
+            if self.read and field_key[1] is not None:
+                try:
+                    result = self._load(key)[field_key]
+                except KeyError:
+                    pass
+                else:
+                    self.hits += 1
+                    return result
+
+            self.misses += 1
+
+        raise KeyError(name)
+
+    def put(self, key, name, method, result):
+        """Store the result of the test's field. Returns whether it was
+        stored."""
+
+        field_key = (name, digest_field(method))
+        if field_key[1] is None:
+            return False
+
+        with self._lock:
+            # Merge our result with any that other builds stored since we
+            # loaded the file.
+            results = self._read(key)
+            self._results[key] = results
+
+            # Don't write the file again if it already has the result.
+            if field_key in results and results[field_key] == result:
+                return True
+
+            results[field_key] = result
+
+            try:
+                data = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                # We can't store results that don't pickle.
+                del results[field_key]
+                return False
+
+            # Write the file where other builds can't see it until it's done.
+            path = self._path(key)
+            tmp = path.parent / ('.%s.tmp' % uuid.uuid4().hex)
+            try:
+                path.parent.makedirs()
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except OSError:
+                if tmp.exists():
+                    tmp.remove()
+                return False
+
+        return True
+
+    def _load(self, key):
+        try:
+            return self._results[key]
+        except KeyError:
+            results = self._results[key] = self._read(key)
+            return results
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            # The file is missing, or we couldn't read it.
+            return {}
+
+    def summary(self):
+        """Returns a line about how well the cache worked."""
+
+        tests = self.hits + self.misses
+        line = '%d hits, %d misses' % (self.hits, self.misses)
+        if tests:
+            line += ' (%d%% hit rate)' % (100 * self.hits / tests)
+
+        return line
+
+    def _path(self, key):
+        return self.directory / key[:2] / key
+
+# ------------------------------------------------------------------------------
+
+# The fingerprints of the builders, by their id, since they aren't hashable.
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+def fingerprint(builder):
+    """Returns the fingerprint of the builder, or None if it doesn't have one.
+    It's only computed once for each builder, since it runs the compiler."""
+
+    key = id(builder)
+    with _fingerprints_lock:
+        try:
+            return _fingerprints[key]
+        except KeyError:
+            pass
+
+    try:
+        builder_fingerprint = builder.fingerprint
+    except AttributeError:
+        result = None
+    else:
+        try:
+            result = builder_fingerprint()
+        except (fbuild.Error, OSError):
+            result = None
+
+    with _fingerprints_lock:
+        if key not in _fingerprints:
+            _fingerprints[key] = result
+            weakref.finalize(builder, _fingerprints.pop, key, None)
+
+    return result
+
+# The fields and their digests, by the id of the field, so that descriptors
+# that only compare some of their arguments still get their own digests.
+_field_digests = {}
+
+def digest_field(method):
+    """Returns a digest of the field's function, or of the field descriptor's
+    arguments and the code of its class. Returns None if the arguments can't
+    be digested, in which case the field can't be shared."""
+
+    try:
+        return _field_digests[id(method)][1]
+    except KeyError:
+        pass
+
+    if fbuild.inspect.isroutine(method):
+        digest = fbuild.db.database.Database._digest_function(method)
+    else:
+        try:
+            arguments = pickle.dumps(sorted(vars(method).items()), 2)
+        except Exception:
+            digest = None
+        else:
+            h = hashlib.md5(arguments)
+            h.update(digest_code(type(method)).encode())
+            digest = h.hexdigest()
+
+    _field_digests[id(method)] = (method, digest)
+
+    return digest
+
+def digest_code(*objects):
+    """Returns a digest of the functions, and of the functions of the classes
+    and their bases."""
+
+    digest_function = fbuild.db.database.Database._digest_function
+
+    h = hashlib.md5()
+    for obj in objects:
+        if isinstance(obj, type):
+            for cls in obj.__mro__:
+                h.update(('%s.%s' % (cls.__module__, cls.__qualname__)).encode())
+                for name, value in sorted(vars(cls).items()):
+                    if fbuild.inspect.isfunction(value):
+                        h.update(digest_function(value).encode())
+        else:
+            h.update(digest_function(obj).encode())
+
+    return h.hexdigest()
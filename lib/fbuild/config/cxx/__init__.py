@@ -42,6 +42,8 @@ class template_test(c.AbstractFieldDescriptor):
     access. If it exists, an instance of L{Template} is memoized in the object
     and returned. Otherwise, memoize and return None."""
 
+    stage = c.COMPILE
+
     def __init__(self, *, test_types=[], **kwargs):
         super().__init__(**kwargs)
         self.test_types = test_types
@@ -84,3 +86,6 @@ class TestMeta(c.TestMeta):
 
 class Test(c.Test, metaclass=TestMeta):
     namespace = None
+
+    # C++ headers are slow to parse, so precompile them.
+    precompile_headers = True
@@ -113,11 +113,17 @@ class Log:
         self.nocolor = nocolor
         self.show_threads = show_threads
 
-        self.maxlen = 25
         self._lock = threading.RLock()
         self._threadcount = threadcount
         self._thread_stack = _ThreadStack()
 
+        self.reset()
+
+    def reset(self):
+        """Start laying out the messages like a new log would."""
+
+        self.maxlen = 25
+
     @contextlib.contextmanager
     def log_from_thread(self):
         self._thread_stack.append([])
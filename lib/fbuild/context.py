@@ -6,8 +6,12 @@ import time
 
 import fbuild
 import fbuild.builders.platform
+import fbuild.config.cache
 import fbuild.console
+import fbuild.db.artifact_cache
 import fbuild.db.database
+import fbuild.db.remote_cache
+import fbuild.jobserver
 import fbuild.sched
 import fbuild.subprocess.killableprocess
 import fbuild.temp
@@ -41,14 +45,61 @@ class Context:
             threadcount=options.threadcount,
             show_threads=options.show_threads)
 
+        if options.remote_cache is None:
+            remote_cache = None
+        else:
+            remote_cache = fbuild.db.remote_cache.HTTPCache(
+                options.remote_cache)
+
+            # The remote artifacts are kept in a local cache too.
+            if options.artifact_cache is None:
+                options.artifact_cache = options.buildroot / 'artifacts'
+
+        if options.artifact_cache is None:
+            artifact_cache = None
+        else:
+            artifact_cache = fbuild.db.artifact_cache.ArtifactCache(self,
+                options.artifact_cache,
+                max_size=options.artifact_cache_size * 1024 * 1024,
+                link=options.artifact_cache_link,
+                remote=remote_cache)
+
+        if options.config_cache is None:
+            self.config_cache = None
+        else:
+            # Test again when we're asked to configure from scratch.
+            self.config_cache = fbuild.config.cache.ConfigCache(
+                options.config_cache,
+                read=not (options.force_rebuild or
+                    options.force_configuration))
+
         self.db = fbuild.db.database.Database(self,
             engine=options.database_engine,
-            explain=options.explain_database)
+            explain=options.explain_database,
+            inline=options.inline_database,
+            digest_algorithm=options.digest_algorithm,
+            watch=options.watch,
+            shared=options.shared_database,
+            artifact_cache=artifact_cache)
         self.scheduler = fbuild.sched.Scheduler(options.threadcount,
-            logger=self.logger)
+            logger=self.logger,
+            priority=options.critical_path,
+            work_stealing=options.work_stealing,
+            processcount=options.processcount,
+            memory_budget=None if options.memory_budget is None else \
+                options.memory_budget * 1024 * 1024)
 
         self.options = options
 
+        # Share a limit on the number of running commands with any make based
+        # builds we run, joining our parent make's jobserver if we have one.
+        if options.jobserver and sys.platform != 'win32':
+            self.jobserver = fbuild.jobserver.JobServer.from_makeflags(
+                os.environ.get('MAKEFLAGS')) or \
+                fbuild.jobserver.JobServer(max(1, options.threadcount))
+        else:
+            self.jobserver = None
+
         self.install_prefix = Path('/usr/local')
         self.to_install = []
 
@@ -82,14 +133,24 @@ class Context:
 
         self.db.connect(self.options.state_file)
 
-    def save_configuration(self):
+        # Load the task statistics so the scheduler can estimate how long a
+        # task will take.
+        self.scheduler.task_stats.update(self.db.load_task_stats())
+
+    def save_configuration(self, *, close=True):
+        """Save the database, and close it unless I{close} is False."""
+
         # Optionally do `not` save the database.
         if not self.options.do_not_save_database:
             # Remove the signal handler so that we can't interrupt saving the
             # db.
             prev_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
             try:
-                self.db.close()
+                self.db.save_task_stats(self.scheduler.task_stats)
+                if close:
+                    self.db.close()
+                else:
+                    self.db.commit()
             finally:
                 signal.signal(signal.SIGINT, prev_handler)
 
@@ -111,8 +172,12 @@ class Context:
             env=None,
             runtime_libpaths=None,
             ignore_error=False,
+            memory=None,
             **kwargs):
-        """Execute the command and return the output."""
+        """Execute the command and return the output. If the scheduler has a
+        memory budget, wait until I{memory} bytes fit into it before running
+        the command. It defaults to the peak memory the command used the last
+        time it ran."""
 
         if isinstance(cmd, str):
             cmd_string = cmd
@@ -187,40 +252,78 @@ class Context:
             # Set the timer to None for now to make sure it's defined.
             timer = None
 
-        starttime = time.time()
+        # Wait until we have enough memory to run the command.
+        memory_budget = self.scheduler.memory_budget
+        if memory_budget is not None:
+            # Temporary files have new names every time, so leave them out of
+            # the key to keep the statistics from growing with every build.
+            stats_key = 'execute:' + fbuild.temp.strip_tempdirs(cmd_string)
+            if memory is None:
+                memory = self.scheduler.task_stats.get(stats_key, {}).get(
+                    'peak_rss', 0)
+
+            with self.scheduler.interruptible():
+                memory_budget.acquire(memory)
+
+        # The memory is given back even if we fail to get a job slot.
         try:
-            p = fbuild.subprocess.killableprocess.Popen(cmd,
-                stdin=fbuild.subprocess.PIPE if input else stdin,
-                stdout=stdout,
-                stderr=stderr,
-                env=env,
-                **kwargs)
+            # Wait for a job slot, and let the children use the jobserver too.
+            if self.jobserver is not None:
+                env['MAKEFLAGS'] = self.jobserver.makeflags(
+                    env.get('MAKEFLAGS'))
+                kwargs['pass_fds'] = tuple(kwargs.get('pass_fds', ())) + \
+                    self.jobserver.fds
+
+                with self.scheduler.interruptible():
+                    token = self.jobserver.acquire()
 
+            starttime = time.time()
             try:
-                if timeout:
-                    timer = threading.Timer(timeout, timeout_function, (p,))
-                    timer.start()
+                p = fbuild.subprocess.killableprocess.Popen(cmd,
+                    stdin=fbuild.subprocess.PIPE if input else stdin,
+                    stdout=stdout,
+                    stderr=stderr,
+                    env=env,
+                    **kwargs)
+
+                try:
+                    if timeout:
+                        timer = threading.Timer(timeout, timeout_function,
+                            (p,))
+                        timer.start()
+
+                    with self.scheduler.interruptible():
+                        stdout, stderr = p.communicate(input)
+                        returncode = p.wait()
+                except KeyboardInterrupt:
+                    # Make sure if we get a keyboard interrupt to kill the
+                    # process.
+                    p.kill(group=True, sigint=True)
+                    raise
+                else:
+                    # Detect Ctrl-C in subprocess.
+                    if returncode == -signal.SIGINT:
+                        raise KeyboardInterrupt
+            except OSError as e:
+                # flush the logger
+                self.logger.log('command failed: ' + cmd_string, color='red')
+                raise e from e
+            finally:
+                if timeout and timer is not None:
+                    timer.cancel()
 
-                with self.scheduler.interruptible():
-                    stdout, stderr = p.communicate(input)
-                    returncode = p.wait()
-            except KeyboardInterrupt:
-                # Make sure if we get a keyboard interrupt to kill the process.
-                p.kill(group=True, sigint=True)
-                raise
-            else:
-                # Detect Ctrl-C in subprocess.
-                if returncode == -signal.SIGINT:
-                    raise KeyboardInterrupt
-        except OSError as e:
-            # flush the logger
-            self.logger.log('command failed: ' + cmd_string, color='red')
-            raise e from e
+                if self.jobserver is not None:
+                    self.jobserver.release(token)
         finally:
-            if timeout and timer is not None:
-                timer.cancel()
+            if memory_budget is not None:
+                memory_budget.release(memory)
         endtime = time.time()
 
+        # Remember how much memory the command needed for next time.
+        if memory_budget is not None and p.peak_rss is not None:
+            self.scheduler.task_stats.setdefault(stats_key, {})['peak_rss'] = \
+                p.peak_rss
+
         if returncode:
             self.logger.log(' + ' + cmd_string, verbose=quieter)
         else:
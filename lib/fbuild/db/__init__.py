@@ -265,3 +265,25 @@ class cacheproperty:
         _check_ctx(instance.ctx, instance.__class__.__name__,
                    'cache<member>.call')
         return instance.ctx.db.call(types.MethodType(self.method, instance))
+
+# ------------------------------------------------------------------------------
+
+def depends_on(*functions):
+    """L{depends_on} decorates a cached function with the plain functions it
+    calls, such as helpers it runs in another process. Their code is digested
+    along with the function's, so changing them reruns its calls. It has to be
+    applied beneath L{caches}, L{cachemethod} or L{cacheproperty}.
+
+    >>> def helper(x):
+    ...     return x + 1
+    >>> @caches
+    ... @depends_on(helper)
+    ... def test(ctx, x):
+    ...     return helper(x)
+    """
+
+    def decorate(function):
+        function.__fbuild_depends_on__ = functions
+        return function
+
+    return decorate
@@ -0,0 +1,336 @@
+"""
+A cache of the results and output files of cached function calls, which is
+shared between builds in different directories. The calls are looked up by a
+digest of the function, its arguments and its source files, so the cache
+directory can be used by any number of builds at once, for instance over NFS.
+Since different arguments may share a digest, the arguments are stored with
+the artifact, and it's only used for a call whose arguments compare equal.
+It can also be backed by a L{fbuild.db.remote_cache} on another machine.
+"""
+
+import collections
+import hashlib
+import os
+import pickle
+import shutil
+import threading
+import uuid
+
+import fbuild.db.backend
+import fbuild.db.remote_cache
+import fbuild.path
+
+# ------------------------------------------------------------------------------
+
+Artifact = collections.namedtuple('Artifact', (
+    # The bound arguments of the call.
+    'bound',
+
+    # The result of the call.
+    'result',
+
+    # The names of the files the call wrote.
+    'dsts',
+
+    # The digests of the files and functions the call used that we only found
+    # out about while it ran, keyed by their names.
+    'external_srcs',
+    'external_dsts',
+    'fun_dependents'))
+
+# ------------------------------------------------------------------------------
+
+class ArtifactCache:
+    """
+    Store the artifacts of calls in a directory, and evict the least recently
+    used ones once they take up more than I{max_size} bytes. If I{link} is
+    true, the files are hard linked out of the cache instead of copied, which
+    is only safe if nothing writes over them in place.
+
+    If there's a I{remote} cache, the artifacts we don't have are downloaded
+    from it, and the ones we store are uploaded to it in the background.
+    """
+
+    def __init__(self, ctx, directory, *, max_size, link=False, remote=None):
+        self._ctx = ctx
+        self.directory = fbuild.path.Path(directory)
+        self.max_size = max_size
+        self.link = link
+        self.remote = remote
+
+        self._lock = threading.Lock()
+
+        # We only add up the size of the cache once we first store something.
+        self._size = None
+
+        # The uploader is started once we first store something.
+        self._uploader = None
+
+        self.hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+
+    def key(self, fun_name, fun_digest, call_key, src_digests):
+        """Returns the key of a call from the function, the key of its
+        arguments and the digests of its source files."""
+
+        h = hashlib.sha256()
+        for s in (fun_name, fun_digest, call_key):
+            h.update(s.encode() + b'\0')
+
+        for src, digest in sorted(src_digests.items()):
+            h.update(src.encode() + b'\0' + digest.encode() + b'\0')
+
+        return h.hexdigest()
+
+    # --------------------------------------------------------------------------
+
+    def fetch(self, key, bound, is_valid):
+        """Restore the files of the artifact for the key, and return the
+        artifact. Returns None if there isn't one, if it was stored for a call
+        whose arguments don't equal I{bound}, or if I{is_valid} returns false
+        for it."""
+
+        path = self._path(key)
+
+        remote_hit = False
+        if self.remote is not None and not (path / 'artifact').exists():
+            remote_hit = self._download(key)
+
+        try:
+            with open(path / 'artifact', 'rb') as f:
+                artifact = fbuild.db.backend.Unpickler(self._ctx, f).load()
+
+            # The key doesn't tell apart every pair of arguments, and the
+            # artifact may have come from another machine, so make sure it
+            # was made by the same call.
+            if artifact.bound == bound and is_valid(artifact):
+                for i, dst in enumerate(artifact.dsts):
+                    self._restore(path / 'files' / str(i), dst)
+
+                # Remember that we used it so it's evicted last.
+                os.utime(path / 'artifact')
+            else:
+                artifact = None
+        except Exception:
+            # The artifact is missing, or another build evicted it while we
+            # were restoring it.
+            artifact = None
+
+        with self._lock:
+            if artifact is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if remote_hit:
+                    self.remote_hits += 1
+
+        return artifact
+
+    def _restore(self, src, dst):
+        dst = fbuild.path.Path(dst)
+        if dst.parent:
+            dst.parent.makedirs()
+
+        if dst.exists():
+            dst.remove()
+
+        if self.link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                # The cache is probably on another file system.
+                pass
+
+        # Give the file a new mtime, since it's newer than its sources.
+        shutil.copy(src, dst)
+
+    # --------------------------------------------------------------------------
+
+    def store(self, key, artifact):
+        """Store the artifact for the key, unless we already have it or any of
+        its files can't be stored. Returns whether it was stored."""
+
+        path = self._path(key)
+        if (path / 'artifact').exists():
+            return False
+
+        if not all(os.path.isfile(dst) for dst in artifact.dsts):
+            return False
+
+        try:
+            data = fbuild.db.backend.pickle_dumps(self._ctx, artifact)
+        except Exception:
+            # We can't store results that don't pickle.
+            return False
+
+        def write_files(files):
+            for i, dst in enumerate(artifact.dsts):
+                shutil.copy2(dst, files / str(i))
+
+        if not self._add(key, data, write_files):
+            return False
+
+        if self.remote is not None:
+            with self._lock:
+                if self._uploader is None:
+                    self._uploader = fbuild.db.remote_cache.Uploader(
+                        self._upload)
+                    self._uploader.start()
+
+            self._uploader.put(key)
+
+        return True
+
+    def _add(self, key, data, write_files):
+        """Add the pickled artifact to the cache, after calling
+        I{write_files} to write its files into a directory. Returns whether it
+        was added."""
+
+        path = self._path(key)
+
+        # Fill in the artifact where other builds can't see it yet.
+        tmp = self.directory / 'tmp' / uuid.uuid4().hex
+        try:
+            (tmp / 'files').makedirs()
+            write_files(tmp / 'files')
+
+            with open(tmp / 'artifact', 'wb') as f:
+                f.write(data)
+
+            size = _disk_usage(tmp)
+
+            path.parent.makedirs()
+            os.rename(tmp, path)
+        except OSError:
+            # We couldn't write to the cache, or another build stored the
+            # artifact first.
+            return False
+        finally:
+            if tmp.exists():
+                tmp.rmtree(ignore_errors=True)
+
+        with self._lock:
+            if self._size is None:
+                self._size = _disk_usage(self.directory)
+            else:
+                self._size += size
+
+            if self._size > self.max_size:
+                self._evict()
+
+        return True
+
+    def _download(self, key):
+        """Add the artifact from the remote cache to ours. Returns whether it
+        was there."""
+
+        data = self.remote.get(key)
+        if data is None:
+            return False
+
+        try:
+            data, files = pickle.loads(data)
+        except Exception:
+            return False
+
+        def write_files(path):
+            for i, contents in enumerate(files):
+                with open(path / str(i), 'wb') as f:
+                    f.write(contents)
+
+        self._add(key, data, write_files)
+
+        return True
+
+    def _upload(self, key):
+        """Upload our artifact to the remote cache, unless it was evicted in
+        the meantime. Returns whether it was uploaded."""
+
+        path = self._path(key)
+
+        try:
+            with open(path / 'artifact', 'rb') as f:
+                data = f.read()
+
+            files = []
+            for i in range(len((path / 'files').listdir())):
+                with open(path / 'files' / str(i), 'rb') as f:
+                    files.append(f.read())
+        except OSError:
+            return False
+
+        return self.remote.put(key,
+            pickle.dumps((data, files), pickle.HIGHEST_PROTOCOL))
+
+    def close(self):
+        """Wait for the artifacts to finish uploading."""
+
+        with self._lock:
+            uploader = self._uploader
+            self._uploader = None
+
+        if uploader is not None:
+            uploader.join()
+
+    def summary(self):
+        """Returns a line about how well the cache worked."""
+
+        calls = self.hits + self.misses
+        line = '%d hits, %d misses' % (self.hits, self.misses)
+        if self.remote is not None:
+            line += ', %d hits from the remote cache' % self.remote_hits
+        if calls:
+            line += ' (%d%% hit rate)' % (100 * self.hits / calls)
+
+        return line
+
+    def _evict(self):
+        """Remove the least recently used artifacts until the cache is back
+        down to 90% of its maximum size."""
+
+        artifacts = []
+        size = 0
+        for dirpath in self.directory.listdir():
+            if len(dirpath) != 2:
+                continue
+
+            for name in (self.directory / dirpath).listdir():
+                path = self.directory / dirpath / name
+                try:
+                    mtime = (path / 'artifact').getmtime()
+                except OSError:
+                    continue
+
+                artifact_size = _disk_usage(path)
+                artifacts.append((mtime, artifact_size, path))
+                size += artifact_size
+
+        artifacts.sort()
+        for mtime, artifact_size, path in artifacts:
+            if size <= self.max_size * 0.9:
+                break
+
+            path.rmtree(ignore_errors=True)
+            size -= artifact_size
+
+        self._size = size
+
+    def _path(self, key):
+        return self.directory / key[:2] / key
+
+# ------------------------------------------------------------------------------
+
+def _disk_usage(directory):
+    """Returns the total size of the files under the directory."""
+
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+
+    return size
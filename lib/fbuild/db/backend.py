@@ -1,17 +1,46 @@
+import hashlib
 import io
 import pickle
 import time
 
+import fbuild.db
 from fbuild.path import Path
 
 # ------------------------------------------------------------------------------
 
+class UnhashedFiles(Exception):
+    """Raised by L{Backend.prepare} when files changed that the caller needs
+    to hash."""
+
+    def __init__(self, file_names):
+        super().__init__(file_names)
+        self.file_names = file_names
+
+# ------------------------------------------------------------------------------
+
 class Backend:
     # Version used for databases created before db versioning was introduced.
     _NULL_VERSION = '0'
 
-    def __init__(self, ctx):
+    # Whether the calls passed to L{cache} are pickled. The database then
+    # hands us a copy of them, since the caller may change them before we get
+    # to pickle them.
+    pickles_calls = True
+
+    def __init__(self, ctx, *, digest_algorithm='md5'):
         self._ctx = ctx
+        self.digest_algorithm = digest_algorithm
+
+        # Digests that the caller of prepare computed for us.
+        self._digests = {}
+
+        # The results of add_file for each file we've looked at during this
+        # build, so that we only stat and hash a file once.
+        self._file_cache = {}
+
+        # If we have a L{fbuild.watch.Watcher}, the file cache is kept across
+        # builds, and the watcher tells us which files to forget.
+        self.watcher = None
 
     def version(self):
         """Return a string detailing the database specification version used."""
@@ -42,10 +71,22 @@ class Backend:
         """Close the connection to the database backend."""
         raise NotImplementedError
 
+    def flush(self):
+        """Write out any changes the backend is holding on to, so that they
+        aren't lost if we crash."""
+        pass
+
+    def commit(self):
+        """Save every change so far, without closing the database."""
+        self.flush()
+
     # --------------------------------------------------------------------------
 
-    def prepare(self, fun_name, fun_digest, bound, srcs, dsts):
-        """Queries all the information needed to cache a function."""
+    def prepare(self, fun_name, fun_digest, bound, srcs, dsts, digests=None):
+        """Queries all the information needed to cache a function. If
+        I{digests} is given, changed files that aren't in it are not hashed.
+        Instead, we raise L{UnhashedFiles} so the caller can hash them outside
+        of the database and try again."""
 
         # Check if the function changed.
         fun_dirty, fun_id = self.check_function(fun_name)
@@ -58,18 +99,34 @@ class Backend:
         else:
             call_dirty, call_id, old_result = self.find_call(fun_id, bound)
 
-        # Add the source files to the database. We always run this because it
-        # adds our call files to the database for us.
-        call_file_digests = self.check_call_files(call_id, srcs)
-
-        # Check extra external call files.
-        if call_id is None:
-            external_srcs = frozenset()
-            external_dsts = frozenset()
-            external_digests = ()
-        else:
-            external_srcs, external_dsts, external_digests = \
-                self.check_external_files(call_id)
+        if digests is not None:
+            file_names = set(srcs)
+            if call_id is not None:
+                file_names.update(self.find_external_srcs(call_id))
+
+            unhashed = [file_name
+                for file_name in self.find_changed_files(file_names)
+                if file_name not in digests]
+            if unhashed:
+                raise UnhashedFiles(unhashed)
+
+            self._digests = digests
+
+        try:
+            # Add the source files to the database. We always run this because
+            # it adds our call files to the database for us.
+            call_file_digests = self.check_call_files(call_id, srcs)
+
+            # Check extra external call files.
+            if call_id is None:
+                external_srcs = frozenset()
+                external_dsts = frozenset()
+                external_digests = ()
+            else:
+                external_srcs, external_dsts, external_digests = \
+                    self.check_external_files(call_id)
+        finally:
+            self._digests = {}
 
         return (
             fun_dirty,
@@ -114,6 +171,15 @@ class Backend:
 
         self.save_external_files(call_id, external_srcs, external_dsts)
 
+    def call_key(self, bound):
+        """Returns a digest of the bound arguments, which is the same across
+        runs and for any arguments that compare equal. Different arguments
+        may still share a key, so it only narrows down which calls need to be
+        compared with the arguments."""
+
+        key = _canonicalize(self._ctx, bound, set())
+        return hashlib.md5(repr(key).encode()).hexdigest()
+
     # --------------------------------------------------------------------------
 
     def check_function(self, fun_name, already_checked=None):
@@ -272,11 +338,87 @@ class Backend:
 
     def add_file(self, file_name):
         """Insert or update the file information. Returns True if the content
-        of the file is different from what was in the table."""
+        of the file is different from what was in the table. The file is only
+        checked the first time we see it during a build, unless we were told
+        that it was written to with L{invalidate_files}."""
 
         # Make sure we got the right types.
         assert isinstance(file_name, str), file_name
 
+        try:
+            file_id, file_mtime, digest = self._file_cache[file_name]
+        except KeyError:
+            pass
+        else:
+            # We've already saved any changes to the file.
+            return False, file_id, file_mtime, digest
+
+        result = self._add_file(file_name)
+        dirty, file_id, file_mtime, digest = result
+        self._cache_file(file_name, file_id, file_mtime, digest)
+
+        return result
+
+
+    def find_changed_files(self, file_names):
+        """Returns the files that L{add_file} would need to hash."""
+
+        changed = []
+        for file_name in file_names:
+            if file_name in self._file_cache:
+                continue
+
+            file_id, old_mtime, old_digest = self.find_file(file_name)
+            try:
+                file_mtime = Path(file_name).getmtime()
+            except OSError:
+                # Let add_file report the missing file.
+                continue
+
+            if self._is_file_unchanged(file_mtime, old_mtime, old_digest):
+                # Save add_file from having to stat the file again.
+                self._cache_file(file_name, file_id, file_mtime, old_digest)
+            else:
+                changed.append(file_name)
+
+        return changed
+
+
+    def _is_file_unchanged(self, file_mtime, old_mtime, old_digest):
+        """Returns if we can assume the file has not been modified without
+        hashing it."""
+
+        if old_mtime is None or file_mtime != old_mtime:
+            return False
+
+        # If the file was modified less than 1.0 seconds ago, recompute the
+        # hash since it still could have changed even with the same mtime.
+        if time.time() - file_mtime <= 1.0:
+            return False
+
+        # The old digest has to be rehashed if it came from another algorithm.
+        return _digest_algorithm(old_digest) == self.digest_algorithm
+
+
+    def _cache_file(self, file_name, file_id, file_mtime, digest):
+        self._file_cache[file_name] = (file_id, file_mtime, digest)
+
+        if self.watcher is not None:
+            self.watcher.add(file_name)
+
+
+    def invalidate_files(self, file_names=None):
+        """Forget what we know about the files, because they were written to.
+        If I{file_names} is None, forget about every file."""
+
+        if file_names is None:
+            self._file_cache.clear()
+        else:
+            for file_name in file_names:
+                self._file_cache.pop(file_name, None)
+
+
+    def _add_file(self, file_name):
         # Look up the old data.
         file_id, old_mtime, old_digest = self.find_file(file_name)
 
@@ -284,15 +426,14 @@ class Backend:
         file_path = Path(file_name)
         file_mtime = file_path.getmtime()
 
-        if old_mtime is not None:
-            # If the file was modified less than 1.0 seconds ago, recompute the
-            # hash since it still could have changed even with the same mtime.
-            # If True, then assume the file has not been modified.
-            if file_mtime == old_mtime and time.time() - file_mtime > 1.0:
-                return False, file_id, file_mtime, old_digest
+        if self._is_file_unchanged(file_mtime, old_mtime, old_digest):
+            return False, file_id, file_mtime, old_digest
 
         # The mtime changed, so let's see if the content's changed.
-        digest = file_path.digest()
+        try:
+            digest = self._digests[file_name]
+        except KeyError:
+            digest = file_path.digest(algorithm=self.digest_algorithm)
 
         if digest == old_digest:
             # Save the new mtime.
@@ -329,6 +470,76 @@ class Backend:
         """Remove the file from the database."""
         raise NotImplementedError
 
+    # --------------------------------------------------------------------------
+
+    def load_task_stats(self):
+        """Returns a dictionary of the statistics recorded for each scheduler
+        task."""
+        raise NotImplementedError
+
+
+    def save_task_stats(self, task_stats):
+        """Insert or update the statistics of the scheduler tasks."""
+        raise NotImplementedError
+
+# ------------------------------------------------------------------------------
+
+def _digest_algorithm(digest):
+    """Returns the algorithm that made the digest from L{Path.digest}."""
+
+    algorithm, sep, _ = digest.rpartition(':')
+    return algorithm if sep else 'md5'
+
+def _canonicalize(ctx, obj, seen):
+    """Convert the object into nested tuples of strings and numbers, which
+    have a stable repr. Objects that compare equal have to be converted into
+    the same value, so anything we don't know how to compare just becomes
+    the name of its type."""
+
+    if obj is ctx:
+        return ('ctx',)
+    elif obj is None:
+        return ('none',)
+    elif isinstance(obj, (bool, int)):
+        return ('n', int(obj))
+    elif isinstance(obj, float):
+        # Integral floats compare equal to ints.
+        if obj.is_integer():
+            return ('n', int(obj))
+        return ('f', repr(obj))
+    elif isinstance(obj, str):
+        # This also covers paths, which compare equal to plain strings.
+        return ('s', str(obj))
+    elif isinstance(obj, (bytes, bytearray)):
+        return ('b', bytes(obj))
+
+    # Guard against objects that contain themselves.
+    if id(obj) in seen:
+        return ('cycle',)
+    seen.add(id(obj))
+    try:
+        if isinstance(obj, dict):
+            return ('d', tuple(sorted(
+                ((_canonicalize(ctx, k, seen), _canonicalize(ctx, v, seen))
+                    for k, v in obj.items()),
+                key=repr)))
+        elif isinstance(obj, (set, frozenset)):
+            return ('S', tuple(sorted(
+                (_canonicalize(ctx, item, seen) for item in obj),
+                key=repr)))
+        elif isinstance(obj, list):
+            return ('l', tuple(_canonicalize(ctx, item, seen) for item in obj))
+        elif isinstance(obj, tuple):
+            return ('t', tuple(_canonicalize(ctx, item, seen) for item in obj))
+        elif isinstance(obj, fbuild.db.PersistentObject):
+            # Persistent objects compare their members.
+            return ('o', type(obj).__qualname__,
+                _canonicalize(ctx, obj.__dict__, seen))
+        else:
+            return ('?', type(obj).__qualname__)
+    finally:
+        seen.discard(id(obj))
+
 # ------------------------------------------------------------------------------
 
 class Pickler(pickle.Pickler):
@@ -4,6 +4,7 @@ import fbuild.db.backend
 
 class CacheBackend(fbuild.db.backend.Backend):
     _LATEST_VERSION = '1'
+    pickles_calls = False
 
     def _connect(self, filename=None):
         """Create the database cache (backend implementation)."""
@@ -13,20 +14,24 @@ class CacheBackend(fbuild.db.backend.Backend):
         self._version = self._LATEST_VERSION
         self._functions = {}
         self._function_calls = {}
+        self._call_keys = {}
         self._files = {}
         self._call_files = {}
         self._external_srcs = {}
         self._external_dsts = {}
+        self._task_stats = {}
 
     def close(self):
         """Clear the database cache."""
 
         del self._functions
         del self._function_calls
+        del self._call_keys
         del self._files
         del self._call_files
         del self._external_srcs
         del self._external_dsts
+        del self._task_stats
 
     # --------------------------------------------------------------------------
 
@@ -90,6 +95,8 @@ class CacheBackend(fbuild.db.backend.Backend):
         else:
             function_existed |= True
 
+        self._call_keys.pop(fun_name, None)
+
         try:
             del self._external_srcs[fun_name]
         except KeyError:
@@ -146,9 +153,11 @@ class CacheBackend(fbuild.db.backend.Backend):
         except KeyError:
             return True, None, None
 
-        # We've called this before, so search the data to see if we've called
-        # it with the same arguments.
-        for call_index, (old_bound, old_result) in enumerate(datas):
+        # We've called this before, so search the calls with the same key to
+        # see if we've called it with the same arguments.
+        call_keys = self._find_call_keys(fun_id)
+        for call_index in call_keys.get(self.call_key(bound), ()):
+            old_bound, old_result = datas[call_index]
             if bound == old_bound:
                 # We've found a matching call so just return the index.
                 return False, (fun_id, call_index), old_result
@@ -157,6 +166,24 @@ class CacheBackend(fbuild.db.backend.Backend):
         return True, None, None
 
 
+    def _find_call_keys(self, fun_id):
+        """Returns the map from call keys to the call indices of the
+        function. The map isn't saved, so it is rebuilt the first time we look
+        at the function."""
+
+        try:
+            return self._call_keys[fun_id]
+        except KeyError:
+            pass
+
+        call_keys = self._call_keys[fun_id] = {}
+        for call_index, (bound, result) in \
+                enumerate(self._function_calls.get(fun_id, ())):
+            call_keys.setdefault(self.call_key(bound), []).append(call_index)
+
+        return call_keys
+
+
     def save_call(self, call_id, fun_id, bound, result):
         """Insert or update the function call."""
 
@@ -182,15 +209,26 @@ class CacheBackend(fbuild.db.backend.Backend):
             # The function be new or may have been deleted. So ignore the
             # call_id and just create a new list.
             self._function_calls[fun_id] = [(bound, result)]
+            self._call_keys[fun_id] = {self.call_key(bound): [0]}
 
             call_index = 0
         else:
+            call_keys = self._find_call_keys(fun_id)
+
             if call_index is None:
                 datas.append((bound, result))
                 call_index = len(datas) - 1
             else:
+                old_bound, old_result = datas[call_index]
+                try:
+                    call_keys[self.call_key(old_bound)].remove(call_index)
+                except (KeyError, ValueError):
+                    pass
+
                 datas[call_index] = (bound, result)
 
+            call_keys.setdefault(self.call_key(bound), []).append(call_index)
+
         return (fun_id, call_index)
 
     # --------------------------------------------------------------------------
@@ -291,8 +329,7 @@ class CacheBackend(fbuild.db.backend.Backend):
         srcs = frozenset(srcs)
         dsts = frozenset(dsts)
 
-        self._external_srcs.setdefault(fun_name, {})[call_index] = srcs
-        self._external_dsts.setdefault(fun_name, {})[call_index] = dsts
+        self._save_external_file_names(fun_name, call_index, srcs, dsts)
 
         external_digests = []
         for src in srcs:
@@ -301,6 +338,11 @@ class CacheBackend(fbuild.db.backend.Backend):
 
         self.save_call_files(call_id, external_digests)
 
+
+    def _save_external_file_names(self, fun_name, call_index, srcs, dsts):
+        self._external_srcs.setdefault(fun_name, {})[call_index] = srcs
+        self._external_dsts.setdefault(fun_name, {})[call_index] = dsts
+
     # --------------------------------------------------------------------------
 
     def find_file(self, file_name):
@@ -360,3 +402,21 @@ class CacheBackend(fbuild.db.backend.Backend):
             file_existed |= True
 
         return file_existed
+
+    # --------------------------------------------------------------------------
+
+    def load_task_stats(self):
+        """Returns a dictionary of the statistics recorded for each scheduler
+        task."""
+
+        return {key: dict(stats) for key, stats in self._task_stats.items()}
+
+
+    def save_task_stats(self, task_stats):
+        """Insert or update the statistics of the scheduler tasks."""
+
+        # Make sure we got the right types.
+        assert isinstance(task_stats, dict), task_stats
+
+        for key, stats in task_stats.items():
+            self._task_stats.setdefault(key, {}).update(stats)
@@ -2,14 +2,18 @@ import hashlib
 import itertools
 import pprint
 import threading
+import types
 
 import fbuild
 import fbuild.functools
 import fbuild.inspect
 import fbuild.path
 import fbuild.rpc
+import fbuild.watch
 
 import fbuild.db
+import fbuild.db.artifact_cache
+import fbuild.db.backend
 import fbuild.db.pickle_backend
 import fbuild.db.cache_backend
 import fbuild.db.sqlite_backend
@@ -21,26 +25,61 @@ class Database:
 
     _FUN_DIGESTS = {}
 
-    def __init__(self, ctx, *, engine, explain=False):
+    # The functions whose digests we haven't needed yet.
+    _FUNCTIONS = {}
+
+    def __init__(self, ctx, *, engine, explain=False, inline=False,
+            digest_algorithm='md5', watch=False, shared=False,
+            artifact_cache=None):
         def handle_rpc(method, *args, **kwargs):
-            return method(*args, **kwargs)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                # Each call writes its changes as a batch.
+                self._backend.flush()
 
         self._ctx = ctx
         self._callstack = []
         self._explain = explain
         self._connected = False
 
+        if shared and engine != 'sqlite':
+            raise fbuild.Error('only the sqlite engine can be shared')
+
         if engine == 'pickle':
-            self._backend = fbuild.db.pickle_backend.PickleBackend(self._ctx)
+            self._backend = fbuild.db.pickle_backend.PickleBackend(self._ctx,
+                digest_algorithm=digest_algorithm)
         elif engine == 'cache':
-            self._backend = fbuild.db.cache_backend.CacheBackend(self._ctx)
+            self._backend = fbuild.db.cache_backend.CacheBackend(self._ctx,
+                digest_algorithm=digest_algorithm)
         elif engine == 'sqlite':
-            self._backend = fbuild.db.sqlite_backend.SqliteBackend(self._ctx)
+            self._backend = fbuild.db.sqlite_backend.SqliteBackend(self._ctx,
+                digest_algorithm=digest_algorithm,
+                shared=shared)
         else:
             raise fbuild.Error('unknown backend: %s' % engine)
 
-        self._rpc = fbuild.rpc.RPC(handle_rpc)
+        # The backends aren't thread safe, so every call goes through the rpc
+        # object, which either hands it to a dedicated thread or runs it while
+        # holding a lock.
+        if inline:
+            self._rpc = fbuild.rpc.InlineRPC(handle_rpc)
+        else:
+            self._rpc = fbuild.rpc.RPC(handle_rpc)
         self._rpc.daemon = True
+        # Watch the files we've looked at so that we can rebuild when they
+        # change, without having to stat them.
+        if watch:
+            self._backend.watcher = fbuild.watch.Watcher()
+
+        # The files written by the calls we ran, so that we can ignore our own
+        # changes when watching files.
+        self._written_files = set()
+
+        # The L{ArtifactCache} that calls are shared through with other
+        # builds, if any.
+        self.artifact_cache = artifact_cache
+
         self.active_files = set()
         self.start()
 
@@ -50,6 +89,8 @@ class Database:
 
     def shutdown(self, *args, **kwargs):
         """Inform and wait for the L{DatabaseThread} to shut down."""
+        if self.artifact_cache is not None:
+            self.artifact_cache.close()
         self._rpc.join(*args, **kwargs)
 
     def connect(self, *args, **kwargs):
@@ -64,8 +105,17 @@ class Database:
         """Close the connection to the backend."""
         result = self._rpc.call(self._backend.close, *args, **kwargs)
         self._connected = False
+
+        # Don't let a call we didn't wait for fail without anyone noticing.
+        self._rpc.raise_cast_error()
+
         return result
 
+    def commit(self):
+        """Save every change so far without closing the database."""
+        self._rpc.call(self._backend.commit)
+        self._rpc.raise_cast_error()
+
     def call(self, function, *args, **kwargs):
         """Call the function and return the result, src dependencies, and dst
         dependencies. If the function has been previously called with the same
@@ -75,6 +125,17 @@ class Database:
         "srcs" are also modified.  Finally, if any of the filenames in "dsts"
         do not exist, re-run the function no matter what."""
 
+        return self._call(function, args, kwargs)
+
+    def call_shared(self, fetch, store, function, *args, **kwargs):
+        """Like L{call}, but look the result up with I{fetch()} before making
+        the call, such as in a cache that's shared with other builds. It
+        raises I{KeyError} if it doesn't have the result. The results of the
+        calls we make are handed to I{store(result)}."""
+
+        return self._call(function, args, kwargs, fetch=fetch, store=store)
+
+    def _call(self, function, args, kwargs, *, fetch=None, store=None):
         # Make sure none of the arguments are a generator.
         assert all(not fbuild.inspect.isgenerator(arg)
             for arg in itertools.chain(args, kwargs.values())), \
@@ -108,14 +169,30 @@ class Database:
             args,
             kwargs)
 
-        fun_dirty, fun_id, call_dirty, call_id, old_result, call_file_digests, \
-            external_srcs, external_dsts, external_digests = \
-                self._rpc.call(self._backend.prepare,
+        # Hash any changed files in this thread rather than the database's, so
+        # that we can hash the files of many calls at once.
+        digests = {}
+        while True:
+            try:
+                prepared = self._rpc.call(self._backend.prepare,
                     fun_name,
                     fun_digest,
                     call_bound,
                     srcs,
-                    dsts)
+                    dsts,
+                    digests)
+            except fbuild.db.backend.UnhashedFiles as e:
+                # Let the other workers run while we read the files.
+                with self._ctx.scheduler.interruptible():
+                    for file_name in e.file_names:
+                        digests[file_name] = fbuild.path.Path(
+                            file_name).digest(
+                                algorithm=self._backend.digest_algorithm)
+            else:
+                break
+
+        fun_dirty, fun_id, call_dirty, call_id, old_result, call_file_digests, \
+            external_srcs, external_dsts, external_digests = prepared
 
         dirty_dsts = set()
 
@@ -148,6 +225,32 @@ class Database:
                 self.active_files.update(all_srcs | all_dsts)
                 return old_result, all_srcs, all_dsts
 
+        # Another build may have already made this call.
+        artifact_key = None
+        if self.artifact_cache is not None:
+            artifact_key = self.artifact_cache.key(fun_name, fun_digest,
+                self._backend.call_key(call_bound), self._file_digests(srcs))
+
+            artifact = self.artifact_cache.fetch(artifact_key, call_bound,
+                self._is_artifact_valid)
+            if artifact is not None:
+                return self._save_call(fun_dirty, fun_id, fun_name, fun_digest,
+                    tuple(artifact.fun_dependents), call_id, call_bound,
+                    artifact.result, return_type, srcs, dsts,
+                    call_file_digests,
+                    set(artifact.external_srcs),
+                    set(artifact.external_dsts))
+
+        if fetch is not None:
+            try:
+                result = fetch()
+            except KeyError:
+                pass
+            else:
+                return self._save_call(fun_dirty, fun_id, fun_name, fun_digest,
+                    (), call_id, call_bound, result, return_type, srcs, dsts,
+                    call_file_digests, set(), set())
+
         if self._explain:
             # Explain why we are going to run the function.
             if fun_dirty:
@@ -188,12 +291,33 @@ class Database:
         assert not fbuild.inspect.isgenerator(call_result), \
             "Cannot store generator in database"
 
-        # Save the results in the database.
-        self._rpc.call(self._backend.cache,
+        call_result, all_srcs, all_dsts = self._save_call(
             fun_dirty, fun_id, fun_name, fun_digest, fun_dependents,
-            call_id, call_bound, call_result,
+            call_id, call_bound, call_result, return_type, srcs, dsts,
             call_file_digests, external_srcs, external_dsts)
 
+        if store is not None:
+            store(call_result)
+
+        if artifact_key is not None:
+            self.artifact_cache.store(artifact_key,
+                fbuild.db.artifact_cache.Artifact(
+                    bound=call_bound,
+                    result=call_result,
+                    dsts=sorted(all_dsts),
+                    external_srcs=self._file_digests(external_srcs),
+                    external_dsts=sorted(external_dsts),
+                    fun_dependents={name: self._find_function_digest(name)
+                        for name in fun_dependents}))
+
+        return call_result, all_srcs, all_dsts
+
+    def _save_call(self, fun_dirty, fun_id, fun_name, fun_digest,
+            fun_dependents, call_id, call_bound, call_result, return_type,
+            srcs, dsts, call_file_digests, external_srcs, external_dsts):
+        """Save the result of a call we made or restored, and return the
+        result, src dependencies, and dst dependencies."""
+
         if return_type is not None and issubclass(return_type, fbuild.db.DST):
             return_dsts = return_type.convert(call_result)
         else:
@@ -202,10 +326,62 @@ class Database:
         all_srcs = srcs.union(external_srcs)
         all_dsts = dsts.union(external_dsts)
         all_dsts.update(return_dsts)
+
+        # The function may have rewritten files we've already looked at.
+        self._rpc.cast(self._backend.invalidate_files, all_dsts)
+        self._written_files.update(all_dsts)
+
+        # Save the results in the database. Nothing is waiting on this, so we
+        # don't need to wait for the rpc thread to get to it. The caller may
+        # change the arguments and the result once we return, so if the
+        # backend pickles them, we pickle them now rather than when the rpc
+        # thread gets to them. The in-memory backend keeps them as they are.
+        if self._backend.pickles_calls:
+            self._rpc.cast(self._cache_pickled,
+                fun_dirty, fun_id, fun_name, fun_digest, fun_dependents,
+                call_id, fbuild.db.backend.pickle_dumps(self._ctx,
+                    (call_bound, call_result)),
+                call_file_digests, external_srcs, external_dsts)
+        else:
+            self._rpc.cast(self._backend.cache,
+                fun_dirty, fun_id, fun_name, fun_digest, fun_dependents,
+                call_id, call_bound, call_result,
+                call_file_digests, external_srcs, external_dsts)
         # Update the active file list.
         self.active_files.update(all_srcs | all_dsts)
         return call_result, all_srcs, all_dsts
 
+    def _cache_pickled(self, fun_dirty, fun_id, fun_name, fun_digest,
+            fun_dependents, call_id, pickled, *args):
+        """Save a call whose arguments and result were pickled by
+        L{_save_call}. This runs in the rpc thread."""
+
+        call_bound, call_result = fbuild.db.backend.pickle_loads(self._ctx,
+            pickled)
+
+        self._backend.cache(fun_dirty, fun_id, fun_name, fun_digest,
+            fun_dependents, call_id, call_bound, call_result, *args)
+
+    def _file_digests(self, file_names):
+        """Returns the digests of the files, keyed by their names."""
+
+        return {file_name: self._rpc.call(self._backend.add_file, file_name)[3]
+            for file_name in file_names}
+
+    def _is_artifact_valid(self, artifact):
+        """Returns whether the files and functions that an artifact's call
+        found out it depended on are the same as when it was stored."""
+
+        if any(self._find_function_digest(name) != digest
+                for name, digest in artifact.fun_dependents.items()):
+            return False
+
+        try:
+            return self._file_digests(artifact.external_srcs) == \
+                artifact.external_srcs
+        except OSError:
+            return False
+
     def delete_function(self, fun_name):
         """Delete the function from the database."""
 
@@ -216,21 +392,110 @@ class Database:
 
         return self._rpc.call(self._backend.delete_file, file_name)
 
+    def wait_for_changes(self):
+        """Block until some of the files that we've looked at are changed by
+        somebody other than us, and return them. Returns None if we lost track
+        of which files changed."""
+
+        watcher = self._backend.watcher
+        assert watcher is not None, 'not watching files'
+
+        while True:
+            changes = watcher.read_changes()
+
+            # Editors often save files in several steps, so wait until the
+            # changes settle down.
+            while changes is not None:
+                more_changes = watcher.read_changes(timeout=0.1)
+                if more_changes is None:
+                    changes = None
+                elif more_changes:
+                    changes.update(more_changes)
+                else:
+                    break
+
+            self._rpc.call(self._backend.invalidate_files, changes)
+
+            if changes is None:
+                return None
+
+            # Files we couldn't watch have to be checked every time.
+            self._rpc.call(self._backend.invalidate_files, watcher.unwatched)
+
+            # Skip the changes we made ourselves during the last build.
+            changes -= self._written_files
+            self._written_files = set()
+
+            if changes:
+                return changes
+
+    def forget_files(self):
+        """Forget what we know about the files before building again in the
+        same process. If we're watching the files, only the ones that changed
+        are forgotten."""
+
+        watcher = self._backend.watcher
+        if watcher is None:
+            self._rpc.call(self._backend.invalidate_files, None)
+            return
+
+        changes = set()
+        while True:
+            more_changes = watcher.read_changes(timeout=0)
+            if more_changes is None:
+                changes = None
+                break
+            elif not more_changes:
+                break
+            changes.update(more_changes)
+
+        self._rpc.call(self._backend.invalidate_files, changes)
+        self._rpc.call(self._backend.invalidate_files, watcher.unwatched)
+        self._written_files = set()
+
+    def load_task_stats(self):
+        """Load the statistics recorded for the scheduler's tasks."""
+
+        return self._rpc.call(self._backend.load_task_stats)
+
+    def save_task_stats(self, task_stats):
+        """Save the statistics recorded for the scheduler's tasks."""
+
+        return self._rpc.call(self._backend.save_task_stats, task_stats)
+
     def dump_database(self):
         """Print the database."""
         pprint.pprint(self._backend.__dict__)
 
     @classmethod
     def add_function_to_map(self, function):
-        """Add the function to the global function map."""
+        """Add the function to the global function map. Most functions are
+        added as their modules are imported, so we don't digest them until
+        they're called."""
         fun_name, function, _, _ = self._find_function_name(function, (), {})
         if fun_name not in self._FUN_DIGESTS:
-            self._FUN_DIGESTS[fun_name] = self._digest_function(function)
+            self._FUNCTIONS.setdefault(fun_name, function)
 
     @classmethod
     def get_function_digest_from_map(self, fun_name):
         """Get the function digest from the global function map."""
-        return self._FUN_DIGESTS[fun_name]
+        try:
+            return self._FUN_DIGESTS[fun_name]
+        except KeyError:
+            pass
+
+        digest = self._FUN_DIGESTS[fun_name] = \
+            self._digest_function(self._FUNCTIONS[fun_name])
+        return digest
+
+    @classmethod
+    def _find_function_digest(self, fun_name):
+        """Returns the function digest, or None if we don't know the
+        function."""
+        try:
+            return self.get_function_digest_from_map(fun_name)
+        except KeyError:
+            return None
 
     @staticmethod
     def _find_function_name(wrapped_function, args, kwargs):
@@ -278,11 +543,23 @@ class Database:
     def _digest_function(function):
         """Compute the digest for a function or a function object."""
         if fbuild.inspect.isroutine(function):
-            # The function is a function, method, or lambda, so digest
-            # the source. If the function is a builtin, we will raise
+            # The function is a function, method, or lambda, so digest its
+            # code, defaults and annotations, which is much faster than
+            # finding its source. If the function is a builtin, we will raise
             # an exception.
-            src = fbuild.inspect.getsource(function)
-            digest = hashlib.md5(src.encode()).hexdigest()
+            function = getattr(function, '__func__', function)
+
+            h = hashlib.md5()
+            _digest_code(h, function.__code__)
+            h.update(_const_repr(function.__defaults__).encode())
+            h.update(_const_repr(function.__kwdefaults__).encode())
+            h.update(_const_repr(function.__annotations__).encode())
+
+            # Digest the functions it said it calls too.
+            for helper in getattr(function, '__fbuild_depends_on__', ()):
+                h.update(Database._digest_function(helper).encode())
+
+            digest = h.hexdigest()
         else:
             # The function is a functor so let it digest itself.
             digest = str(hash(function))
@@ -324,8 +601,58 @@ class Database:
         frame = frame.f_back
 
         while frame:
-            if frame.f_code == self.call.__code__:
+            if frame.f_code == self._call.__code__:
                 frame.f_locals['external_srcs'].update(srcs)
                 frame.f_locals['external_dsts'].update(dsts)
 
             frame = frame.f_back
+
+# ------------------------------------------------------------------------------
+
+def _digest_code(h, code):
+    """Update the hash with the code object and the code nested in it. Line
+    numbers and file names are left out, so moving a function doesn't change
+    its digest."""
+
+    h.update(code.co_code)
+    h.update(repr((
+        code.co_argcount,
+        code.co_kwonlyargcount,
+        code.co_flags,
+        code.co_names,
+        code.co_varnames,
+        code.co_freevars,
+        code.co_cellvars)).encode())
+
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _digest_code(h, const)
+        else:
+            h.update(_const_repr(const).encode())
+
+def _const_repr(obj):
+    """Returns a repr of the constant, default or annotation that's the same
+    in every run. Classes and functions are represented by their names, and
+    other objects by their repr if they have their own. Otherwise they're
+    only represented by their type, since the default repr includes their
+    address."""
+
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        return repr(obj)
+    elif isinstance(obj, tuple):
+        return '(%s)' % ','.join(_const_repr(o) for o in obj)
+    elif isinstance(obj, list):
+        return '[%s]' % ','.join(_const_repr(o) for o in obj)
+    elif isinstance(obj, (set, frozenset)):
+        # The order of a set changes with the hash seed.
+        return '{%s}' % ','.join(sorted(_const_repr(o) for o in obj))
+    elif isinstance(obj, dict):
+        return '{%s}' % ','.join(sorted(
+            _const_repr(k) + ':' + _const_repr(v) for k, v in obj.items()))
+    elif isinstance(obj, type) or fbuild.inspect.isroutine(obj):
+        return '<%s.%s>' % (getattr(obj, '__module__', None),
+            getattr(obj, '__qualname__', None))
+    elif type(obj).__repr__ is not object.__repr__:
+        return repr(obj)
+    else:
+        return '<%s.%s>' % (type(obj).__module__, type(obj).__qualname__)
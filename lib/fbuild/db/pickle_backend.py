@@ -1,73 +1,356 @@
-import io
-import pickle
+import collections.abc
+import os
+import uuid
 
+import fbuild.db.backend
 import fbuild.db.cache_backend
 import fbuild.path
 
 # ------------------------------------------------------------------------------
 
+class _LazyDict(collections.abc.MutableMapping):
+    """
+    A dictionary whose values are each pickled on their own, and only
+    unpickled when they're first looked up. This lets us load the calls of
+    just the functions a build runs.
+    """
+
+    def __init__(self, ctx, pickles=None, values=None):
+        self._ctx = ctx
+        self._pickles = pickles or {}
+        self._values = values or {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        value = self._values[key] = fbuild.db.backend.pickle_loads(self._ctx,
+            self._pickles.pop(key))
+
+        return value
+
+    def __setitem__(self, key, value):
+        self._pickles.pop(key, None)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        try:
+            del self._values[key]
+        except KeyError:
+            del self._pickles[key]
+
+    def __contains__(self, key):
+        return key in self._values or key in self._pickles
+
+    def __iter__(self):
+        yield from self._values
+        yield from self._pickles
+
+    def __len__(self):
+        return len(self._values) + len(self._pickles)
+
+    def pickles(self):
+        """Returns the pickled values. The values we never looked at don't
+        need to be pickled again."""
+
+        pickles = dict(self._pickles)
+        for key, value in self._values.items():
+            pickles[key] = fbuild.db.backend.pickle_dumps(self._ctx, value)
+
+        return pickles
+
+# ------------------------------------------------------------------------------
+
 class PickleBackend(fbuild.db.cache_backend.CacheBackend):
-    _LATEST_VERSION = '2'
+    """
+    A backend that pickles the database into a file. Rather than pickling the
+    whole database every time it's closed, every change to it is appended to
+    a journal file, which is replayed on top of the database when it's
+    loaded. The whole database is only written again once the journal grows
+    too big.
+
+    The calls of each function are pickled separately, and are only
+    unpickled once the function is called.
+    """
+
+    _LATEST_VERSION = '5'
+    pickles_calls = True
 
     def _connect(self, filename):
         """Load the database from the file."""
 
         self._file_name = fbuild.path.Path(filename)
+        self._journal_name = self._file_name + '.journal'
+        self._journal = None
+        self._generation = None
 
-        if self._file_name.exists():
-            with open(self._file_name, 'rb') as f:
-                unpickler = fbuild.db.backend.Unpickler(self._ctx, f)
-                try:
-                    data = unpickler.load()
-                except AttributeError:
-                    # Likely a moved member. Just start clean!
-                    super()._connect()
-                    return
-
-                if len(data) == 6:
-                    # This was created before DB versioning was introduced. Use
-                    # a fake version.
-                    data = (self._NULL_VERSION,) + data
-
-                self._version, self._functions, self._function_calls, \
-                    self._files, self._call_files, self._external_srcs, \
-                    self._external_dsts = data
-        else:
+        # Don't write anything if we aren't going to save the database.
+        self._save = not self._ctx.options.do_not_save_database
+
+        if not self._load():
             super()._connect()
+            self._function_calls = _LazyDict(self._ctx)
+            self._external_srcs = _LazyDict(self._ctx)
+            self._external_dsts = _LazyDict(self._ctx)
+
+        # Let the caller start over if the database is from an older version.
+        if self._version != self._LATEST_VERSION:
+            return
+
+        if self._generation is None:
+            # We don't have a journal yet, so write out the database to give
+            # us something to journal against.
+            self._compact()
+        else:
+            size = self._replay_journal()
+            if size is None:
+                # The journal is missing, or we crashed before replacing it
+                # with the one for this database. Anything we appended to it
+                # would be ignored next time, so start a new one.
+                self._compact()
+            else:
+                self._open_journal(size)
+
+
+    def _load(self):
+        """Load the database. Returns False if there isn't one."""
+
+        if not self._file_name.exists():
+            return False
+
+        with open(self._file_name, 'rb') as f:
+            unpickler = fbuild.db.backend.Unpickler(self._ctx, f)
+            try:
+                data = unpickler.load()
+            except AttributeError:
+                # Likely a moved member. Just start clean!
+                return False
+
+        if len(data) == 6:
+            # This was created before DB versioning was introduced. Use
+            # a fake version.
+            data = (self._NULL_VERSION,) + data
+
+        if len(data) == 7:
+            # This was created before task statistics were recorded.
+            # The rest of the format is unchanged, so just upgrade it.
+            if data[0] == '2':
+                data = ('3',) + data[1:]
+            data += ({},)
+
+        if len(data) == 8:
+            # This was created before we had a journal, which we'll create
+            # when we don't have a generation.
+            if data[0] == '3':
+                data = ('4',) + data[1:]
+            data += (None,)
+
+        self._version, self._functions, function_calls, \
+            self._files, self._call_files, external_srcs, \
+            external_dsts, self._task_stats, self._generation = data
+
+        if self._version == '4':
+            # This was created before the calls were pickled separately. We
+            # already unpickled them, so just write them out again.
+            self._version = self._LATEST_VERSION
+            self._generation = None
+            self._function_calls = _LazyDict(self._ctx, values=function_calls)
+            self._external_srcs = _LazyDict(self._ctx, values=external_srcs)
+            self._external_dsts = _LazyDict(self._ctx, values=external_dsts)
+        else:
+            self._function_calls = _LazyDict(self._ctx, function_calls)
+            self._external_srcs = _LazyDict(self._ctx, external_srcs)
+            self._external_dsts = _LazyDict(self._ctx, external_dsts)
+
+        # The call keys are rebuilt as they're needed.
+        self._call_keys = {}
+
+        return True
 
 
     def close(self):
         """Save the database to the file."""
 
-        f = io.BytesIO()
-        pickler = fbuild.db.backend.Pickler(self._ctx, f)
-
-        pickler.dump((
-            self._LATEST_VERSION,
-            self._functions,
-            self._function_calls,
-            self._files,
-            self._call_files,
-            self._external_srcs,
-            self._external_dsts))
-
-        s = f.getvalue()
-
-        # Try to save the state as atomically as possible. Unfortunately, if
-        # someone presses ctrl+c while we're saving, we might corrupt the db.
-        # So, we'll write to a temp file, then move the old state file out of
-        # the way, then rename the temp file to the filename.
-        path = fbuild.path.Path(self._file_name)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+            if self._is_journal_big():
+                self._compact()
+                self._journal.close()
+                self._journal = None
+
+        super().close()
+
+
+    def flush(self):
+        """Write the changes we've journaled so far to the file."""
+
+        if self._journal is not None:
+            self._journal.flush()
+
+
+    def commit(self):
+        """Save the changes so far, like L{close} does."""
+
+        if self._journal is not None:
+            self._journal.flush()
+
+            if self._is_journal_big():
+                self._compact()
+
+    # --------------------------------------------------------------------------
+
+    def _compact(self):
+        """Write out the whole database and start a new journal."""
+
+        if not self._save:
+            return
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+        # The journal belongs to the database with the same generation. If we
+        # crash before we replace the journal, the old one is ignored.
+        self._generation = uuid.uuid4().hex
+
+        self._replace_file(self._file_name, fbuild.db.backend.pickle_dumps(
+            self._ctx, (
+                self._LATEST_VERSION,
+                self._functions,
+                self._function_calls.pickles(),
+                self._files,
+                self._call_files,
+                self._external_srcs.pickles(),
+                self._external_dsts.pickles(),
+                self._task_stats,
+                self._generation)))
+
+        self._replace_file(self._journal_name, fbuild.db.backend.pickle_dumps(
+            self._ctx,
+            ('generation', self._generation)))
+
+        self._open_journal()
+
+
+    def _is_journal_big(self):
+        """Returns whether the journal takes long enough to replay that we
+        should write out the whole database."""
+
+        return self._journal_name.getsize() > self._file_name.getsize() // 2
+
+
+    def _replace_file(self, path, data):
+        """Write the data to a temporary file, then move it over the path so
+        that we either have the old or the new file if we're interrupted."""
+
         tmp = path + '.tmp'
-        old = path + '.old'
 
         with open(tmp, 'wb') as f:
-            f.write(s)
+            f.write(data)
+
+        os.replace(tmp, path)
+
+
+    def _open_journal(self, size=None):
+        """Open the journal to add changes to it. If I{size} is given, cut the
+        journal down to it first."""
+
+        if not self._save:
+            return
+
+        if size is None:
+            self._journal = open(self._journal_name, 'ab')
+        else:
+            self._journal = open(self._journal_name, 'r+b')
+            self._journal.truncate(size)
+            self._journal.seek(size)
+
+
+    def _replay_journal(self):
+        """Apply the changes in the journal to the database. Returns the size
+        of the complete records we applied, or None if there isn't a journal
+        for our database."""
+
+        try:
+            f = open(self._journal_name, 'rb')
+        except FileNotFoundError:
+            return None
+
+        with f:
+            try:
+                header = fbuild.db.backend.Unpickler(self._ctx, f).load()
+            except Exception:
+                header = None
+
+            if header != ('generation', self._generation):
+                return None
+
+            size = f.tell()
+            while True:
+                # Each record is pickled on its own. If we crashed while
+                # writing the last one, we just drop it.
+                try:
+                    name, args = \
+                        fbuild.db.backend.Unpickler(self._ctx, f).load()
+                except Exception:
+                    break
+
+                getattr(super(), name)(*args)
+                size = f.tell()
+
+        return size
+
+
+    def _log(self, name, *args):
+        """Append a change to the journal."""
+
+        if self._journal is not None:
+            self._journal.write(fbuild.db.backend.pickle_dumps(self._ctx,
+                (name, args)))
+
+    # --------------------------------------------------------------------------
+    # The methods that change the database. Each one is recorded in the journal
+    # by name so it can be replayed with the same arguments.
+
+    def save_function(self, *args):
+        self._log('save_function', *args)
+        return super().save_function(*args)
+
+
+    def delete_function(self, *args):
+        self._log('delete_function', *args)
+        return super().delete_function(*args)
+
+
+    def save_call(self, *args):
+        self._log('save_call', *args)
+        return super().save_call(*args)
+
+
+    def save_call_file(self, *args):
+        self._log('save_call_file', *args)
+        return super().save_call_file(*args)
+
+
+    def _save_external_file_names(self, *args):
+        self._log('_save_external_file_names', *args)
+        return super()._save_external_file_names(*args)
+
+
+    def save_file(self, *args):
+        self._log('save_file', *args)
+        return super().save_file(*args)
+
 
-        if path.exists():
-            path.rename(old)
+    def delete_file(self, *args):
+        self._log('delete_file', *args)
+        return super().delete_file(*args)
 
-        tmp.rename(path)
 
-        if old.exists():
-            old.remove()
+    def save_task_stats(self, *args):
+        self._log('save_task_stats', *args)
+        return super().save_task_stats(*args)
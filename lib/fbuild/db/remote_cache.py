@@ -0,0 +1,186 @@
+"""
+Share the artifact cache with other machines over HTTP. An artifact is read
+with a GET of its key, and written with a PUT. The artifacts are pickled, so
+only use a server that you would trust to run code in your builds.
+
+A minimal server that stores the artifacts in a directory is included, which
+can be run with::
+
+    python3 -m fbuild.db.remote_cache DIR --port PORT
+"""
+
+import argparse
+import http.client
+import http.server
+import os
+import queue
+import re
+import sys
+import threading
+import urllib.request
+import uuid
+
+# ------------------------------------------------------------------------------
+
+class HTTPCache:
+    """A client of a remote cache at the url. Requests that fail are treated
+    like the cache doesn't have the artifact, so the build carries on."""
+
+    def __init__(self, url, *, timeout=10):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def get(self, key):
+        """Returns the artifact data for the key, or None if there isn't
+        one."""
+
+        try:
+            with urllib.request.urlopen(self.url + '/' + key,
+                    timeout=self.timeout) as response:
+                return response.read()
+        except (OSError, http.client.HTTPException):
+            # This also covers the 404 from a missing key.
+            return None
+
+    def put(self, key, data):
+        """Store the artifact data for the key. Returns whether it worked."""
+
+        request = urllib.request.Request(self.url + '/' + key,
+            data=data,
+            method='PUT',
+            headers={'Content-Type': 'application/octet-stream'})
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                return True
+        except (OSError, http.client.HTTPException):
+            return False
+
+# ------------------------------------------------------------------------------
+
+class Uploader(threading.Thread):
+    """
+    Upload artifacts in the background, so the build never waits for the
+    remote cache. I{upload} is called with each item put on the queue.
+    """
+
+    def __init__(self, upload):
+        super().__init__(daemon=True)
+
+        self._upload = upload
+        self._queue = queue.Queue()
+
+        self.uploaded = 0
+        self.failed = 0
+
+    def put(self, item):
+        self._queue.put(item)
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            try:
+                uploaded = self._upload(item)
+            except Exception:
+                uploaded = False
+
+            if uploaded:
+                self.uploaded += 1
+            else:
+                self.failed += 1
+
+    def join(self, *args, **kwargs):
+        """Wait for the queued artifacts to be uploaded."""
+
+        self._queue.put(None)
+        super().join(*args, **kwargs)
+
+# ------------------------------------------------------------------------------
+
+# The keys are sha256 digests, which also keeps them from naming other files.
+_KEY = re.compile('^/([0-9a-f]{64})$')
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self._path()
+        if path is None:
+            return
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        path = self._path()
+        if path is None:
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+
+        tmp = path + '.' + uuid.uuid4().hex
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _path(self):
+        match = _KEY.match(self.path)
+        if match is None:
+            self.send_error(404)
+            return None
+
+        return os.path.join(self.server.directory, match.group(1))
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(directory, address=('localhost', 0)):
+    """Returns a server that stores the artifacts in the directory. Its
+    address is in I{server_address}."""
+
+    os.makedirs(directory, exist_ok=True)
+
+    server = http.server.ThreadingHTTPServer(address, _Handler)
+    server.directory = directory
+
+    return server
+
+# ------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='serve a remote artifact cache from a directory')
+    parser.add_argument('directory')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args(argv)
+
+    server = make_server(args.directory, (args.host, args.port))
+    print('serving %s on http://%s:%d' % ((args.directory,) +
+        server.server_address[:2]))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,7 @@
 import io
 import pickle
 import sqlite3
+import time
 import weakref
 
 import fbuild.db
@@ -18,14 +19,25 @@ class _ObjectID:
 
 class SqliteBackend(fbuild.db.backend.Backend):
     """
-    A sqlite-based fbuild backend database.
+    A sqlite-based fbuild backend database. If I{shared} is true, other
+    processes may use the database at the same time, so every cached call is
+    committed in its own short transaction, which is retried while another
+    process holds the database.
     """
 
-    _LATEST_VERSION = '2'
+    _LATEST_VERSION = '3'
 
-    def __init__(self, *args, **kwargs):
+    # How many cached calls we write before we commit them.
+    _CALLS_PER_COMMIT = 1000
+
+    # How many seconds we wait for other processes to release the database.
+    _BUSY_TIMEOUT = 60
+
+    def __init__(self, *args, shared=False, **kwargs):
         super().__init__(*args, **kwargs)
 
+        self._shared = shared
+
         self._pickle_data = io.BytesIO()
         self._pickler = fbuild.db.backend.Pickler(
             self._ctx,
@@ -41,11 +53,27 @@ class SqliteBackend(fbuild.db.backend.Backend):
 
         self._file_name = fbuild.path.Path(filename)
 
-        self.conn = sqlite3.connect(self._file_name)
+        # The connection may be used from any thread when the database is
+        # inline, but the calls are still serialized.
+        #
+        # When the database is shared, anything we write outside of a cached
+        # call is committed right away so we don't hold the database.
+        self.conn = sqlite3.connect(self._file_name, check_same_thread=False,
+            timeout=self._BUSY_TIMEOUT,
+            isolation_level=None if self._shared else '')
         self.cursor = self.conn.cursor()
 
+        # With a write-ahead log, a commit only has to append to the log
+        # rather than sync the database, and it's safe to only sync the log
+        # when it's folded back into the database.
+        self.cursor.execute('PRAGMA journal_mode = WAL')
+        self.cursor.execute('PRAGMA synchronous = NORMAL')
+        self.cursor.execute('PRAGMA cache_size = -65536')
+
         self._initialize_database()
 
+        self._uncommitted_calls = 0
+
         # Load the version.
         self.cursor.execute('SELECT version FROM Version')
         rows = self.cursor.fetchall()
@@ -56,17 +84,21 @@ class SqliteBackend(fbuild.db.backend.Backend):
     def close(self):
         # Update the version.
 
-        if self._version == self._NULL_VERSION:
-            self.cursor.execute('INSERT INTO Version (version) VALUES (?)',
-                                self._LATEST_VERSION)
-        else:
-            self.cursor.execute('UPDATE Version SET version=?',
-                                self._LATEST_VERSION)
+        self.cursor.execute(
+            'INSERT OR REPLACE INTO Version (id, version) VALUES (1, ?)',
+            (self._LATEST_VERSION,))
         self.conn.commit()
 
         self.conn.close()
 
 
+    def commit(self):
+        """Commit the calls we haven't committed yet."""
+
+        self.conn.commit()
+        self._uncommitted_calls = 0
+
+
     def _initialize_database(self):
         self.cursor.executescript('''
             PRAGMA foreign_keys = ON;
@@ -88,6 +120,7 @@ class SqliteBackend(fbuild.db.backend.Backend):
                 fun_id INTEGER REFERENCES Function(fun_id)
                     ON DELETE CASCADE
                     ON UPDATE CASCADE,
+                call_key TEXT,
                 call_bound BLOB,
                 call_result BLOB);
             CREATE INDEX IF NOT EXISTS Call_fun_id_index ON
@@ -128,13 +161,97 @@ class SqliteBackend(fbuild.db.backend.Backend):
                     ON DELETE CASCADE
                     ON UPDATE CASCADE,
                 PRIMARY KEY (call_id, file_id));
+
+            CREATE TABLE IF NOT EXISTS TaskStat (
+                task_key TEXT PRIMARY KEY,
+                task_stats BLOB);
             ''')
 
+        # Databases from before we had call keys get thrown away once we see
+        # their version, so we can only index the keys if the column exists.
+        columns = [row[1] for row in
+            self.cursor.execute('PRAGMA table_info(Call)')]
+        if 'call_key' in columns:
+            self.cursor.execute('''
+                CREATE INDEX IF NOT EXISTS Call_key_index ON
+                    Call (fun_id, call_key)''')
+
+        # A new database is already the latest version, so we don't have to
+        # start it over, which would pull it out from under other processes.
+        self.cursor.execute('''
+            INSERT OR IGNORE INTO Version (id, version)
+            SELECT 1, ? WHERE NOT EXISTS (SELECT * FROM Function)
+            ''', (self._LATEST_VERSION,))
+        self.conn.commit()
+
     # --------------------------------------------------------------------------
 
+    def _transaction(self, function, *args, **kwargs):
+        """Call the function in its own transaction, and try again if another
+        process is using the database."""
+
+        deadline = time.time() + self._BUSY_TIMEOUT
+        delay = 0.01
+
+        while True:
+            try:
+                # Take the write lock up front. If we only took it on our first
+                # write, two processes that read the database could both wait
+                # for the other one to finish.
+                self.cursor.execute('BEGIN IMMEDIATE')
+                result = function(*args, **kwargs)
+                self.conn.commit()
+                return result
+            except sqlite3.OperationalError as e:
+                self.conn.rollback()
+                if 'locked' not in str(e) and 'busy' not in str(e) or \
+                        time.time() > deadline:
+                    raise
+            except:
+                self.conn.rollback()
+                raise
+
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+
+
+    def _cache_shared(self, fun_dirty, fun_id, fun_name, fun_digest,
+            fun_dependents, call_id, *args):
+        # Another process may have saved the function since we looked it up.
+        new_fun_id, new_fun_digest, _ = self.find_function(fun_name)
+        if new_fun_id != fun_id:
+            fun_id = new_fun_id
+            fun_dirty = new_fun_digest != fun_digest
+            call_id = None
+
+        return super().cache(fun_dirty, fun_id, fun_name, fun_digest,
+            fun_dependents, call_id, *args)
+
+
     def cache(self, *args, **kwargs):
-        with self.conn:
-            return super().cache(*args, **kwargs)
+        if self._shared:
+            return self._transaction(self._cache_shared, *args, **kwargs)
+
+        # Commit the calls in batches, but roll back just this call if it
+        # fails.
+        if not self.conn.in_transaction:
+            self.cursor.execute('BEGIN')
+        self.cursor.execute('SAVEPOINT cache')
+
+        try:
+            result = super().cache(*args, **kwargs)
+        except:
+            self.cursor.execute('ROLLBACK TO cache')
+            raise
+        finally:
+            self.cursor.execute('RELEASE cache')
+
+        self._uncommitted_calls += 1
+        if self._uncommitted_calls >= self._CALLS_PER_COMMIT:
+            self.conn.commit()
+            self._uncommitted_calls = 0
+
+        return result
 
     # --------------------------------------------------------------------------
 
@@ -172,11 +289,19 @@ class SqliteBackend(fbuild.db.backend.Backend):
         joined_dependents = '\0'.join(fun_dependents)
 
         if fun_id is None:
-            self.cursor.execute(
-                'INSERT INTO Function (fun_name, fun_digest, fun_dependents) VALUES (?,?,?)',
-                (fun_name, fun_digest, joined_dependents))
+            # Another process may have added the function since we looked.
+            self.cursor.execute('''
+                INSERT INTO Function (fun_name, fun_digest, fun_dependents)
+                VALUES (?,?,?)
+                ON CONFLICT (fun_name) DO UPDATE SET
+                    fun_digest=excluded.fun_digest,
+                    fun_dependents=excluded.fun_dependents
+                ''', (fun_name, fun_digest, joined_dependents))
 
-            fun_id = self.cursor.lastrowid
+            self.cursor.execute(
+                'SELECT fun_id FROM Function WHERE fun_name=?',
+                (fun_name,))
+            (fun_id,), = self.cursor.fetchall()
         else:
             self.cursor.execute(
                 'UPDATE Function SET fun_digest=?, fun_dependents=? WHERE fun_id=?',
@@ -278,13 +403,13 @@ class SqliteBackend(fbuild.db.backend.Backend):
         assert isinstance(fun_id, int), fun_id
         assert isinstance(bound, dict), bound
 
-        # We've called this before, so search the data to see if we've called
-        # it with the same arguments.
+        # We've called this before, so search the calls with the same key to
+        # see if we've called it with the same arguments.
         for call_id, old_bound, old_result in self.cursor.execute('''
                 SELECT call_id, call_bound, call_result
                 FROM Call
-                WHERE fun_id=?
-                ''', (fun_id,)):
+                WHERE fun_id=? AND call_key=?
+                ''', (fun_id, self.call_key(bound))):
             old_bound = self._pickle_loads(old_bound)
 
             if bound == old_bound:
@@ -305,15 +430,21 @@ class SqliteBackend(fbuild.db.backend.Backend):
 
         call_result = self._pickle_dumps(call_result)
 
+        # Another process may have saved the same call since we looked.
+        if call_id is None and self._shared:
+            dirty, call_id, old_result = self.find_call(fun_id, call_bound)
+
         # Insert or update the call result.
         if call_id is None:
+            call_key = self.call_key(call_bound)
             call_bound = self._pickle_dumps(call_bound)
 
             self.cursor.execute('''
-                INSERT INTO Call (fun_id,call_bound,call_result)
-                VALUES (?,?,?)
+                INSERT INTO Call (fun_id,call_key,call_bound,call_result)
+                VALUES (?,?,?,?)
                 ''', (
                     fun_id,
+                    call_key,
                     sqlite3.Binary(call_bound),
                     sqlite3.Binary(call_result)))
 
@@ -364,6 +495,19 @@ class SqliteBackend(fbuild.db.backend.Backend):
             VALUES (?,?,?)
             ''', (call_id, file_id, file_digest))
 
+
+    def save_call_files(self, call_id, digests):
+        """Insert or update the call files."""
+
+        # Make sure we got the right types.
+        assert isinstance(call_id, int), call_id
+
+        self.cursor.executemany('''
+            INSERT OR REPLACE INTO CallFile (call_id,file_id,file_digest)
+            VALUES (?,?,?)
+            ''', ((call_id, file_id, file_digest)
+                for file_id, file_name, file_digest in digests))
+
     # --------------------------------------------------------------------------
 
     def find_external_srcs(self, call_id):
@@ -484,12 +628,19 @@ class SqliteBackend(fbuild.db.backend.Backend):
         assert isinstance(file_digest, str), file_digest
 
         if file_id is None:
+            # Another process may have added the file since we looked.
             self.cursor.execute('''
                 INSERT INTO File (file_name,file_mtime,file_digest)
                 VALUES (?,?,?)
+                ON CONFLICT (file_name) DO UPDATE SET
+                    file_mtime=excluded.file_mtime,
+                    file_digest=excluded.file_digest
                 ''', (file_name, file_mtime, file_digest))
 
-            file_id = self.cursor.lastrowid
+            self.cursor.execute(
+                'SELECT file_id FROM File WHERE file_name=?',
+                (file_name,))
+            (file_id,), = self.cursor.fetchall()
         else:
             self.cursor.execute(
                 'UPDATE File SET file_mtime=?, file_digest=? WHERE file_id=?',
@@ -527,3 +678,34 @@ class SqliteBackend(fbuild.db.backend.Backend):
             (file_id,))
 
         self.cursor.execute('DELETE FROM File WHERE file_name=?', (file_name,))
+
+    # --------------------------------------------------------------------------
+
+    def load_task_stats(self):
+        """Returns a dictionary of the statistics recorded for each scheduler
+        task."""
+
+        return {task_key: self._pickle_loads(task_stats)
+            for task_key, task_stats in self.cursor.execute(
+                'SELECT task_key,task_stats FROM TaskStat')}
+
+
+    def save_task_stats(self, task_stats):
+        """Insert or update the statistics of the scheduler tasks."""
+
+        # Make sure we got the right types.
+        assert isinstance(task_stats, dict), task_stats
+
+        if self._shared and not self.conn.in_transaction:
+            return self._transaction(self.save_task_stats, task_stats)
+
+        old_task_stats = self.load_task_stats()
+        for key, stats in task_stats.items():
+            old_task_stats.setdefault(key, {}).update(stats)
+
+        self.cursor.executemany('''
+            INSERT OR REPLACE INTO TaskStat (task_key,task_stats)
+            VALUES (?,?)
+            ''', ((key, sqlite3.Binary(self._pickle_dumps(stats)))
+                for key, stats in old_task_stats.items()
+                if key in task_stats))
@@ -1,4 +1,5 @@
 from inspect import *
+import re
 import linecache
 
 def findsource(object):
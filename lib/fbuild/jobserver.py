@@ -0,0 +1,166 @@
+import os
+import re
+import select
+import threading
+
+import fbuild
+
+# ------------------------------------------------------------------------------
+
+class JobServer:
+    """
+    A GNU make compatible jobserver, which limits how many jobs can run at once
+    across fbuild and any make based builds it runs. Every job must hold a
+    token while it runs. The process owns one implicit token, and the rest are
+    bytes in a pipe that is shared with the child processes through
+    I{MAKEFLAGS}:
+
+    >>> jobserver = JobServer(2)
+    >>> a = jobserver.acquire()
+    >>> b = jobserver.acquire()
+    >>> jobserver.release(b)
+    >>> jobserver.release(a)
+    >>> jobserver.makeflags() # doctest: +ELLIPSIS
+    '-j2 --jobserver-auth=...'
+    """
+
+    def __init__(self, jobs, *, fds=None):
+        """
+        Create a jobserver that allows I{jobs} jobs at once. If I{fds} is
+        given, join the jobserver that has these read and write file
+        descriptors instead of creating a new one.
+        """
+
+        self.jobs = jobs
+
+        if fds is None:
+            self.fds = os.pipe()
+            os.write(self.fds[1], b'+' * (jobs - 1))
+        else:
+            self.fds = tuple(fds)
+
+        # Tokens we can hand out without touching the pipe. This starts out
+        # with the implicit token, which is represented by None.
+        self._free_tokens = [None]
+        self._condition = threading.Condition()
+
+        # Only one thread at a time waits on the pipe. It also needs to wake
+        # up when the implicit token is returned, which doesn't go through the
+        # pipe, so we poke it through a private pipe.
+        self._reading = False
+        self._wakeup_fds = os.pipe()
+
+    @classmethod
+    def from_makeflags(cls, makeflags):
+        """
+        Join the jobserver named in the I{MAKEFLAGS} of a parent make, or
+        return None if there isn't one we can use.
+        """
+
+        if not makeflags:
+            return None
+
+        match = re.search(r'--jobserver-(?:auth|fds)=(?:(\d+),(\d+)|fifo:(\S+))',
+            makeflags)
+        if match is None:
+            return None
+
+        match_jobs = re.search(r'(?:^|\s)-j(\d+)', makeflags)
+        jobs = int(match_jobs.group(1)) if match_jobs else None
+
+        if match.group(3):
+            try:
+                fd = os.open(match.group(3), os.O_RDWR)
+            except OSError:
+                return None
+            return cls(jobs, fds=(fd, fd))
+
+        fds = int(match.group(1)), int(match.group(2))
+
+        # Make only passes the pipe down to recipes it knows are make
+        # commands, so the descriptors may not actually be open.
+        try:
+            for fd in fds:
+                os.fstat(fd)
+        except OSError:
+            return None
+
+        return cls(jobs, fds=fds)
+
+    def acquire(self):
+        """
+        Block until a token is available and return it. The token must be
+        handed back to L{release} once the job is done.
+        """
+
+        with self._condition:
+            while self._reading and not self._free_tokens:
+                self._condition.wait()
+
+            if self._free_tokens:
+                return self._free_tokens.pop()
+
+            self._reading = True
+
+        try:
+            while True:
+                readable, _, _ = select.select(
+                    [self.fds[0], self._wakeup_fds[0]], [], [])
+
+                if self._wakeup_fds[0] in readable:
+                    os.read(self._wakeup_fds[0], 1)
+
+                    with self._condition:
+                        if self._free_tokens:
+                            return self._free_tokens.pop()
+
+                if self.fds[0] in readable:
+                    # Another process may beat us to the token, in which case
+                    # we block until a token is returned to the pipe, just like
+                    # make does.
+                    token = os.read(self.fds[0], 1)
+                    if not token:
+                        raise fbuild.Error('jobserver pipe was closed')
+
+                    return token
+        finally:
+            # Let another thread wait on the pipe.
+            with self._condition:
+                self._reading = False
+                self._condition.notify()
+
+    def release(self, token):
+        """Return a token from L{acquire} back to the jobserver."""
+
+        if token is None:
+            with self._condition:
+                self._free_tokens.append(None)
+                self._condition.notify()
+
+                if self._reading:
+                    os.write(self._wakeup_fds[1], b'+')
+        else:
+            # Make expects to get back the same byte it handed out.
+            os.write(self.fds[1], token)
+
+    def makeflags(self, makeflags=None):
+        """
+        Return the I{MAKEFLAGS} that lets a child make use this jobserver,
+        replacing any jobserver settings in I{makeflags}.
+        """
+
+        flags = []
+        if makeflags:
+            flags.append(re.sub(r'(?:^|\s)(?:-j\d*|--jobserver-\S+)', '',
+                makeflags).strip())
+
+        # If we joined a fifo based jobserver, the children just inherit our
+        # descriptor for the fifo.
+        auth = '--jobserver-auth=%d,%d' % self.fds
+
+        if self.jobs is None:
+            flags.append(auth)
+        else:
+            flags.append('-j%d %s' % (self.jobs, auth))
+
+        return ' '.join(f for f in flags if f)
@@ -1,3 +1,4 @@
+import copy
 import os
 import sys
 import signal
@@ -13,6 +14,7 @@ import fbuild.target
 import fbuild.path
 import fbuild.context
 import fbuild.options
+import fbuild.server
 import fbuild.builders.file
 
 # If we can't import fbuildroot, save the exception and raise it later.
@@ -49,6 +51,9 @@ def _call_or_deprecated(current, current_args, deprecated, deprecated_args):
     return None
 
 def parse_args(argv):
+    return fbuild.context.Context(parse_options(argv))
+
+def parse_options(argv):
     parser = fbuild.options.make_parser()
 
     # -------------------------------------------------------------------------
@@ -67,7 +72,7 @@ def parse_args(argv):
                                deprecated='post_options', deprecated_args=[args]) \
            or args
 
-    return fbuild.context.Context(args)
+    return args
 
 # ------------------------------------------------------------------------------
 
@@ -129,8 +134,40 @@ def build(ctx):
             target = fbuild.target.find(target_name)
             target.function(ctx)
 
+    ctx.logger.log('nested scheduler calls slept %d times instead of polling' %
+        ctx.scheduler.idle_waits, verbose=1)
+
+    if ctx.db.artifact_cache is not None:
+        ctx.logger.log('artifact cache: ' + ctx.db.artifact_cache.summary())
+
+    if ctx.config_cache is not None:
+        ctx.logger.log('config cache: ' + ctx.config_cache.summary())
+
     return 0
 
+def watch(ctx):
+    """Build again whenever the files the build used change, until we're
+    interrupted."""
+
+    while True:
+        ctx.logger.log('waiting for changes...', color='cyan')
+
+        try:
+            changes = ctx.db.wait_for_changes()
+        except KeyboardInterrupt:
+            return 0
+
+        if changes is None:
+            ctx.logger.log('lost track of changes, checking every file')
+        else:
+            for change in sorted(changes):
+                ctx.logger.check(' * changed', change, color='yellow')
+
+        try:
+            build(ctx)
+        except fbuild.Error as e:
+            ctx.logger.log(e, color='red')
+
 # ------------------------------------------------------------------------------
 
 def main(argv=None):
@@ -149,7 +186,22 @@ def main(argv=None):
 
     # --------------------------------------------------------------------------
 
-    ctx = parse_args(sys.argv if argv is None else argv)
+    if argv is None:
+        argv = sys.argv
+
+    # Let the build server build for us if there is one.
+    result = fbuild.server.request(argv)
+    if result is not None:
+        sys.exit(result)
+
+    args = parse_options(argv)
+
+    # The server compares these options to its requests, so copy them before
+    # the context changes them.
+    server_args = copy.copy(args)
+
+    ctx = fbuild.context.Context(args)
+    restart = False
 
     # --------------------------------------------------------------------------
     # Replace the ctrl-c signal handler with one that will shut down the
@@ -183,13 +235,24 @@ def main(argv=None):
                 ctx.options.buildroot.rmtree()
             return
 
+        if ctx.options.stop_server:
+            raise fbuild.Error('no build server is running')
+
         # Prep the context for running.
         ctx.create_buildroot()
         ctx.load_configuration()
 
         # ... and then run the build.
         try:
-            result = build(ctx)
+            if ctx.options.serve:
+                restart = fbuild.server.serve(ctx, server_args,
+                    parse_options, build)
+                result = 0
+            else:
+                result = build(ctx)
+
+                if ctx.options.watch:
+                    result = watch(ctx)
         except fbuild.Error as e:
             ctx.logger.log(e, color='red')
             sys.exit(1)
@@ -210,4 +273,9 @@ def main(argv=None):
     finally:
         ctx.scheduler.shutdown()
 
+    # Start the server over now that we've saved the state, so that it loads
+    # the changed build scripts.
+    if restart:
+        os.execv(sys.executable, [sys.executable] + argv)
+
     return result
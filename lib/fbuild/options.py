@@ -2,6 +2,8 @@ import argparse
 import optparse
 import warnings
 
+import fbuild.config.cache
+import fbuild.path
 import fbuild.target
 
 # ------------------------------------------------------------------------------
@@ -95,6 +97,20 @@ def make_parser():
                         help='print out extra debugging info')
     parser.add_argument('-j', '--jobs', dest='threadcount', metavar='N', type=int,
                         default=1, help='Allow N jobs at once')
+    parser.add_argument('--jobserver', action='store_true', default=False,
+                        help='limit the running commands, including those run '
+                             'by make, to N with a make compatible jobserver')
+    parser.add_argument('--memory-budget', metavar='MB', type=int, default=None,
+                        help='delay running commands that would use more than '
+                             'MB megabytes of memory together')
+    parser.add_argument('--processes', dest='processcount', metavar='N',
+                        type=int, default=0,
+                        help='run cpu bound python work in N processes')
+    parser.add_argument('--critical-path', action='store_true', default=False,
+                        help='run the tasks with the longest dependency chains first')
+    parser.add_argument('--work-stealing', action='store_true', default=False,
+                        help='give each job its own work queue and steal work '
+                             'from the others when idle')
     parser.add_argument('--no-color', action='store_true', default=False,
                         help='do not use colors')
     parser.add_argument('--nocolor', action='store_true', default=False,
@@ -127,6 +143,49 @@ def make_parser():
                         help='explain why a function was not cached')
     parser.add_argument('--database-engine', choices=('pickle', 'sqlite', 'cache'),
                         default='pickle', help='which database engine to use')
+    parser.add_argument('--digest-algorithm',
+                        choices=fbuild.path.DIGEST_ALGORITHMS, default='md5',
+                        help='which algorithm to hash files with')
+    parser.add_argument('--inline-database', action='store_true', default=False,
+                        help='access the database from the calling thread ' \
+                             'instead of a dedicated database thread')
+    parser.add_argument('--shared-database', action='store_true',
+                        default=False,
+                        help='let other fbuild processes use the sqlite ' \
+                             'database while this one does')
+    parser.add_argument('--artifact-cache', metavar='DIR',
+                        help='share the results and files of cached calls ' \
+                             'with other builds through this directory')
+    parser.add_argument('--artifact-cache-size', metavar='MB', type=int,
+                        default=10240,
+                        help='evict the least recently used calls from the ' \
+                             'artifact cache once it is bigger than this ' \
+                             '(default: 10240)')
+    parser.add_argument('--artifact-cache-link', action='store_true',
+                        default=False,
+                        help='hard link files out of the artifact cache ' \
+                             'instead of copying them, which is only safe ' \
+                             'if nothing writes over the build outputs')
+    parser.add_argument('--remote-cache', metavar='URL',
+                        help='share the artifact cache with other machines ' \
+                             'through the http server at this url')
+    parser.add_argument('--config-cache', metavar='DIR', nargs='?',
+                        const=fbuild.config.cache.default_directory(),
+                        help='share the results of configuration tests with ' \
+                             'other builds that use the same compiler and ' \
+                             'flags through this directory (default: ' \
+                             '~/.cache/fbuild/config)')
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='after building, build again whenever a file '
+                             'the build used changes (linux only)')
+    parser.add_argument('--serve', action='store_true', default=False,
+                        help='keep the build loaded in a server, which later '
+                             'fbuild calls run their targets in (unix only)')
+    parser.add_argument('--stop-server', action='store_true', default=False,
+                        help='stop the build server')
+    parser.add_argument('--no-server', action='store_true', default=False,
+                        help='build in this process even if a build server '
+                             'is running')
     parser.add_argument('--no-warnings', action='store_true', default=False,
                         help='suppress warnings for the build script')
 
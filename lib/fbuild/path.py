@@ -1,15 +1,40 @@
 import collections
 import hashlib
 import itertools
+import mmap
 import os
 import shutil
 import sys
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+import fbuild
 import fbuild.fnmatch
 import fbuild.glob
 
 # ------------------------------------------------------------------------------
 
+# The algorithms that Path.digest can use.
+DIGEST_ALGORITHMS = ('md5', 'sha1', 'sha256', 'blake2b', 'xxhash')
+
+# Files at least this big are mapped into memory to be hashed.
+_MMAP_THRESHOLD = 4 * 1024 * 1024
+
+def _new_hash(algorithm):
+    if algorithm == 'xxhash':
+        if xxhash is None:
+            raise fbuild.Error('xxhash digests need the xxhash module')
+        return xxhash.xxh3_128()
+    elif algorithm in DIGEST_ALGORITHMS:
+        return hashlib.new(algorithm)
+    else:
+        raise fbuild.Error('unknown digest algorithm: %s' % algorithm)
+
+# ------------------------------------------------------------------------------
+
 class Path(str):
     """Implement a simple interface for working with the filesystem. The
     methods in this class are designed to be used as either normal methods:
@@ -119,9 +144,16 @@ class Path(str):
         Path('abc/foo/bar/baz.ext')
         >>> Path.addroot('foo/bar/baz.ext', 'foo')
         Path('foo/bar/baz.ext')
+
+        Absolute paths that are already under "root", like the temporary
+        files in the build directory, are left alone too.
         """
         if not self.startswith(root):
             if os.path.isabs(self):
+                abs_root = os.path.join(os.path.abspath(root), '')
+                if self.startswith(abs_root):
+                    return Path(self)
+
                 path = os.path.split(self)[1]
             else:
                 path = self
@@ -292,16 +324,26 @@ class Path(str):
                 return
             raise
 
-    def digest(self, chunksize=65536):
-        """Hash the file usind md5 and return the digest."""
+    def digest(self, chunksize=65536, *, algorithm='md5'):
+        """Hash the file using the algorithm and return the digest. Digests
+        from algorithms other than md5 start with the algorithm's name, so
+        they never match a digest from a different algorithm."""
+        m = _new_hash(algorithm)
         with open(self, 'rb') as f:
-            m = hashlib.md5()
-            while True:
-                d = f.read(chunksize)
-                if not d:
-                    break
-                m.update(d)
+            if os.fstat(f.fileno()).st_size >= _MMAP_THRESHOLD:
+                # Hash the whole file at once without copying it.
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as d:
+                    m.update(d)
+            else:
+                while True:
+                    d = f.read(chunksize)
+                    if not d:
+                        break
+                    m.update(d)
+
+        if algorithm == 'md5':
             return m.hexdigest()
+        return '%s:%s' % (algorithm, m.hexdigest())
 
     def mkdir(self):
         return os.mkdir(self)
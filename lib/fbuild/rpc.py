@@ -36,6 +36,11 @@ class RPC(threading.Thread):
         self._started = threading.Event()
         self._running = False
 
+        # The first exception raised by a L{cast}, which is raised when the
+        # caller checks for it, or when we shut down.
+        self._cast_error = None
+        self._cast_error_lock = threading.Lock()
+
     def call(self, *args, **kwargs):
         """Call the function inside the rpc thread."""
 
@@ -69,6 +74,30 @@ class RPC(threading.Thread):
         else:
             return result.result
 
+    def cast(self, *args, **kwargs):
+        """Queue up a call of the function inside the rpc thread without
+        waiting for it to finish. Calls are processed in order, so a later
+        L{call} sees the effects of this one. If it raises an exception, the
+        exception is raised by L{raise_cast_error} or L{join} instead. The
+        arguments must not be changed until the call has run."""
+
+        with self._lock:
+            if not self._running:
+                raise RPCNotRunning()
+
+            self._queue.put((None, None, args, kwargs))
+
+    def raise_cast_error(self):
+        """Raise the first exception raised by a L{cast} since we last
+        checked, if any."""
+
+        with self._cast_error_lock:
+            err = self._cast_error
+            self._cast_error = None
+
+        if err is not None:
+            raise err
+
     def start(self, *args, **kwargs):
         super().start(*args, **kwargs)
 
@@ -82,18 +111,17 @@ class RPC(threading.Thread):
 
         try:
             while True:
-                msg = self._queue.get()
+                # Drain every message that's queued up before we go back to
+                # waiting, so that a burst of calls costs us only one wakeup.
+                msgs = [self._queue.get()]
                 try:
-                    # If we received a null value, then we're supposed to shut
-                    # down.
-                    if msg is _NULL:
-                        sys.stdout.flush()
-                        break
-
-                    self._process(msg)
-                finally:
-                    # ... and let the queue know we finished.
-                    self._queue.task_done()
+                    while True:
+                        msgs.append(self._queue.get(block=False))
+                except queue.Empty:
+                    pass
+
+                if not self._process_all(msgs):
+                    break
         except KeyboardInterrupt:
             # let the main thread know we got a SIGINT
             import _thread
@@ -104,10 +132,44 @@ class RPC(threading.Thread):
         finally:
             self._running = False
 
+    def _process_all(self, msgs):
+        """Process the messages in order. Returns False if we're supposed to
+        shut down."""
+
+        for i, msg in enumerate(msgs):
+            try:
+                # If we received a null value, then we're supposed to shut
+                # down.
+                if msg is _NULL:
+                    sys.stdout.flush()
+
+                    # Let the queue know we won't finish the rest.
+                    for _ in msgs[i + 1:]:
+                        self._queue.task_done()
+
+                    return False
+
+                self._process(msg)
+            finally:
+                # ... and let the queue know we finished.
+                self._queue.task_done()
+
+        return True
+
     def _process(self, msg):
         # Break up the message.
         event, result, args, kwargs = msg
 
+        # A cast doesn't have anyone waiting on the result.
+        if event is None:
+            try:
+                self._handler(*args, **kwargs)
+            except Exception as err:
+                with self._cast_error_lock:
+                    if self._cast_error is None:
+                        self._cast_error = err
+            return
+
         try:
             result.result = self._handler(*args, **kwargs)
         except Exception as err:
@@ -121,7 +183,8 @@ class RPC(threading.Thread):
             event.set()
 
     def join(self, *args, **kwargs):
-        """Inform the thread to shut down."""
+        """Inform the thread to shut down, and raise any exception from a
+        L{cast} that hasn't been raised yet."""
 
         if self._running:
             with self._lock:
@@ -130,3 +193,40 @@ class RPC(threading.Thread):
                 self._queue.join()
 
                 super().join(*args, **kwargs)
+
+        self.raise_cast_error()
+
+# ------------------------------------------------------------------------------
+
+class InlineRPC:
+    """An L{RPC} lookalike that calls the function directly in the calling
+    thread. Calls from different threads are serialized with a lock, which
+    avoids the cost of handing every call over to another thread."""
+
+    def __init__(self, handler):
+        self._handler = handler
+        self._lock = threading.Lock()
+        self._running = False
+        self.daemon = True
+
+    def call(self, *args, **kwargs):
+        """Call the function while holding the lock."""
+
+        with self._lock:
+            if not self._running:
+                raise RPCNotRunning()
+
+            return self._handler(*args, **kwargs)
+
+    cast = call
+
+    def raise_cast_error(self):
+        # Casts raise right away.
+        pass
+
+    def start(self):
+        self._running = True
+
+    def join(self, *args, **kwargs):
+        with self._lock:
+            self._running = False
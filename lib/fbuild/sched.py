@@ -1,11 +1,16 @@
 import collections
+import concurrent.futures
 import contextlib
+import functools
+import heapq
 import io
+import itertools
 import operator
 import queue
 import sys
 import threading
 import time
+import types
 import _thread
 
 import fbuild
@@ -66,20 +71,57 @@ class Scheduler:
     >>> scheduler.map_with_dependencies(deps, f, ['a', 'b', 'c'])
     ['c', 'b', 'a']
 
+    In priority mode, the scheduler weighs every task by the length of the
+    longest chain of tasks that depend upon it, and always dispatches the
+    heaviest ready task first.  The length of a chain is estimated from how
+    long its tasks took to run previously, as recorded in L{task_stats}:
+
+    >>> scheduler = Scheduler(2, priority=True)
+    >>> scheduler.map_with_dependencies(deps, f, ['a', 'b', 'c'])
+    ['c', 'b', 'a']
+    >>> sorted(scheduler.task_stats)
+    ['f:a', 'f:b', 'f:c']
+
     """
 
-    def __init__(self, threadcount=0, *, logger=None):
+    def __init__(self, threadcount=0, *, logger=None, priority=False,
+            work_stealing=False, processcount=0, memory_budget=None):
         # We need at least 1 thread.
         threadcount = max(1, threadcount)
 
         # Our threads.
         self.__threads = []
 
+        # Our process pool for pure python work, which is only started the
+        # first time we need it.
+        self.__processcount = processcount
+        self.__process_pool = None
+        self.__process_pool_lock = threading.Lock()
+
+        # Should we order the ready tasks by their critical path?
+        self.priority = priority
+
+        # Statistics about previously run tasks, keyed by the task's function
+        # name and source. This is loaded from and saved to the database by
+        # the context.
+        self.task_stats = {}
+
+        # Optionally limit how much memory the running commands may use.
+        if memory_budget is None:
+            self.memory_budget = None
+        else:
+            self.memory_budget = MemoryBudget(memory_budget)
+
         # Our work queue of ready tasks that is shared with all the worker
-        # threads. We use a lifo queue as we want to do work in the order it
-        # comes in since it's less likely to have dependencies on later
-        # functions.
-        self.__ready_queue = queue.LifoQueue()
+        # threads. Tasks with the highest priority are run first. Otherwise we
+        # want to do work in a lifo order as it's less likely to have
+        # dependencies on later functions. With many threads, the single queue
+        # can become contended, so optionally give each thread its own queue
+        # and let idle threads steal work from the others.
+        if work_stealing:
+            self.__ready_queue = WorkStealingQueue()
+        else:
+            self.__ready_queue = ReadyQueue()
 
         # All the worker threads need to share a logger object to make sure we
         # don't have races when we're logging to the console. So we need to
@@ -91,6 +133,14 @@ class Scheduler:
         # Set up the controlling lock.
         self.__controlling_lock = threading.Lock()
 
+        # Nested evaluations wait on this condition until there is either a
+        # new ready task or one of their tasks finished.
+        self.__activity = threading.Condition()
+
+        # The number of times a nested evaluation went to sleep instead of
+        # polling the queues.
+        self.idle_waits = 0
+
         # Spin up our threads!
         for i in range(threadcount):
             thread = WorkerThread(logger, self.__ready_queue, self.__controlling_lock)
@@ -136,6 +186,33 @@ class Scheduler:
             if was_locked:
                 self.__controlling_lock.acquire()
 
+    def run_in_process(self, function, *args, **kwargs):
+        """Run the function in the process pool and return the result. This
+        lets cpu bound python code run without holding the interpreter lock
+        of this process. The function and its arguments must be picklable, so
+        it shouldn't use the context. If the scheduler doesn't have a process
+        pool, the function is just called directly.
+
+        >>> scheduler = Scheduler(1, processcount=2)
+        >>> scheduler.run_in_process(pow, 2, 10)
+        1024
+        >>> scheduler.shutdown()
+        """
+
+        if not self.__processcount:
+            return function(*args, **kwargs)
+
+        with self.__process_pool_lock:
+            if self.__process_pool is None:
+                self.__process_pool = concurrent.futures.ProcessPoolExecutor(
+                    self.__processcount)
+
+        future = self.__process_pool.submit(function, *args, **kwargs)
+
+        # Let the other threads run while the process does the work.
+        with self.interruptible():
+            return future.result()
+
     def map(self, function, srcs):
         """Run the function over the input sources concurrently. This function
         returns the results in their initial order."""
@@ -144,10 +221,28 @@ class Scheduler:
 
         return [n.result for n in tasks]
 
-    def map_with_dependencies(self, depends, function, srcs):
+    def imap_unordered(self, function, srcs):
+        """Run the function over the input sources concurrently. This function
+        returns an iterator that yields the results as soon as they finish, so
+        the caller can start working on them while the rest are running.
+
+        >>> scheduler = Scheduler(2)
+        >>> sorted(scheduler.imap_unordered(lambda x: x * x, [1, 2, 3]))
+        [1, 4, 9]
+        """
+        tasks = [Task(function, src, index) for index, src in enumerate(srcs)]
+
+        for task in self._iter_evaluate(tasks):
+            yield task.result
+
+    def map_with_dependencies(self, depends, function, srcs, *, cost=None):
         """Calculate the dependencies between the input sources and run them
         concurrently. This function returns the results in the order that they
-        finished, not their initial order."""
+        finished, not their initial order.
+
+        When the scheduler is in priority mode, the optional I{cost} function
+        estimates how long it takes to run the function on a source. It
+        defaults to the duration recorded the last time the task ran."""
 
         # First create tasks for all the input sources and create an index from
         # src to task. We'll use this as a lookup when we invert the dependency
@@ -171,9 +266,21 @@ class Scheduler:
                         # ignore missing dependencies
                         pass
 
+        # Weigh the tasks by their critical paths.
+        if self.priority:
+            self._prioritize(function, list(tasks.values()), cost)
+
         # Evaluate the functions.
         self._evaluate(list(tasks.values()))
 
+        # Remember how long each task took for future builds.
+        if self.priority:
+            name = _function_name(function)
+            for task in tasks.values():
+                self.task_stats.setdefault(
+                    '%s:%s' % (name, task.src), {})['duration'] = \
+                        task.duration
+
         # Sort the functions in a depth first order. Otherwise, the order of
         # the function evaluation could change between calls, which could break
         # caching these results.
@@ -194,8 +301,60 @@ class Scheduler:
 
         return results
 
+    def _prioritize(self, function, tasks, cost=None):
+        """Set each task's priority to the estimated cost of the longest chain
+        of tasks that depends on it, including the task itself."""
+
+        if cost is None:
+            name = _function_name(function)
+            durations = {}
+            for task in tasks:
+                try:
+                    durations[task.src] = \
+                        self.task_stats['%s:%s' % (name, task.src)]['duration']
+                except KeyError:
+                    pass
+
+            # Tasks we haven't seen before are assumed to be average.
+            if durations:
+                default = sum(durations.values()) / len(durations)
+            else:
+                default = 1.0
+
+            cost = lambda src: durations.get(src, default)
+
+        # Walk the graph from the tasks nothing depends upon back towards
+        # their dependencies. A task's weight is known once all of its
+        # dependents have been weighed. Tasks in a dependency loop are never
+        # reached, but _evaluate will report them anyway.
+        remaining = collections.Counter()
+        for task in tasks:
+            for dep in task.dependencies:
+                remaining[dep] += 1
+
+        heaviest_dependent = collections.defaultdict(float)
+        stack = [task for task in tasks if not remaining[task]]
+
+        while stack:
+            task = stack.pop()
+            task.priority = cost(task.src) + heaviest_dependent[task]
+
+            for dep in task.dependencies:
+                heaviest_dependent[dep] = max(
+                    heaviest_dependent[dep],
+                    task.priority)
+
+                remaining[dep] -= 1
+                if not remaining[dep]:
+                    stack.append(dep)
+
     def _evaluate(self, tasks):
         """Evaluate the function over these tasks and return the results."""
+        return list(self._iter_evaluate(tasks))
+
+    def _iter_evaluate(self, tasks):
+        """Evaluate the function over these tasks and yield each task as soon
+        as it finishes."""
 
         # Keep a counter for the number of active tasks. When this reaches 0 we
         # know we can exit.
@@ -205,17 +364,20 @@ class Scheduler:
         children = collections.defaultdict(list)
 
         # The queue from which we will receive function results.
-        done_queue = queue.Queue()
+        done_queue = DoneQueue(self.__activity)
 
-        # Add each task to our work set and map dependencies to dependents.
-        for task in tasks:
+        # Add each task to our work set and map dependencies to dependents. We
+        # queue up the heaviest tasks first so that an idle worker doesn't grab
+        # a light one before we've added the rest.
+        for task in sorted(tasks, key=operator.attrgetter('priority'),
+                reverse=True):
             for dep in task.dependencies:
                 children[dep].append(task)
 
             if task.can_run():
                 count += 1
                 task.running = True
-                self.__ready_queue.put((done_queue, task))
+                self._put_ready((done_queue, task))
 
         # A naive threadpool scheduler can deadlock if a function the scheduler
         # is mapping also makes calls to the scheduler. The traditional way of
@@ -231,27 +393,26 @@ class Scheduler:
         # run another queued up function.
         current_thread = threading.current_thread()
 
-        # The list of function results.
-        results = []
+        # The number of tasks that finished.
+        finished = 0
 
         # Run until all of our tasks finished.
         while count != 0:
             if isinstance(current_thread, WorkerThread):
                 # We're inside an already running thread, so we're going to run
-                # until all of our tasks are done.
-                try:
-                    with self.interruptible():
-                        task = current_thread.read_task(block=False)
-                except queue.Empty:
-                    pass
-                else:
-                    current_thread.run_one(task)
-
-                # See if any of our tasks finished.
+                # until all of our tasks are done. See if any of our tasks
+                # finished.
                 try:
                     task = done_queue.get(block=False)
                 except queue.Empty:
-                    # No tasks done, so loop.
+                    # No tasks done, so either run a ready task or sleep until
+                    # something happens, then loop.
+                    with self.interruptible():
+                        queue_task = self._wait_for_activity(current_thread,
+                            done_queue)
+
+                    if queue_task is not None:
+                        current_thread.run_one(queue_task)
                     continue
             else:
                 task = done_queue.get()
@@ -269,19 +430,21 @@ class Scheduler:
 
                 raise task.exc
 
-            # Otherwise, add it to our results.
-            results.append(task)
-
             # If we have any dependent childs, see if they can run now. If so,
-            # add them to our work queue.
+            # add them to our work queue. We do this before handing the task
+            # back so that they can run while our caller is busy with it.
             for child in children[task]:
                 if child.can_run():
                     count += 1
                     child.running = True
-                    self.__ready_queue.put((done_queue, child))
+                    self._put_ready((done_queue, child))
+
+            # Hand the finished task back to our caller.
+            finished += 1
+            yield task
 
         # Check if we ran all of the tasks.
-        if len(results) != len(tasks):
+        if finished != len(tasks):
             # Uh oh, we must have a mutually dependent task. Figure out all the
             # dependencies and error out.
             recursive_srcs = set()
@@ -296,7 +459,34 @@ class Scheduler:
 
             raise DependencyLoop(recursive_srcs)
 
-        return results
+    def _put_ready(self, queue_task):
+        """Add a task to the ready queue and wake up any nested evaluations
+        that are waiting for work."""
+
+        self.__ready_queue.put(queue_task)
+
+        with self.__activity:
+            self.__activity.notify_all()
+
+    def _wait_for_activity(self, current_thread, done_queue):
+        """Block until there is either a ready task, which is returned, or a
+        task in the done queue, in which case None is returned."""
+
+        with self.__activity:
+            while True:
+                try:
+                    return current_thread.read_task(block=False)
+                except queue.Empty:
+                    pass
+
+                if not done_queue.empty():
+                    return None
+
+                # Everyone who adds a ready or done task notifies us after
+                # they've added it, and they can't do that until we've released
+                # the condition by waiting on it, so we can't miss a wakeup.
+                self.idle_waits += 1
+                self.__activity.wait()
 
     def __del__(self):
         # Make sure we shutdown all our threads before we quit.
@@ -307,7 +497,7 @@ class Scheduler:
 
         # make sure we wake the threads before we kill them.
         for thread in self.__threads:
-            self.__ready_queue.put(None)
+            self._put_ready(None)
 
         for thread in self.__threads:
             thread.shutdown()
@@ -316,6 +506,161 @@ class Scheduler:
         # Reset our thread list.
         self.__threads = []
 
+        if self.__process_pool is not None:
+            self.__process_pool.shutdown()
+            self.__process_pool = None
+
+# ------------------------------------------------------------------------------
+
+class MemoryBudget:
+    """
+    Limits the total memory the running tasks are expected to use. A task that
+    doesn't fit waits until enough other tasks finish. A task always runs if
+    no others are running, so a task that's larger than the whole budget
+    won't wait forever:
+
+    >>> budget = MemoryBudget(100)
+    >>> budget.acquire(60)
+    True
+    >>> budget.acquire(200, block=False)
+    False
+    >>> budget.release(60)
+    >>> budget.acquire(200, block=False)
+    True
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self._running = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, amount, block=True):
+        """Reserve I{amount} bytes of the budget, waiting until it fits.
+        Returns whether or not we reserved it, which can only be False if
+        I{block} is False."""
+
+        with self._condition:
+            while self._running and self.used + amount > self.budget:
+                if not block:
+                    return False
+                self._condition.wait()
+
+            self.used += amount
+            self._running += 1
+
+            return True
+
+    def release(self, amount):
+        """Return I{amount} bytes to the budget."""
+
+        with self._condition:
+            self.used -= amount
+            self._running -= 1
+            self._condition.notify_all()
+
+# ------------------------------------------------------------------------------
+
+class DoneQueue(queue.Queue):
+    """
+    A queue of finished tasks that wakes up the nested evaluations waiting on
+    the scheduler's activity condition whenever a task is added.
+    """
+
+    def __init__(self, activity):
+        super().__init__()
+        self._activity = activity
+
+    def put(self, *args, **kwargs):
+        super().put(*args, **kwargs)
+
+        with self._activity:
+            self._activity.notify_all()
+
+# ------------------------------------------------------------------------------
+
+class ReadyQueue(queue.PriorityQueue):
+    """
+    A queue of (done_queue, task) pairs that returns the task with the highest
+    priority first, and the most recently added task when the priorities are
+    equal. A None shuts down a worker thread, so it is returned right away.
+    """
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._counter = itertools.count()
+
+    def _put(self, item):
+        if item is None:
+            priority = float('inf')
+        else:
+            priority = item[1].priority
+
+        heapq.heappush(self.queue, (-priority, -next(self._counter), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
+
+    def register(self):
+        """Worker threads call this before they read any tasks."""
+        pass
+
+
+class WorkStealingQueue:
+    """
+    A queue of (done_queue, task) pairs where every worker thread has its own
+    deque. A worker pushes and pops tasks at the back of its deque, so it
+    works on the tasks it most recently created first. When its deque is
+    empty, it steals the oldest task from the front of another deque. Tasks
+    added by any other thread go on a shared deque that is also stolen from.
+    Task priorities are ignored.
+    """
+
+    def __init__(self):
+        # The deque operations we use are atomic, so the only thing the
+        # threads share is the count of queued tasks.
+        self._shared = collections.deque()
+        self._deques = [self._shared]
+        self._local = threading.local()
+        self._count = threading.Semaphore(0)
+
+    def register(self):
+        """Give the calling worker thread its own deque."""
+        self._local.deque = collections.deque()
+        self._deques.append(self._local.deque)
+
+    def put(self, item, block=True, timeout=None):
+        """Add an item to the current thread's deque."""
+        getattr(self._local, 'deque', self._shared).append(item)
+        self._count.release()
+
+    def get(self, block=True, timeout=None):
+        """Remove an item from the current thread's deque, or steal one from
+        another deque if it is empty."""
+
+        if not self._count.acquire(block, timeout):
+            raise queue.Empty
+
+        # Acquiring the count guarantees that there is an item waiting for us
+        # in one of the deques, even if another thread beats us to the first
+        # one we find.
+        own = getattr(self._local, 'deque', None)
+        while True:
+            if own is not None:
+                try:
+                    return own.pop()
+                except IndexError:
+                    pass
+
+            for d in self._deques:
+                try:
+                    return d.popleft()
+                except IndexError:
+                    pass
+
+    def task_done(self):
+        pass
+
 # ------------------------------------------------------------------------------
 
 class WorkerThread(threading.Thread):
@@ -338,6 +683,8 @@ class WorkerThread(threading.Thread):
         self.__finished = True
 
     def run(self):
+        self.__ready_queue.register()
+
         try:
             while not self.__finished:
                 with self.__logger.log_from_thread():
@@ -390,10 +737,12 @@ class Task:
         self.function = function
         self.src = src
         self.index = index
+        self.priority = 0
         self.running = False
         self.done = False
         self.dependencies = []
         self.exc = None
+        self.duration = None
 
     def can_run(self):
         """Returns True if all of this task's dependencies are done. Otherwise
@@ -410,7 +759,31 @@ class Task:
     def run(self):
         """Run the task's function."""
 
+        starttime = time.time()
         try:
             self.result = self.function(self.src)
         except Exception as e:
             self.exc = e
+        finally:
+            self.duration = time.time() - starttime
+
+# ------------------------------------------------------------------------------
+
+def _function_name(function):
+    """Return a name for the function that is stable between builds, so that
+    we can find a task's statistics from a previous build."""
+
+    while isinstance(function, functools.partial):
+        function = function.func
+
+    # Cached method wrappers hold onto the real bound method.
+    function = getattr(function, 'method', function)
+
+    owner = getattr(function, '__self__', None)
+    if owner is not None and not isinstance(owner, types.ModuleType):
+        return '%s.%s' % (type(owner).__qualname__, function.__name__)
+
+    try:
+        return function.__qualname__
+    except AttributeError:
+        return type(function).__qualname__
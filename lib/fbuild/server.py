@@ -0,0 +1,273 @@
+"""
+A build server that keeps the context, database and scheduler of a build
+loaded between builds. Clients hand it their command line and print the
+output it sends back.
+
+This module is imported by clients before anything else of fbuild's, so it
+should only import what it needs to talk to the server at the top level.
+"""
+
+import os
+import sys
+import threading
+import time
+import traceback
+
+from multiprocessing.connection import Client, Listener
+
+import fbuild
+
+# The name of the server's socket in the buildroot.
+SOCKET_NAME = 'fbuild.sock'
+
+# ------------------------------------------------------------------------------
+
+def socket_path(argv):
+    """Returns the path of the server socket for the buildroot named in the
+    command line arguments."""
+
+    buildroot = 'build'
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == '--buildroot':
+            buildroot = next(args, buildroot)
+        elif arg.startswith('--buildroot='):
+            buildroot = arg[len('--buildroot='):]
+
+    return os.path.join(buildroot, SOCKET_NAME)
+
+# ------------------------------------------------------------------------------
+
+def request(argv, *, timeout=60):
+    """
+    Run the build described by the command line arguments in the build
+    server, and return its exit code. Returns None if there is no server, in
+    which case the caller should build by itself.
+    """
+
+    if sys.platform == 'win32' or '--serve' in argv or '--no-server' in argv:
+        return None
+
+    address = socket_path(argv)
+    if not os.path.exists(address):
+        return None
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            conn = Client(address, family='AF_UNIX')
+        except (ConnectionRefusedError, FileNotFoundError):
+            # The server is gone, or it's still restarting.
+            if time.time() > deadline or not _is_restarting(address):
+                return None
+            time.sleep(0.1)
+            continue
+
+        with conn:
+            conn.send({'argv': argv[1:], 'cwd': os.getcwd()})
+
+            while True:
+                try:
+                    kind, value = conn.recv()
+                except EOFError:
+                    sys.stderr.write('build server exited unexpectedly\n')
+                    return 1
+
+                if kind == 'stdout':
+                    sys.stdout.write(value)
+                    sys.stdout.flush()
+                elif kind == 'stderr':
+                    sys.stderr.write(value)
+                    sys.stderr.flush()
+                elif kind == 'exit':
+                    return value
+                elif kind == 'restart':
+                    break
+
+        # The build scripts changed, so the server is starting over. Wait
+        # for it to come back and try again.
+        time.sleep(0.1)
+
+def _is_restarting(address):
+    return os.path.exists(address + '.restart')
+
+# ------------------------------------------------------------------------------
+
+class _ConnectionWriter:
+    """A file-like object that sends what is written to it to the client."""
+
+    def __init__(self, conn, kind):
+        self._conn = conn
+        self._kind = kind
+        self._lock = threading.Lock()
+
+    def write(self, s):
+        with self._lock:
+            try:
+                self._conn.send((self._kind, s))
+            except OSError:
+                # The client went away. Keep building anyway so that the
+                # results are cached.
+                pass
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+# ------------------------------------------------------------------------------
+
+def serve(ctx, args, parse_options, build):
+    """
+    Serve build requests until we're told to stop. I{args} are the parsed
+    command line options the server was started with. Requests are parsed
+    with I{parse_options}, and have to match them except for the targets,
+    which are run with I{build}. Returns True if the server needs to be
+    restarted because the build scripts changed.
+    """
+
+    address = ctx.buildroot / SOCKET_NAME
+    restart_marker = address + '.restart'
+
+    # Remove the socket of a server that died.
+    if address.exists():
+        address.remove()
+
+    scripts = _script_mtimes()
+    options = _comparable_options(args)
+
+    listener = Listener(address, family='AF_UNIX')
+    ctx.logger.log('serving builds on %s' % address, color='cyan')
+
+    if restart_marker.exists():
+        restart_marker.remove()
+
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except KeyboardInterrupt:
+                return False
+
+            with conn:
+                try:
+                    req = conn.recv()
+                except EOFError:
+                    continue
+
+                if '--stop-server' in req['argv']:
+                    conn.send(('exit', 0))
+                    return False
+
+                if any(_mtime(path) != mtime
+                        for path, mtime in scripts.items()):
+                    # We can't reload the build scripts in place, so let the
+                    # client wait for us to start over.
+                    open(restart_marker, 'w').close()
+                    conn.send(('restart', None))
+                    return True
+
+                conn.send(('exit',
+                    _serve_request(ctx, conn, options, parse_options, build,
+                        req)))
+    finally:
+        listener.close()
+        if address.exists():
+            address.remove()
+
+def _serve_request(ctx, conn, options, parse_options, build, req):
+    stdout = sys.stdout
+    stderr = sys.stderr
+    sys.stdout = _ConnectionWriter(conn, 'stdout')
+    sys.stderr = _ConnectionWriter(conn, 'stderr')
+    try:
+        if req['cwd'] != os.getcwd():
+            print('the build server is running in %s' % os.getcwd(),
+                file=sys.stderr)
+            return 1
+
+        try:
+            args = parse_options(['fbuild'] + req['argv'])
+        except SystemExit as e:
+            # The arguments were bad, or we printed the help.
+            return e.code
+
+        if _comparable_options(args) != options:
+            print('the build server was started with different options, '
+                'stop it with --stop-server first', file=sys.stderr)
+            return 1
+
+        ctx.options.targets = args.targets
+
+        # Start the build over like a new process would.
+        if ctx.logger.file:
+            ctx.logger.file.close()
+        ctx.create_buildroot()
+        ctx.db.forget_files()
+        _reset_counters(ctx)
+
+        try:
+            build(ctx)
+        except fbuild.Error as e:
+            ctx.logger.log(e, color='red')
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        else:
+            ctx.clear_temp_dir()
+            return 0
+        finally:
+            # Save what we built, since the server may be killed rather than
+            # stopped.
+            ctx.save_configuration(close=False)
+    finally:
+        sys.stdout = stdout
+        sys.stderr = stderr
+
+def _reset_counters(ctx):
+    """Zero the counters that the build reports at the end, so that every
+    request only reports its own build."""
+
+    ctx.logger.reset()
+    ctx.scheduler.idle_waits = 0
+
+    if ctx.db.artifact_cache is not None:
+        ctx.db.artifact_cache.hits = 0
+        ctx.db.artifact_cache.remote_hits = 0
+        ctx.db.artifact_cache.misses = 0
+
+    if ctx.config_cache is not None:
+        ctx.config_cache.hits = 0
+        ctx.config_cache.misses = 0
+
+def _comparable_options(args):
+    """Returns the options that have to be the same for the server to run a
+    request."""
+
+    options = dict(vars(args))
+    for name in ('targets', 'serve', 'no_server', 'stop_server'):
+        options.pop(name, None)
+
+    return options
+
+def _script_mtimes():
+    """Returns the modification times of the modules loaded from the current
+    directory, like the fbuildroot."""
+
+    cwd = os.getcwd()
+    mtimes = {}
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if path and os.path.abspath(path).startswith(cwd + os.sep):
+            mtimes[path] = _mtime(path)
+
+    return mtimes
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
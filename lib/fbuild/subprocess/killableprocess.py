@@ -205,10 +205,34 @@ class Popen(subprocess.Popen):
                     raise
             self.returncode = -9
 
+    # The resource usage of the process once it exits, if we know it.
+    rusage = None
+
+    @property
+    def peak_rss(self):
+        """The peak resident set size of the exited process in bytes, or None
+        if it is not known."""
+        if self.rusage is None:
+            return None
+        elif sys.platform == 'darwin':
+            return self.rusage.ru_maxrss
+        else:
+            return self.rusage.ru_maxrss * 1024
+
     def _try_wait(self, wait_flags):
         if wait_flags == 0:
             wait_flags = os.WUNTRACED
-        return subprocess.Popen._try_wait(self, wait_flags)
+
+        # Use wait4 so we can record how much memory the process used.
+        try:
+            pid, sts, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return subprocess.Popen._try_wait(self, wait_flags)
+
+        if pid == self.pid:
+            self.rusage = rusage
+
+        return pid, sts
 
     def wait(self, timeout=-1, group=True):
         """Wait for the process to terminate. Returns returncode attribute.
@@ -1,4 +1,5 @@
 import contextlib
+import re
 import tempfile as _tempfile
 import textwrap
 import os
@@ -16,6 +17,18 @@ def set_default_tempdir(tmp):
     global _default_tempdir
     _default_tempdir = Path(tmp).abspath()
 
+def strip_tempdirs(string):
+    '''
+    Replace the unique directories made in the default temporary directory
+    with a placeholder, so that strings that name temporary files, such as
+    commands, stay the same from run to run.
+    '''
+    if _default_tempdir is None:
+        return string
+
+    return re.sub(re.escape(_default_tempdir + os.sep) + r'[^\s/\\\'"]+',
+        '<tmp>', string)
+
 # ------------------------------------------------------------------------------
 
 @contextlib.contextmanager
@@ -0,0 +1,136 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+
+import fbuild
+
+# ------------------------------------------------------------------------------
+
+# The inotify events we care about. See inotify(7).
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | \
+    _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF
+
+# The header of a struct inotify_event, which is followed by the name.
+_EVENT = struct.Struct('iIII')
+
+# ------------------------------------------------------------------------------
+
+class Watcher:
+    """
+    Watch files for changes with Linux's inotify. Rather than watching every
+    file, which could run into the kernel's limit on watches, we watch the
+    directories that hold the files, and ignore the events for any other
+    files in them.
+    """
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise fbuild.Error('watching files needs linux inotify')
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        self._libc = libc
+        self._fd = libc.inotify_init1(_IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self._lock = threading.Lock()
+
+        # The watched file names, and the directory names we found them under
+        # for each watch descriptor.
+        self._files = set()
+        self._dirs = {}
+        self._watches = {}
+
+        # The files we failed to watch.
+        self.unwatched = set()
+
+    def add(self, file_name):
+        """Start watching the file."""
+
+        dirname = os.path.dirname(file_name)
+
+        with self._lock:
+            self._files.add(file_name)
+
+            if dirname in self._dirs:
+                return
+
+            wd = self._libc.inotify_add_watch(self._fd,
+                os.fsencode(dirname or os.curdir), _WATCH_MASK)
+            if wd < 0:
+                # We won't hear about this file changing, so it has to be
+                # checked again every build.
+                self.unwatched.add(file_name)
+                return
+
+            self._dirs[dirname] = wd
+            self._watches.setdefault(wd, set()).add(dirname)
+
+    def read_changes(self, timeout=None):
+        """
+        Wait up to I{timeout} seconds for changes, and return the set of the
+        watched files that changed. Returns None if the kernel dropped events,
+        in which case any file could have changed.
+        """
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        data = os.read(self._fd, 65536)
+
+        changes = set()
+        with self._lock:
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & _IN_Q_OVERFLOW:
+                    return None
+
+                dirnames = self._watches.get(wd, ())
+
+                if mask & (_IN_IGNORED | _IN_DELETE_SELF | _IN_MOVE_SELF):
+                    # The directory itself went away, so every file in it
+                    # changed. The watch is added again when we next see one.
+                    for dirname in self._watches.pop(wd, ()):
+                        del self._dirs[dirname]
+                        changes.update(f for f in self._files
+                            if os.path.dirname(f) == dirname)
+
+                    # A moved directory is still watched under its new name.
+                    if mask & _IN_MOVE_SELF:
+                        self._libc.inotify_rm_watch(self._fd, wd)
+                    continue
+
+                for dirname in dirnames:
+                    file_name = os.path.join(dirname, os.fsdecode(name))
+                    if file_name in self._files:
+                        changes.add(file_name)
+
+        return changes
+
+    def close(self):
+        os.close(self._fd)
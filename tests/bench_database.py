@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""Measure how long a build takes to cache new calls, and how long a no-op
+build takes to look them up again, for each database engine, with the
+database in its own thread or inline."""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), '..', 'lib'))
+
+import fbuild.context
+import fbuild.db
+
+# -----------------------------------------------------------------------------
+
+@fbuild.db.caches
+def square(ctx, x):
+    return x * x
+
+def make_context(buildroot, threads, engine, inline):
+    args = ['--buildroot', buildroot, '--database-engine', engine,
+        '-j', str(threads)]
+    if inline:
+        args.append('--inline-database')
+
+    ctx = fbuild.context.make_default_context(args)
+    ctx.create_buildroot()
+    ctx.load_configuration()
+
+    return ctx
+
+def build(ctx, calls):
+    ctx.scheduler.map(lambda x: square(ctx, x), range(calls))
+
+def bench(threads, calls, *, engine, inline):
+    with tempfile.TemporaryDirectory() as buildroot:
+        # The first build fills up the database.
+        ctx = make_context(buildroot, threads, engine, inline)
+        try:
+            start = time.perf_counter()
+            build(ctx, calls)
+            ctx.save_configuration()
+            fill = time.perf_counter() - start
+        finally:
+            ctx.db.shutdown()
+            ctx.scheduler.shutdown()
+
+        # The second one only has to look up the cached calls.
+        ctx = make_context(buildroot, threads, engine, inline)
+        try:
+            start = time.perf_counter()
+            build(ctx, calls)
+            return fill, time.perf_counter() - start
+        finally:
+            ctx.db.shutdown()
+            ctx.scheduler.shutdown()
+
+# -----------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=50000,
+        help='the number of calls to cache and look up')
+    parser.add_argument('--threads', type=int, nargs='*', default=[1, 4, 16],
+        help='the thread counts to measure')
+    parser.add_argument('--engines', nargs='*', choices=('pickle', 'sqlite'),
+        default=['pickle', 'sqlite'],
+        help='the database engines to measure')
+    args = parser.parse_args()
+
+    print('%8s %8s %8s %16s %16s' % (
+        'engine', 'threads', 'database', 'fill us/call', 'lookup us/call'))
+    for engine in args.engines:
+        for threads in args.threads:
+            for inline in (False, True):
+                fill, lookup = bench(threads, args.calls, engine=engine,
+                    inline=inline)
+
+                print('%8s %8d %8s %16.2f %16.2f' % (
+                    engine,
+                    threads,
+                    'inline' if inline else 'thread',
+                    fill * 1e6 / args.calls,
+                    lookup * 1e6 / args.calls))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
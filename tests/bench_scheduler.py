@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""Measure how the scheduler's dispatch overhead scales with the number of
+threads, for both the shared ready queue and the work stealing queues."""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), '..', 'lib'))
+
+from fbuild.sched import Scheduler
+
+# -----------------------------------------------------------------------------
+
+def noop(x):
+    return x
+
+def nested(scheduler, n):
+    def f(x):
+        return scheduler.map(noop, range(n))
+    return f
+
+def bench(threads, tasks, *, work_stealing, nesting):
+    scheduler = Scheduler(threads, work_stealing=work_stealing)
+    try:
+        start = time.perf_counter()
+        if nesting:
+            scheduler.map(nested(scheduler, nesting), range(tasks // nesting))
+        else:
+            scheduler.map(noop, range(tasks))
+        return time.perf_counter() - start
+    finally:
+        scheduler.shutdown()
+
+# -----------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tasks', type=int, default=20000,
+        help='the number of tasks to dispatch')
+    parser.add_argument('--nesting', type=int, default=0,
+        help='dispatch the tasks from nested maps of this size')
+    parser.add_argument('--threads', type=int, nargs='*',
+        default=[1, 2, 4, 8, 16, 32, 64],
+        help='the thread counts to measure')
+    args = parser.parse_args()
+
+    print('%8s %16s %16s' % ('threads', 'shared us/task', 'stealing us/task'))
+    for threads in args.threads:
+        shared, stealing = [
+            bench(threads, args.tasks,
+                work_stealing=work_stealing,
+                nesting=args.nesting) * 1e6 / args.tasks
+            for work_stealing in (False, True)]
+
+        print('%8d %16.2f %16.2f' % (threads, shared, stealing))
+
+    return 0
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,10 +7,20 @@ import unittest
 
 sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), '..', 'lib'))
 
+import test_artifact_cache
+import test_config
+import test_config_cache
+import test_context
+import test_database
 import test_fnmatch
 import test_functools
 import test_glob
+import test_jobserver
+import test_remote_cache
+import test_rpc
 import test_scheduler
+import test_server
+import test_watch
 
 # -----------------------------------------------------------------------------
 
@@ -42,10 +52,20 @@ def main():
             else:
                 suite.addTest(test)
 
+    suite.addTest(test_artifact_cache.suite())
+    suite.addTest(test_config.suite())
+    suite.addTest(test_config_cache.suite())
+    suite.addTest(test_context.suite())
+    suite.addTest(test_database.suite())
     suite.addTest(test_fnmatch.suite())
     suite.addTest(test_functools.suite())
     suite.addTest(test_glob.suite())
+    suite.addTest(test_jobserver.suite())
+    suite.addTest(test_remote_cache.suite())
+    suite.addTest(test_rpc.suite())
     suite.addTest(test_scheduler.suite())
+    suite.addTest(test_server.suite())
+    suite.addTest(test_watch.suite())
 
     runner = unittest.TextTestRunner(verbosity=2)
     runner.run(suite)
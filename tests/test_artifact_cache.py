@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import fbuild.context
+from fbuild.db.artifact_cache import Artifact, ArtifactCache
+
+# -----------------------------------------------------------------------------
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ctx = fbuild.context.make_default_context(
+            ['--buildroot', self.tmpdir.name])
+        self.cache = ArtifactCache(self.ctx,
+            os.path.join(self.tmpdir.name, 'cache'),
+            max_size=10000)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, contents):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def artifact(self, dsts, result=None, bound={'x': 1}):
+        return Artifact(
+            bound=bound,
+            result=result,
+            dsts=dsts,
+            external_srcs={},
+            external_dsts=[],
+            fun_dependents={})
+
+    def testKey(self):
+        key = self.cache.key('f', 'digest', 'args', {'a': '1', 'b': '2'})
+
+        self.assertEqual(key,
+            self.cache.key('f', 'digest', 'args', {'b': '2', 'a': '1'}))
+        self.assertNotEqual(key,
+            self.cache.key('f', 'digest', 'args', {'a': '1', 'b': '3'}))
+        self.assertNotEqual(key,
+            self.cache.key('g', 'digest', 'args', {'a': '1', 'b': '2'}))
+
+    def testStoreFetch(self):
+        dst = self.write('a.o', 'a')
+        key = self.cache.key('f', 'digest', 'args', {})
+
+        self.assertEqual(self.cache.fetch(key, {'x': 1}, lambda artifact: True), None)
+        self.assertTrue(self.cache.store(key, self.artifact([dst], dst)))
+
+        # We already have it.
+        self.assertFalse(self.cache.store(key, self.artifact([dst], dst)))
+
+        os.remove(dst)
+        artifact = self.cache.fetch(key, {'x': 1}, lambda artifact: True)
+        self.assertEqual(artifact.result, dst)
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'a')
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def testInvalid(self):
+        dst = self.write('a.o', 'a')
+        key = self.cache.key('f', 'digest', 'args', {})
+        self.cache.store(key, self.artifact([dst]))
+
+        os.remove(dst)
+        self.assertEqual(self.cache.fetch(key, {'x': 1}, lambda artifact: False), None)
+        self.assertFalse(os.path.exists(dst))
+
+    def testOtherArguments(self):
+        dst = self.write('a.o', 'a')
+        key = self.cache.key('f', 'digest', 'args', {})
+        self.cache.store(key, self.artifact([dst], bound={'x': 1}))
+
+        # Arguments that happen to share the key don't get the artifact.
+        os.remove(dst)
+        self.assertEqual(
+            self.cache.fetch(key, {'x': 2}, lambda artifact: True), None)
+        self.assertFalse(os.path.exists(dst))
+
+    def testMissingDst(self):
+        key = self.cache.key('f', 'digest', 'args', {})
+        dst = os.path.join(self.tmpdir.name, 'missing.o')
+
+        self.assertFalse(self.cache.store(key, self.artifact([dst])))
+
+    def testEvict(self):
+        keys = []
+        for i in range(5):
+            dst = self.write('%d.o' % i, str(i) * 3000)
+            key = self.cache.key('f', 'digest', str(i), {})
+            self.cache.store(key, self.artifact([dst]))
+            keys.append(key)
+
+            # Use the first one so that it isn't evicted.
+            self.cache.fetch(keys[0], {'x': 1}, lambda artifact: True)
+
+        found = [self.cache.fetch(key, {'x': 1}, lambda artifact: True) is not None
+            for key in keys]
+        self.assertEqual(found, [True, False, False, True, True])
+
+# -----------------------------------------------------------------------------
+
+def suite(*args, **kwargs):
+    return unittest.TestLoader().loadTestsFromTestCase(TestArtifactCache)
+
+if __name__ == "__main__":
+    unittest.main()
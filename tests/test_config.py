@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import contextlib
+import re
+import tempfile
+import threading
+import unittest
+
+import fbuild
+import fbuild.config
+import fbuild.config.c
+import fbuild.context
+from fbuild.config.c import cacheproperty
+from fbuild.path import Path
+
+# -----------------------------------------------------------------------------
+
+calls = []
+calls_lock = threading.Lock()
+
+def record(name):
+    with calls_lock:
+        calls.append(name)
+
+class HeaderTest(fbuild.config.Test):
+    prefetch_first = ('header',)
+
+    @cacheproperty
+    def header(self):
+        record('header')
+        return True
+
+    @cacheproperty
+    def a(self):
+        record('a')
+        return 'a' if self.header else None
+
+    @cacheproperty
+    def b(self):
+        record('b')
+        return 'b' if self.header else None
+
+# -----------------------------------------------------------------------------
+
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ctx = fbuild.context.make_default_context(
+            ['--buildroot', self.tmpdir.name,
+             '--database-engine', 'cache',
+             '-j', '2'])
+        self.ctx.db.connect()
+        del calls[:]
+
+    def tearDown(self):
+        self.ctx.db.shutdown()
+        self.ctx.scheduler.shutdown()
+        self.tmpdir.cleanup()
+
+    def testPrefetch(self):
+        test = HeaderTest(self.ctx)
+
+        self.assertIs(test.prefetch(), test)
+        self.assertEqual(calls[0], 'header')
+        self.assertEqual(sorted(calls), ['a', 'b', 'header'])
+
+        # The fields are now cached.
+        self.assertEqual((test.header, test.a, test.b), (True, 'a', 'b'))
+        self.assertEqual(len(calls), 3)
+
+    def testPrefetchMany(self):
+        fbuild.config.prefetch([HeaderTest(self.ctx)])
+        fbuild.config.prefetch([])
+
+        self.assertEqual(sorted(calls), ['a', 'b', 'header'])
+
+# -----------------------------------------------------------------------------
+
+class TestAddRoot(unittest.TestCase):
+    def testTempfile(self):
+        # Temporary files in the buildroot keep their own directory, so
+        # concurrent tests don't write over each other's files.
+        root = Path('build')
+        path = root.abspath() / '.tmp' / 'tmp1234' / 'temp.c'
+
+        self.assertEqual(path.addroot(root), path)
+        self.assertEqual(Path('/elsewhere/temp.c').addroot(root),
+            Path('build/temp.c'))
+
+# -----------------------------------------------------------------------------
+
+class ProbeBuilder:
+    """Pretend to build the programs. Programs that mention "missing" don't
+    compile, and each type is 8 bytes wide and aligned."""
+
+    cross_compiler = False
+
+    def __init__(self):
+        self.programs = []
+        self.headers = []
+
+    def precompile_header(self, headers):
+        self.headers.append(headers)
+        if 'missing.h' in headers:
+            raise fbuild.ExecutionError()
+        return ['-include', 'pch.h']
+
+    @contextlib.contextmanager
+    def tempfile_compile(self, code, **kwargs):
+        self.programs.append(('compile', code))
+        self.flags = kwargs.get('flags')
+        if 'missing' in code:
+            raise fbuild.ExecutionError()
+
+        # Check the compile time assertions.
+        for expr, value in re.findall(r'\[\((.*) <= (\d+)\) \? 1 : -1\]',
+                code):
+            if 8 > int(value):
+                raise fbuild.ExecutionError()
+        yield
+
+    @contextlib.contextmanager
+    def tempfile_link_exe(self, code, **kwargs):
+        self.programs.append(('link', code))
+        if 'missing' in code:
+            raise fbuild.ExecutionError()
+        yield
+
+    def tempfile_run(self, code, **kwargs):
+        self.programs.append(('run', code))
+        if 'missing' in code:
+            raise fbuild.ExecutionError()
+        return b'8\n8\n' * code.count('typedef'), b''
+
+class ProbeTest(fbuild.config.c.Test):
+    a = fbuild.config.c.macro_test()
+    b = fbuild.config.c.type_test(name='int')
+    missing = fbuild.config.c.macro_test()
+    c = fbuild.config.c.function_test('int', 'int')
+    d = fbuild.config.c.type_test(name='long')
+    e = fbuild.config.c.macro_test(test='int main() { return 0; }')
+
+class TestProbeBatch(unittest.TestCase):
+    def setUp(self):
+        # Skip the constructor, which would run the tests through the db.
+        self.test = object.__new__(ProbeTest)
+        self.test.builder = ProbeBuilder()
+        self.test.flags = []
+        self.test.libpaths = []
+        self.test.libs = []
+        self.test.external_libs = []
+
+        self.batch = fbuild.config.c.ProbeBatch(self.test, 'test.h')
+
+    def run_probe(self, name):
+        return self.batch.run(getattr(ProbeTest, name).method)
+
+    def testBatch(self):
+        self.assertEqual(self.run_probe('a'), b'')
+        self.assertEqual(self.run_probe('b'), b'8\n8\n')
+        self.assertIsNone(self.run_probe('missing'))
+        self.assertEqual(self.run_probe('c'), b'')
+        self.assertEqual(self.run_probe('d'), b'8\n8\n')
+
+        # The macros are only compiled, and the failed program is split
+        # until the missing macro is found. The types include other headers
+        # and are run, and the function is linked.
+        self.assertEqual(
+            [stage for stage, code in self.test.builder.programs],
+            ['compile', 'compile', 'compile', 'run', 'link'])
+        self.assertEqual(self.batch.programs, 5)
+
+    def testCrossCompiler(self):
+        self.test.builder.cross_compiler = True
+
+        # The types aren't batched, since they can't be run.
+        self.assertEqual(self.run_probe('a'), b'')
+        self.assertNotIn('run',
+            [stage for stage, code in self.test.builder.programs])
+        self.assertRaises(KeyError, self.run_probe, 'b')
+
+        # Their alignment and size are found at compile time instead.
+        self.assertEqual(
+            ProbeTest.b.method.compute_stdout(self.test, 'test.h'),
+            b'8\n8\n')
+        self.assertEqual(
+            ProbeTest.e.method.compute_stdout(self.test, 'test.h'),
+            None)
+
+    def testPrecompileHeaders(self):
+        self.test.precompile_headers = True
+        builder = self.test.builder
+
+        fbuild.config.c._run_test(self.test, '', fbuild.config.c.COMPILE,
+            headers=('stdio.h', 'test.h'))
+        self.assertEqual(builder.headers, [('stdio.h', 'test.h')])
+        self.assertEqual(builder.flags, ['-include', 'pch.h'])
+
+        # Headers that fail to precompile are included as usual, and aren't
+        # tried again.
+        for i in range(2):
+            fbuild.config.c._run_test(self.test, '', fbuild.config.c.COMPILE,
+                headers=('missing.h',))
+            self.assertIsNone(builder.flags)
+        self.assertEqual(builder.headers,
+            [('stdio.h', 'test.h'), ('missing.h',)])
+
+    def testFormatProgram(self):
+        code = self.batch.format_program([ProbeTest.a.method,
+            ProbeTest.c.method])
+
+        self.assertTrue(code.startswith('#include <test.h>\n'))
+        self.assertIn('static void fbuild_probe_0(void) {', code)
+        self.assertIn('#ifndef a', code)
+        self.assertIn('int res = c(arg_0);', code)
+        self.assertEqual(code.count('int main()'), 1)
+
+    def testBatchable(self):
+        self.assertTrue(ProbeTest.a.method.batchable)
+        self.assertFalse(ProbeTest.e.method.batchable)
+        self.assertFalse(fbuild.config.c.header_test('test.h').batchable)
+
+# -----------------------------------------------------------------------------
+
+def suite(*args, **kwargs):
+    return unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(TestPrefetch),
+        unittest.TestLoader().loadTestsFromTestCase(TestAddRoot),
+        unittest.TestLoader().loadTestsFromTestCase(TestProbeBatch),
+    ])
+
+if __name__ == "__main__":
+    unittest.main()
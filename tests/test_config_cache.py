@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import fbuild.config.c
+import fbuild.context
+from fbuild.config.cache import ConfigCache, digest_field
+
+# -----------------------------------------------------------------------------
+
+calls = []
+
+class Builder:
+    def __init__(self, ctx, fingerprint='gcc'):
+        self.ctx = ctx
+        self._fingerprint = fingerprint
+
+    def __eq__(self, other):
+        # The database stores copies of the tests and their builders.
+        return isinstance(other, Builder) and \
+            self._fingerprint == other._fingerprint
+
+    def __hash__(self):
+        return hash(self._fingerprint)
+
+    def fingerprint(self):
+        return self._fingerprint
+
+class unpicklable_test(fbuild.config.c.AbstractFieldDescriptor):
+    def __init__(self):
+        super().__init__()
+        self.function = lambda: 'b'
+
+    def __call__(self, instance):
+        calls.append('b')
+        return self.function()
+
+class CountTest(fbuild.config.c.Test):
+    @fbuild.config.c.cacheproperty
+    def a(self):
+        calls.append('a')
+        return 'a'
+
+    b = unpicklable_test()
+
+# -----------------------------------------------------------------------------
+
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmpdir.name, 'config')
+        self.contexts = []
+        del calls[:]
+
+    def tearDown(self):
+        for ctx in self.contexts:
+            ctx.db.shutdown()
+            ctx.scheduler.shutdown()
+        self.tmpdir.cleanup()
+
+    def make_context(self, *args):
+        ctx = fbuild.context.make_default_context(
+            ['--buildroot', os.path.join(self.tmpdir.name, 'build'),
+             '--database-engine', 'cache',
+             '--config-cache', self.directory] + list(args))
+        ctx.db.connect()
+        self.contexts.append(ctx)
+        return ctx
+
+    def make_test(self, ctx, **kwargs):
+        return CountTest(Builder(ctx, **kwargs), platform={'posix'})
+
+    def testGetPut(self):
+        cache = ConfigCache(self.directory)
+        method = CountTest.a.method
+
+        self.assertRaises(KeyError, cache.get, 'key', 'a', method)
+        self.assertTrue(cache.put('key', 'a', method, 5))
+        self.assertEqual(cache.get('key', 'a', method), 5)
+
+        # Other caches read the file.
+        self.assertEqual(ConfigCache(self.directory).get('key', 'a', method),
+            5)
+
+        # The cache isn't read when we test again.
+        cache = ConfigCache(self.directory, read=False)
+        self.assertRaises(KeyError, cache.get, 'key', 'a', method)
+
+    def testDigestField(self):
+        # Descriptors with different arguments have different digests.
+        a = fbuild.config.c.function_test('int', 'int', attribute='f')
+        b = fbuild.config.c.function_test('int', 'long', attribute='f')
+        self.assertNotEqual(digest_field(a), digest_field(b))
+
+        c = fbuild.config.c.function_test('int', 'int', attribute='f')
+        self.assertEqual(digest_field(a), digest_field(c))
+
+    def testShareBetweenBuilds(self):
+        self.assertEqual(self.make_test(self.make_context()).a, 'a')
+        self.assertEqual(calls, ['a'])
+
+        # A fresh build with the same toolchain doesn't test again.
+        self.assertEqual(self.make_test(self.make_context()).a, 'a')
+        self.assertEqual(calls, ['a'])
+
+        # A different toolchain does.
+        test = self.make_test(self.make_context(), fingerprint='clang')
+        self.assertEqual(test.a, 'a')
+        self.assertEqual(calls, ['a', 'a'])
+
+        # So does rebuilding.
+        self.assertEqual(self.make_test(self.make_context('--rebuild')).a, 'a')
+        self.assertEqual(calls, ['a', 'a', 'a'])
+
+    def testPutUnchanged(self):
+        cache = ConfigCache(self.directory)
+        method = CountTest.a.method
+
+        cache.put('key', 'a', method, 5)
+        path = cache._path('key')
+        stat = os.stat(path)
+
+        # The file isn't written again if the result didn't change.
+        cache.put('key', 'a', method, 5)
+        self.assertEqual(os.stat(path).st_ino, stat.st_ino)
+
+        cache.put('key', 'a', method, 6)
+        self.assertNotEqual(os.stat(path).st_ino, stat.st_ino)
+
+    def testDatabaseFirst(self):
+        ctx = self.make_context()
+        test = self.make_test(ctx)
+        self.assertEqual(test.a, 'a')
+
+        # The project's database has the field, so the config cache isn't
+        # looked at again.
+        self.assertEqual(test.a, 'a')
+        self.assertEqual((ctx.config_cache.hits, ctx.config_cache.misses),
+            (0, 1))
+
+        # A hit in the config cache is saved in the project's database.
+        ctx = self.make_context()
+        test = self.make_test(ctx)
+        self.assertEqual(test.a, 'a')
+        self.assertEqual(test.a, 'a')
+        self.assertEqual((ctx.config_cache.hits, ctx.config_cache.misses),
+            (1, 0))
+        self.assertEqual(calls, ['a'])
+
+    def testUnpicklableField(self):
+        self.assertIsNone(digest_field(CountTest.b.method))
+
+        # The field is still tested and cached by the project's database.
+        ctx = self.make_context()
+        test = self.make_test(ctx)
+        self.assertEqual(test.b, 'b')
+        self.assertEqual(test.b, 'b')
+        self.assertEqual(calls, ['b'])
+
+        self.assertEqual(self.make_test(self.make_context()).b, 'b')
+        self.assertEqual(calls, ['b', 'b'])
+
+    def testProbeCode(self):
+        test = self.make_test(self.make_context())
+        key = test.config_cache_key()
+
+        # Changing how the tests are built changes their key.
+        digest = fbuild.config.c._digest_probes()
+        fbuild.config.c._probes_digest = 'changed'
+        try:
+            self.assertNotEqual(test.config_cache_key(), key)
+        finally:
+            fbuild.config.c._probes_digest = digest
+
+    def testUnsharedTests(self):
+        ctx = self.make_context()
+
+        self.assertIsNone(CountTest(Builder(ctx, fingerprint=None),
+            platform={'posix'}).config_cache_key())
+        self.assertIsNone(CountTest(Builder(ctx),
+            platform={'posix'},
+            libs=['build/libfoo.a']).config_cache_key())
+
+# -----------------------------------------------------------------------------
+
+def suite(*args, **kwargs):
+    return unittest.TestLoader().loadTestsFromTestCase(TestConfigCache)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import sys
+import tempfile
+import unittest
+
+import fbuild.context
+import fbuild.subprocess
+import fbuild.temp
+from fbuild.subprocess.killableprocess import Popen
+
+# -----------------------------------------------------------------------------
+
+# A command that holds on to about 64MB of memory.
+ALLOCATE = [sys.executable, '-c', 'x=bytearray(64<<20)']
+
+class TestPeakRSS(unittest.TestCase):
+    def testWait(self):
+        p = Popen(ALLOCATE)
+        self.assertIsNone(p.peak_rss)
+        self.assertEqual(p.wait(), 0)
+
+        self.assertGreaterEqual(p.peak_rss, 64 << 20)
+
+    def testCommunicate(self):
+        p = Popen([sys.executable, '-c', 'print(1)'],
+            stdout=fbuild.subprocess.PIPE)
+        stdout, stderr = p.communicate()
+
+        self.assertEqual(stdout.strip(), b'1')
+        self.assertGreater(p.peak_rss, 0)
+
+class TestExecute(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ctx = fbuild.context.make_default_context(
+            ['--buildroot', self.tmpdir.name, '--memory-budget', '1024'])
+        self.ctx.tmpdir.makedirs()
+        self.budget = self.ctx.scheduler.memory_budget
+        self.task_stats = self.ctx.scheduler.task_stats
+
+    def tearDown(self):
+        self.ctx.scheduler.shutdown()
+        self.tmpdir.cleanup()
+
+    def testPeakRSS(self):
+        self.ctx.execute(ALLOCATE, quieter=1)
+
+        # The command's memory is remembered, and the budget is given back.
+        stats = self.task_stats['execute:' + ' '.join(ALLOCATE)]
+        self.assertGreaterEqual(stats['peak_rss'], 64 << 20)
+        self.assertEqual(self.budget.used, 0)
+
+    def testReserveLastPeakRSS(self):
+        cmd = [sys.executable, '-c', 'pass']
+        self.task_stats['execute:' + ' '.join(cmd)] = {'peak_rss': 100 << 20}
+
+        used = []
+        acquire = self.budget.acquire
+        def record(amount, *args, **kwargs):
+            used.append(amount)
+            return acquire(amount, *args, **kwargs)
+        self.budget.acquire = record
+
+        # The command reserves what it used last time, unless it's told how
+        # much it needs.
+        self.ctx.execute(cmd, quieter=1)
+        self.ctx.execute(cmd, quieter=1, memory=5)
+        self.assertEqual(used, [100 << 20, 5])
+
+    def testTemporaryFiles(self):
+        for i in range(2):
+            with fbuild.temp.tempfile('pass', '.py') as src:
+                self.ctx.execute([sys.executable, src], quieter=1)
+
+        # The commands named different temporary files, but they share their
+        # statistics.
+        self.assertEqual(
+            [key for key in self.task_stats if key.startswith('execute:')],
+            ['execute:%s <tmp>/temp.py' % sys.executable])
+
+# -----------------------------------------------------------------------------
+
+def suite(*args, **kwargs):
+    return unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(TestPeakRSS),
+        unittest.TestLoader().loadTestsFromTestCase(TestExecute),
+    ])
+
+if __name__ == "__main__":
+    unittest.main()
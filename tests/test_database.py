@@ -0,0 +1,585 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import fbuild.context
+import fbuild.db
+import fbuild.db.artifact_cache
+import fbuild.db.backend
+import fbuild.db.cache_backend
+import fbuild.db.pickle_backend
+import fbuild.db.sqlite_backend
+from fbuild.db.database import Database
+from fbuild.path import Path
+
+# -----------------------------------------------------------------------------
+
+class TestCacheBackend(unittest.TestCase):
+    backend_class = fbuild.db.cache_backend.CacheBackend
+    fun_name = 'test.f'
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ctx = fbuild.context.make_default_context(
+            ['--buildroot', self.tmpdir.name])
+        self.filename = os.path.join(self.tmpdir.name, 'state.db')
+        self.connect()
+
+    def tearDown(self):
+        self.backend.close()
+        self.tmpdir.cleanup()
+
+    def connect(self):
+        self.backend = self.backend_class(self.ctx)
+        self.backend.connect(self.filename)
+        self.fun_id = self.backend.save_function(None, self.fun_name, 'x', ())
+
+    def reconnect(self):
+        self.backend.close()
+        self.connect()
+
+    def find_call(self, bound):
+        dirty, call_id, result = self.backend.find_call(self.fun_id, bound)
+        return None if dirty else result
+
+    def testCallKey(self):
+        key = self.backend.call_key
+
+        # Arguments that compare equal need to have the same key.
+        self.assertEqual(key({'x': 1}), key({'x': 1.0}))
+        self.assertEqual(key({'x': 'a'}), key({'x': Path('a')}))
+        self.assertEqual(key({'x': {1, 2}}), key({'x': frozenset([2, 1])}))
+        self.assertEqual(key({'x': 1, 'y': 2}), key({'y': 2, 'x': 1}))
+        self.assertEqual(key({'ctx': self.ctx}), key({'ctx': self.ctx}))
+
+        self.assertNotEqual(key({'x': 1}), key({'x': 2}))
+        self.assertNotEqual(key({'x': [1]}), key({'x': (1,)}))
+
+    def testFindCall(self):
+        for i in range(10):
+            self.backend.save_call(None, self.fun_id,
+                {'ctx': self.ctx, 'x': i}, i * 2)
+
+        for i in range(10):
+            self.assertEqual(self.find_call({'ctx': self.ctx, 'x': i}), i * 2)
+        self.assertEqual(self.find_call({'ctx': self.ctx, 'x': 10}), None)
+
+    def testCollision(self):
+        # Objects we don't know how to compare all share a key, so they have
+        # to fall back on comparing the arguments.
+        a = object()
+        b = object()
+        self.backend.save_call(None, self.fun_id, {'x': a}, 1)
+        self.backend.save_call(None, self.fun_id, {'x': b}, 2)
+
+        self.assertEqual(self.find_call({'x': a}), 1)
+        self.assertEqual(self.find_call({'x': b}), 2)
+
+    def testUpdateCall(self):
+        call_id = self.backend.save_call(None, self.fun_id, {'x': 1}, 1)
+        self.backend.save_call(call_id, self.fun_id, {'x': 1}, 2)
+
+        self.assertEqual(self.find_call({'x': 1}), 2)
+
+    def testFileCache(self):
+        path = os.path.join(self.tmpdir.name, 'a.txt')
+        with open(path, 'w') as f:
+            print('a', file=f)
+
+        dirty, file_id, mtime, digest = self.backend.add_file(path)
+        self.assertTrue(dirty)
+
+        # We don't look at the file again until we're told we changed it.
+        with open(path, 'w') as f:
+            print('b', file=f)
+
+        self.assertEqual(self.backend.add_file(path),
+            (False, file_id, mtime, digest))
+
+        self.backend.invalidate_files([path])
+        dirty, file_id, mtime, new_digest = self.backend.add_file(path)
+        self.assertTrue(dirty)
+        self.assertNotEqual(digest, new_digest)
+
+    def testDigestAlgorithm(self):
+        path = os.path.join(self.tmpdir.name, 'a.txt')
+        with open(path, 'w') as f:
+            print('a', file=f)
+
+        dirty, file_id, mtime, digest = self.backend.add_file(path)
+
+        # Changing the algorithm rehashes the file even though the mtime is
+        # the same.
+        self.backend.digest_algorithm = 'blake2b'
+        self.backend.invalidate_files([path])
+        self.assertEqual(self.backend.find_changed_files([path]), [path])
+
+        dirty, file_id, mtime, new_digest = self.backend.add_file(path)
+        self.assertTrue(dirty)
+        self.assertTrue(new_digest.startswith('blake2b:'))
+
+    def testPrepareDigests(self):
+        # Pretend the function was registered with the database.
+        Database._FUN_DIGESTS.setdefault(self.fun_name, 'x')
+
+        path = os.path.join(self.tmpdir.name, 'a.txt')
+        with open(path, 'w') as f:
+            print('a', file=f)
+
+        # The caller has to hash new files.
+        with self.assertRaises(fbuild.db.backend.UnhashedFiles) as cm:
+            self.backend.prepare(self.fun_name, 'x', {}, {path}, set(), {})
+        self.assertEqual(cm.exception.file_names, [path])
+
+        digest = Path(path).digest()
+        prepared = self.backend.prepare(self.fun_name, 'x', {}, {path}, set(),
+            {path: digest})
+        self.assertEqual(self.backend.add_file(path)[3], digest)
+
+class TestPickleBackend(TestCacheBackend):
+    backend_class = fbuild.db.pickle_backend.PickleBackend
+
+    def connect(self):
+        super().connect()
+
+        # The function id is its name, so it's stable across connections.
+        self.fun_id = self.fun_name
+
+    def crash(self):
+        """Reconnect without closing the database."""
+        self.backend.flush()
+        self.backend._journal.close()
+        self.backend._journal = None
+        self.connect()
+
+    def testReconnect(self):
+        for i in range(10):
+            self.backend.save_call(None, self.fun_id, {'x': i}, i * 2)
+
+        self.reconnect()
+
+        for i in range(10):
+            self.assertEqual(self.find_call({'x': i}), i * 2)
+
+    def testJournal(self):
+        self.backend.save_call(None, self.fun_id, {'x': 1}, 2)
+
+        # Pretend we crashed while writing a record, and without closing the
+        # database.
+        self.backend._journal.write(b'\x80\x05\x95')
+        self.backend._journal.flush()
+        self.backend._journal.close()
+        self.backend._journal = None
+        self.connect()
+
+        self.assertEqual(self.find_call({'x': 1}), 2)
+
+        # The broken record is dropped so we can keep adding to the journal.
+        self.backend.save_call(None, self.fun_id, {'x': 2}, 4)
+        self.reconnect()
+
+        self.assertEqual(self.find_call({'x': 1}), 2)
+        self.assertEqual(self.find_call({'x': 2}), 4)
+
+    def testCompact(self):
+        size = os.path.getsize(self.filename)
+        for i in range(100):
+            self.backend.save_call(None, self.fun_id, {'x': i}, i * 2)
+
+        # The journal is folded into the database once it's big enough.
+        self.reconnect()
+        self.assertGreater(os.path.getsize(self.filename), size)
+        self.assertLess(os.path.getsize(self.filename + '.journal'), 1000)
+
+        for i in range(100):
+            self.assertEqual(self.find_call({'x': i}), i * 2)
+
+    def testStaleJournal(self):
+        self.backend.save_call(None, self.fun_id, {'x': 1}, 2)
+        self.backend.close()
+
+        # A journal doesn't apply to a new database.
+        os.remove(self.filename)
+        self.connect()
+
+        self.assertEqual(self.find_call({'x': 1}), None)
+
+    def testStaleJournalWrite(self):
+        self.backend.save_call(None, self.fun_id, {'x': 1}, 2)
+        self.backend.close()
+
+        # Pretend we crashed after replacing the database but before replacing
+        # its journal.
+        with open(self.filename + '.journal', 'wb') as f:
+            f.write(fbuild.db.backend.pickle_dumps(self.ctx,
+                ('generation', 'stale')))
+        self.connect()
+
+        # The changes we make now still need to be kept, even if we crash
+        # before the journal is folded into the database.
+        self.backend.save_call(None, self.fun_id, {'x': 2}, 4)
+        self.crash()
+
+        self.assertEqual(self.find_call({'x': 1}), 2)
+        self.assertEqual(self.find_call({'x': 2}), 4)
+
+    def testMissingJournal(self):
+        self.backend.save_call(None, self.fun_id, {'x': 1}, 2)
+        self.backend.close()
+
+        os.remove(self.filename + '.journal')
+        self.connect()
+
+        self.backend.save_call(None, self.fun_id, {'x': 2}, 4)
+        self.crash()
+
+        self.assertEqual(self.find_call({'x': 1}), 2)
+        self.assertEqual(self.find_call({'x': 2}), 4)
+
+    def testFlush(self):
+        self.backend.save_call(None, self.fun_id, {'x': 1}, 2)
+        self.backend.flush()
+
+        # Another process sees what we've flushed, even though we haven't
+        # closed the database.
+        other = self.backend_class(fbuild.context.make_default_context(
+            ['--buildroot', self.tmpdir.name, '--do-not-save-database']))
+        other.connect(self.filename)
+        try:
+            dirty, call_id, result = other.find_call(self.fun_id, {'x': 1})
+            self.assertEqual(result, 2)
+        finally:
+            other.close()
+
+    def testLazyLoad(self):
+        other_id = self.backend.save_function(None, 'test.g', 'x', ())
+        self.backend.save_call(None, self.fun_id, {'x': 1}, 2)
+        self.backend.save_call(None, other_id, {'x': 1}, 3)
+        self.backend._compact()
+        self.reconnect()
+
+        # We only unpickle the calls of the functions we look at.
+        self.assertEqual(self.find_call({'x': 1}), 2)
+        self.assertEqual(set(self.backend._function_calls._values),
+            {self.fun_id})
+
+        # The calls we didn't look at are still saved.
+        self.backend._compact()
+        self.reconnect()
+
+        dirty, call_id, result = self.backend.find_call(other_id, {'x': 1})
+        self.assertEqual(result, 3)
+
+class TestSqliteBackend(TestCacheBackend):
+    backend_class = fbuild.db.sqlite_backend.SqliteBackend
+
+    testReconnect = TestPickleBackend.testReconnect
+
+    def connect(self):
+        self.backend = self.backend_class(self.ctx)
+        self.backend.connect(self.filename)
+        self.fun_id = self.backend.find_function(self.fun_name)[0]
+        if self.fun_id is None:
+            self.fun_id = self.backend.save_function(
+                None, self.fun_name, 'x', ())
+
+    def testCollision(self):
+        # Plain objects can't be pickled by value, so use a class of ours.
+        a = Opaque(1)
+        b = Opaque(2)
+        self.backend.save_call(None, self.fun_id, {'x': a}, 1)
+        self.backend.save_call(None, self.fun_id, {'x': b}, 2)
+
+        self.assertEqual(self.find_call({'x': a}), 1)
+        self.assertEqual(self.find_call({'x': b}), 2)
+
+    def cache(self, fun_name, x, result, fun_dirty=False):
+        fun_id = self.backend.find_function(fun_name)[0]
+        self.backend.cache(fun_dirty, fun_id, fun_name, 'x', (), None,
+            {'x': x}, result, [], set(), set())
+
+    def testBatches(self):
+        self.backend._CALLS_PER_COMMIT = 10
+        for i in range(25):
+            self.cache(self.fun_name, i, i * 2)
+
+        # Other connections only see the batches we committed, unless the
+        # database is shared, which commits every call.
+        conn = sqlite3.connect(self.filename)
+        try:
+            count, = conn.execute('SELECT COUNT(*) FROM Call').fetchone()
+        finally:
+            conn.close()
+        self.assertEqual(count, 25 if self.backend._shared else 20)
+
+        # The rest are committed when we close.
+        self.reconnect()
+        for i in range(25):
+            self.assertEqual(self.find_call({'x': i}), i * 2)
+
+    def testRollback(self):
+        self.cache(self.fun_name, 1, 2)
+
+        # The function is saved before its call fails to pickle, so both are
+        # rolled back, but not the call before them.
+        self.assertRaises(Exception, self.cache, 'test.g', 1, lambda: None,
+            fun_dirty=True)
+        self.assertEqual(self.backend.find_function('test.g')[0], None)
+
+        self.cache(self.fun_name, 3, 4)
+        self.reconnect()
+
+        self.assertEqual(self.backend.find_function('test.g')[0], None)
+        self.assertEqual(self.find_call({'x': 1}), 2)
+        self.assertEqual(self.find_call({'x': 3}), 4)
+
+class TestSharedSqliteBackend(TestSqliteBackend):
+    def connect(self):
+        self.backend = self.new_backend()
+        self.fun_id = self.backend.find_function(self.fun_name)[0]
+        if self.fun_id is None:
+            self.fun_id = self.backend.save_function(
+                None, self.fun_name, 'x', ())
+
+    def new_backend(self):
+        backend = self.backend_class(self.ctx, shared=True)
+        backend.connect(self.filename)
+        return backend
+
+    def testUpsert(self):
+        other = self.new_backend()
+        try:
+            # Both processes looked before either saved anything.
+            fun_id = other.save_function(None, self.fun_name, 'y', ())
+            self.assertEqual(fun_id, self.fun_id)
+
+            call_id = self.backend.save_call(None, self.fun_id, {'x': 1}, 1)
+            other_call_id = other.save_call(None, self.fun_id, {'x': 1}, 2)
+            self.assertEqual(call_id, other_call_id)
+
+            self.assertEqual(self.find_call({'x': 1}), 2)
+        finally:
+            other.close()
+
+    def testBusy(self):
+        other = self.new_backend()
+        try:
+            # Hold the database for a while in the other process.
+            other.cursor.execute('BEGIN IMMEDIATE')
+            other.save_call(None, self.fun_id, {'x': 1}, 1)
+            timer = threading.Timer(0.2, other.conn.commit)
+            timer.start()
+
+            call_id = self.backend._transaction(self.backend.save_call,
+                None, self.fun_id, {'x': 1}, 2)
+            timer.join()
+
+            self.assertEqual(other.find_call(self.fun_id, {'x': 1}),
+                (False, call_id, 2))
+        finally:
+            other.close()
+
+@fbuild.db.caches
+def make_list(ctx, n):
+    return list(range(n))
+
+@fbuild.db.caches
+def read_file(ctx, src: fbuild.db.SRC):
+    with open(src, 'rb') as f:
+        return f.read()
+
+@fbuild.db.caches
+def opaque_value(ctx, opaque):
+    return opaque.value
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ctx = fbuild.context.make_default_context(
+            ['--buildroot', self.tmpdir.name, '--database-engine', 'pickle',
+             '-j', '2'])
+        self.ctx.db.connect(os.path.join(self.tmpdir.name, 'state.db'))
+
+    def tearDown(self):
+        self.ctx.db.shutdown()
+        self.ctx.scheduler.shutdown()
+        self.tmpdir.cleanup()
+
+    def testCacheSnapshot(self):
+        result = make_list(self.ctx, 3)
+
+        # The call is saved as it was when it returned.
+        result.append(3)
+        self.assertEqual(make_list(self.ctx, 3), [0, 1, 2])
+
+    def testCacheError(self):
+        def cache(*args):
+            raise ValueError()
+        self.ctx.db._backend.cache = cache
+
+        # The error isn't raised by other calls, but by closing the database.
+        self.assertEqual(make_list(self.ctx, 1), [0])
+        self.assertEqual(make_list(self.ctx, 2), [0, 1])
+        self.assertRaises(ValueError, self.ctx.db.close)
+
+    def testConcurrentHashing(self):
+        srcs = []
+        for i in range(2):
+            src = os.path.join(self.tmpdir.name, 'src%d' % i)
+            with open(src, 'wb') as f:
+                f.write(b'%d' % i)
+            srcs.append(src)
+
+        # Each file is only hashed once both workers are hashing, which
+        # can't happen if they hold the scheduler's lock while they do it.
+        barrier = threading.Barrier(2, timeout=5)
+        digest = Path.digest
+        def wait_and_digest(path, *args, **kwargs):
+            barrier.wait()
+            return digest(path, *args, **kwargs)
+
+        Path.digest = wait_and_digest
+        try:
+            self.assertEqual(
+                self.ctx.scheduler.map(lambda src: read_file(self.ctx, src),
+                    srcs),
+                [b'0', b'1'])
+        finally:
+            Path.digest = digest
+
+    def testArtifactCollision(self):
+        self.ctx.db.artifact_cache = fbuild.db.artifact_cache.ArtifactCache(
+            self.ctx, os.path.join(self.tmpdir.name, 'artifacts'),
+            max_size=1000000)
+
+        # The arguments share an artifact key, but the second call doesn't
+        # get the result of the first one.
+        backend = self.ctx.db._backend
+        self.assertEqual(backend.call_key({'opaque': Opaque(1)}),
+            backend.call_key({'opaque': Opaque(2)}))
+        self.assertEqual(opaque_value(self.ctx, Opaque(1)), 1)
+        self.assertEqual(opaque_value(self.ctx, Opaque(2)), 2)
+
+class Opaque:
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, Opaque) and self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+class TestFunctionDigest(unittest.TestCase):
+    def setUp(self):
+        self.functions = dict(Database._FUNCTIONS)
+        self.fun_digests = dict(Database._FUN_DIGESTS)
+
+    def tearDown(self):
+        Database._FUNCTIONS.clear()
+        Database._FUNCTIONS.update(self.functions)
+        Database._FUN_DIGESTS.clear()
+        Database._FUN_DIGESTS.update(self.fun_digests)
+
+    def testDigest(self):
+        def f(x, y=1):
+            return x in {'a', 'b'}
+
+        def g(x, y=1):
+            return x in {'a', 'c'}
+
+        def h(x, y=2):
+            return x in {'a', 'b'}
+
+        digest = Database._digest_function(f)
+        self.assertEqual(digest, Database._digest_function(f))
+        self.assertNotEqual(digest, Database._digest_function(g))
+        self.assertNotEqual(digest, Database._digest_function(h))
+
+    def testDefaults(self):
+        def f(x=Path('a')):
+            pass
+
+        def g(x=Path('b')):
+            pass
+
+        def h(x=fbuild.db.SRC):
+            pass
+
+        def i(x=fbuild.db.DST):
+            pass
+
+        # Defaults that aren't literals still change the digest.
+        self.assertNotEqual(Database._digest_function(f),
+            Database._digest_function(g))
+        self.assertNotEqual(Database._digest_function(h),
+            Database._digest_function(i))
+
+    def testAnnotations(self):
+        def f(x: fbuild.db.SRC):
+            pass
+
+        def g(x: fbuild.db.SRCS):
+            pass
+
+        def h(x: fbuild.db.SRC) -> fbuild.db.DST:
+            pass
+
+        digest = Database._digest_function(f)
+        self.assertNotEqual(digest, Database._digest_function(g))
+        self.assertNotEqual(digest, Database._digest_function(h))
+
+        # Annotations are named by their class, which is the same in every
+        # run.
+        f.__annotations__ = {'x': fbuild.db.SRC}
+        self.assertEqual(digest, Database._digest_function(f))
+
+    def testDependsOn(self):
+        def helper(x):
+            return x + 1
+
+        def other_helper(x):
+            return x + 2
+
+        def make_f(*helpers):
+            @fbuild.db.depends_on(*helpers)
+            def f(x):
+                return helper(x)
+            return f
+
+        # The helpers a function lists are part of its digest.
+        digest = Database._digest_function(make_f(helper))
+        self.assertEqual(digest, Database._digest_function(make_f(helper)))
+        self.assertNotEqual(digest, Database._digest_function(make_f()))
+        self.assertNotEqual(digest,
+            Database._digest_function(make_f(other_helper)))
+
+    def testLazy(self):
+        def f():
+            pass
+
+        f.__module__ = 'test_database.lazy'
+        Database.add_function_to_map(f)
+        self.assertNotIn('test_database.lazy.f', Database._FUN_DIGESTS)
+
+        self.assertEqual(Database.get_function_digest_from_map(
+            'test_database.lazy.f'), Database._digest_function(f))
+
+# -----------------------------------------------------------------------------
+
+def suite(*args, **kwargs):
+    return unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(TestCacheBackend),
+        unittest.TestLoader().loadTestsFromTestCase(TestPickleBackend),
+        unittest.TestLoader().loadTestsFromTestCase(TestSqliteBackend),
+        unittest.TestLoader().loadTestsFromTestCase(TestSharedSqliteBackend),
+        unittest.TestLoader().loadTestsFromTestCase(TestDatabase),
+        unittest.TestLoader().loadTestsFromTestCase(TestFunctionDigest),
+    ])
+
+if __name__ == "__main__":
+    unittest.main()
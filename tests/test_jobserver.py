@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import unittest
+
+import fbuild
+import fbuild.context
+from fbuild.jobserver import JobServer
+
+# -----------------------------------------------------------------------------
+
+class TestJobServer(unittest.TestCase):
+    def setUp(self):
+        self.fds = []
+
+    def tearDown(self):
+        for fd in self.fds:
+            os.close(fd)
+
+    def pipe(self):
+        fds = os.pipe()
+        self.fds.extend(fds)
+        return fds
+
+    def track(self, jobserver):
+        """Close the jobserver's private pipe once the test is done."""
+        self.fds.extend(jobserver._wakeup_fds)
+        return jobserver
+
+    def new(self, jobs):
+        jobserver = self.track(JobServer(jobs))
+        self.fds.extend(jobserver.fds)
+        return jobserver
+
+    def acquire_in_thread(self, jobserver):
+        """Start acquiring a token in another thread, and return the thread
+        and a list that the token is put into."""
+
+        tokens = []
+        thread = threading.Thread(
+            target=lambda: tokens.append(jobserver.acquire()))
+        thread.daemon = True
+        thread.start()
+
+        return thread, tokens
+
+    def testFromMakeflags(self):
+        r, w = self.pipe()
+
+        jobserver = self.track(JobServer.from_makeflags(
+            '-j4 --jobserver-auth=%d,%d' % (r, w)))
+        self.assertEqual(jobserver.jobs, 4)
+        self.assertEqual(jobserver.fds, (r, w))
+
+        # Older versions of make call it --jobserver-fds, and may not pass
+        # the job count down.
+        jobserver = self.track(JobServer.from_makeflags(
+            '--jobserver-fds=%d,%d' % (r, w)))
+        self.assertIsNone(jobserver.jobs)
+        self.assertEqual(jobserver.fds, (r, w))
+
+    def testFromMakeflagsFifo(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'fifo')
+            os.mkfifo(path)
+
+            jobserver = self.track(JobServer.from_makeflags(
+                '-j2 --jobserver-auth=fifo:' + path))
+            self.fds.append(jobserver.fds[0])
+
+            self.assertEqual(jobserver.jobs, 2)
+            self.assertEqual(jobserver.fds[0], jobserver.fds[1])
+
+            # The children inherit our descriptor for the fifo.
+            self.assertIn('--jobserver-auth=%d,%d' % jobserver.fds,
+                jobserver.makeflags())
+
+    def testFromMakeflagsUnusable(self):
+        self.assertIsNone(JobServer.from_makeflags(None))
+        self.assertIsNone(JobServer.from_makeflags('-j4'))
+        self.assertIsNone(JobServer.from_makeflags(
+            '--jobserver-auth=fifo:/nonexistent/fifo'))
+
+        # Make didn't pass the pipe down to us.
+        r, w = os.pipe()
+        os.close(r)
+        os.close(w)
+        self.assertIsNone(JobServer.from_makeflags(
+            '-j4 --jobserver-auth=%d,%d' % (r, w)))
+
+    def testMakeflags(self):
+        jobserver = self.new(3)
+
+        self.assertEqual(
+            jobserver.makeflags('k -j8 --jobserver-auth=100,101'),
+            'k -j3 --jobserver-auth=%d,%d' % jobserver.fds)
+
+    def testContention(self):
+        jobserver = self.new(2)
+
+        # The implicit token is handed out first, then the one in the pipe.
+        a = jobserver.acquire()
+        b = jobserver.acquire()
+        self.assertIsNone(a)
+        self.assertEqual(b, b'+')
+
+        thread, tokens = self.acquire_in_thread(jobserver)
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+
+        # Returning the token to the pipe lets the waiting thread run.
+        jobserver.release(b)
+        thread.join(5)
+        self.assertEqual(tokens, [b'+'])
+
+        jobserver.release(tokens[0])
+        jobserver.release(a)
+        self.assertEqual(jobserver.acquire(), None)
+        self.assertEqual(jobserver.acquire(), b'+')
+
+    def testWakeup(self):
+        jobserver = self.new(1)
+
+        token = jobserver.acquire()
+
+        # The other thread waits on the pipe, which the implicit token never
+        # goes through, so it has to be woken up when we return it.
+        thread, tokens = self.acquire_in_thread(jobserver)
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+
+        jobserver.release(token)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(tokens, [None])
+
+    def testClosedPipe(self):
+        r, w = os.pipe()
+        self.fds.append(r)
+        jobserver = self.track(JobServer(None, fds=(r, w)))
+        jobserver._free_tokens = []
+        os.close(w)
+
+        self.assertRaises(fbuild.Error, jobserver.acquire)
+
+# -----------------------------------------------------------------------------
+
+class FailingJobServer(JobServer):
+    def acquire(self):
+        raise fbuild.Error('no more jobs')
+
+class TestExecute(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ctx = fbuild.context.make_default_context(
+            ['--buildroot', self.tmpdir.name, '--memory-budget', '1'])
+
+    def tearDown(self):
+        self.ctx.scheduler.shutdown()
+        self.tmpdir.cleanup()
+
+    def testAcquireFailure(self):
+        self.ctx.jobserver = FailingJobServer(1)
+        budget = self.ctx.scheduler.memory_budget
+
+        self.assertRaises(fbuild.Error, self.ctx.execute, ['true'],
+            memory=1024)
+
+        # The memory is given back even though we never got a job slot.
+        self.assertEqual(budget.used, 0)
+
+        for fd in self.ctx.jobserver.fds + self.ctx.jobserver._wakeup_fds:
+            os.close(fd)
+
+# -----------------------------------------------------------------------------
+
+def suite(*args, **kwargs):
+    return unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(TestJobServer),
+        unittest.TestLoader().loadTestsFromTestCase(TestExecute),
+    ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import unittest
+
+import fbuild.context
+from fbuild.db.artifact_cache import Artifact, ArtifactCache
+from fbuild.db.remote_cache import HTTPCache, make_server
+
+# -----------------------------------------------------------------------------
+
+class TestRemoteCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ctx = fbuild.context.make_default_context(
+            ['--buildroot', self.tmpdir.name])
+
+        self.server = make_server(os.path.join(self.tmpdir.name, 'server'))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.remote = HTTPCache('http://%s:%d' % self.server.server_address[:2])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def testGetPut(self):
+        key = 'a' * 64
+
+        self.assertEqual(self.remote.get(key), None)
+        self.assertTrue(self.remote.put(key, b'data'))
+        self.assertEqual(self.remote.get(key), b'data')
+
+        # Anything but a key is refused.
+        self.assertFalse(self.remote.put('../a', b'data'))
+
+    def testUnreachable(self):
+        remote = HTTPCache('http://localhost:1', timeout=1)
+
+        self.assertEqual(remote.get('a' * 64), None)
+        self.assertFalse(remote.put('a' * 64, b'data'))
+
+    def testArtifactCache(self):
+        def make_cache(name):
+            return ArtifactCache(self.ctx,
+                os.path.join(self.tmpdir.name, name),
+                max_size=1000000,
+                remote=self.remote)
+
+        dst = os.path.join(self.tmpdir.name, 'a.o')
+        with open(dst, 'w') as f:
+            f.write('a')
+
+        # Store the artifact on one machine, and wait for it to be uploaded.
+        cache = make_cache('local')
+        key = cache.key('f', 'digest', 'args', {})
+        cache.store(key, Artifact(
+            bound={'x': 1},
+            result=1,
+            dsts=[dst],
+            external_srcs={},
+            external_dsts=[],
+            fun_dependents={}))
+        cache.close()
+
+        # Then fetch it on another one.
+        os.remove(dst)
+        cache = make_cache('other')
+        artifact = cache.fetch(key, {'x': 1}, lambda artifact: True)
+
+        self.assertEqual(artifact.result, 1)
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'a')
+        self.assertEqual((cache.hits, cache.remote_hits, cache.misses),
+            (1, 1, 0))
+
+        # A machine that makes the call with other arguments doesn't use it.
+        cache = make_cache('third')
+        self.assertEqual(cache.fetch(key, {'x': 2}, lambda artifact: True),
+            None)
+        self.assertEqual((cache.hits, cache.remote_hits, cache.misses),
+            (0, 0, 1))
+
+# -----------------------------------------------------------------------------
+
+def suite(*args, **kwargs):
+    return unittest.TestLoader().loadTestsFromTestCase(TestRemoteCache)
+
+if __name__ == "__main__":
+    unittest.main()
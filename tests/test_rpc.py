@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from fbuild.rpc import RPC, InlineRPC, RPCNotRunning
+
+# -----------------------------------------------------------------------------
+
+class TestRPC(unittest.TestCase):
+    rpc_class = RPC
+
+    def setUp(self):
+        self.calls = []
+
+        def handler(x):
+            if x is None:
+                raise ValueError()
+            self.calls.append(x)
+            return x * 2
+
+        self.rpc = self.rpc_class(handler)
+        self.rpc.daemon = True
+        self.rpc.start()
+
+    def tearDown(self):
+        self.rpc.join()
+
+    def testCall(self):
+        self.assertEqual(self.rpc.call(1), 2)
+        self.assertRaises(ValueError, self.rpc.call, None)
+
+    def testCast(self):
+        for i in range(100):
+            self.rpc.cast(i)
+
+        # A call sees the effects of every cast before it.
+        self.assertEqual(self.rpc.call(100), 200)
+        self.assertEqual(self.calls, list(range(101)))
+
+    def testCastError(self):
+        self.rpc.cast(None)
+
+        # Other calls aren't affected by the error.
+        self.assertEqual(self.rpc.call(1), 2)
+        self.assertRaises(ValueError, self.rpc.raise_cast_error)
+        self.rpc.raise_cast_error()
+
+    def testCastErrorJoin(self):
+        self.rpc.cast(None)
+        self.assertRaises(ValueError, self.rpc.join)
+
+    def testNotRunning(self):
+        self.rpc.join()
+        self.assertRaises(RPCNotRunning, self.rpc.call, 1)
+        self.assertRaises(RPCNotRunning, self.rpc.cast, 1)
+
+class TestInlineRPC(TestRPC):
+    rpc_class = InlineRPC
+
+    def testCastError(self):
+        # Inline casts are just calls, so they raise right away.
+        self.assertRaises(ValueError, self.rpc.cast, None)
+        self.assertEqual(self.rpc.call(1), 2)
+        self.rpc.raise_cast_error()
+
+    def testCastErrorJoin(self):
+        self.rpc.cast(1)
+        self.rpc.join()
+
+# -----------------------------------------------------------------------------
+
+def suite(*args, **kwargs):
+    return unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(TestRPC),
+        unittest.TestLoader().loadTestsFromTestCase(TestInlineRPC),
+    ])
+
+if __name__ == "__main__":
+    unittest.main()
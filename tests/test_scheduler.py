@@ -13,13 +13,16 @@ import threading
 # -----------------------------------------------------------------------------
 
 class TestScheduler(unittest.TestCase):
+    work_stealing = False
+
     def setUp(self):
         # Make sure any latent contexts are cleaned up before we run.
         gc.collect()
 
         self.initial_thread_count = threading.active_count()
 
-        self.scheduler = Scheduler(self.threads)
+        self.scheduler = Scheduler(self.threads,
+            work_stealing=self.work_stealing)
 
         if self.threads == 0:
             self.assertEqual(self.scheduler.threadcount, 1)
@@ -51,15 +54,129 @@ class TestScheduler(unittest.TestCase):
             self.scheduler.map(g, [[0,1,2],[3,4,5],[6,7,8]]),
             [[1,2,3],[4,5,6],[7,8,9]])
 
+    def testImapUnordered(self):
+        def f(x):
+            time.sleep(random.random() * 0.01)
+            return x + 1
+
+        self.assertEqual(
+            sorted(self.scheduler.imap_unordered(f, [0,1,2,3,4,5,6,7,8,9])),
+            [1,2,3,4,5,6,7,8,9,10])
+
+        # now test if we can handle recursive scheduling
+        def g(x):
+            return sorted(self.scheduler.imap_unordered(f, x))
+
+        self.assertEqual(
+            sorted(self.scheduler.imap_unordered(g, [[0,1,2],[3,4,5],[6,7,8]])),
+            [[1,2,3],[4,5,6],[7,8,9]])
+
     def run(self, *args, **kwargs):
         for i in range(10):
             self.threads = i
             super(TestScheduler, self).run(*args, **kwargs)
 
+class TestWorkStealingScheduler(TestScheduler):
+    work_stealing = True
+
+    def testMapWithDependencies(self):
+        deps = {'a': ['b', 'c'], 'b': ['c'], 'c': []}
+
+        def f(x):
+            time.sleep(random.random() * 0.01)
+            return x
+
+        self.assertEqual(
+            self.scheduler.map_with_dependencies(deps.get, f, ['a', 'b', 'c']),
+            ['c', 'b', 'a'])
+
+# -----------------------------------------------------------------------------
+
+class TestPriorityScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler(1, priority=True)
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def testCriticalPath(self):
+        deps = {'a': [], 'b': ['a'], 'c': ['b'], 'x': [], 'y': []}
+        order = []
+
+        def f(x):
+            order.append(x)
+            return x
+
+        self.scheduler.map_with_dependencies(deps.get, f,
+            ['x', 'y', 'c', 'b', 'a'])
+
+        # 'a' starts the longest chain, so it must be dispatched first.
+        self.assertEqual(order[0], 'a')
+        self.assertEqual(sorted(order), ['a', 'b', 'c', 'x', 'y'])
+
+    def testCost(self):
+        deps = {'a': [], 'b': ['a'], 'x': []}
+        order = []
+
+        def f(x):
+            order.append(x)
+            return x
+
+        self.scheduler.map_with_dependencies(deps.get, f, ['a', 'b', 'x'],
+            cost={'a': 1, 'b': 1, 'x': 10}.get)
+
+        self.assertEqual(order[0], 'x')
+
+    def testHistory(self):
+        deps = {'a': [], 'b': ['a'], 'x': []}
+        order = []
+
+        def f(x):
+            order.append(x)
+            return x
+
+        # Pretend 'x' took a long time in a previous build.
+        key = f.__qualname__ + ':%s'
+        self.scheduler.task_stats[key % 'a'] = {'duration': 1.0}
+        self.scheduler.task_stats[key % 'b'] = {'duration': 1.0}
+        self.scheduler.task_stats[key % 'x'] = {'duration': 10.0}
+
+        self.scheduler.map_with_dependencies(deps.get, f, ['a', 'b', 'x'])
+
+        self.assertEqual(order[0], 'x')
+        self.assertEqual(sorted(self.scheduler.task_stats),
+            [key % 'a', key % 'b', key % 'x'])
+        self.assertLess(self.scheduler.task_stats[key % 'x']['duration'], 10.0)
+
+# -----------------------------------------------------------------------------
+
+class TestProcessPool(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler(2, processcount=2)
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def testRunInProcess(self):
+        def f(x):
+            return self.scheduler.run_in_process(pow, x, 2)
+
+        self.assertEqual(self.scheduler.map(f, [1, 2, 3]), [1, 4, 9])
+
+    def testException(self):
+        self.assertRaises(ZeroDivisionError,
+            self.scheduler.run_in_process, divmod, 1, 0)
+
 # -----------------------------------------------------------------------------
 
 def suite():
-    return unittest.TestLoader().loadTestsFromTestCase(TestScheduler)
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestScheduler),
+        loader.loadTestsFromTestCase(TestWorkStealingScheduler),
+        loader.loadTestsFromTestCase(TestPriorityScheduler),
+        loader.loadTestsFromTestCase(TestProcessPool),
+    ])
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import fbuild.context
+import fbuild.db
+import fbuild.options
+import fbuild.server
+
+# -----------------------------------------------------------------------------
+
+calls = []
+
+@fbuild.db.caches
+def square(ctx, x):
+    calls.append(x)
+    return x * x
+
+def parse_options(argv):
+    return fbuild.options.make_parser().parse_args(argv[1:])
+
+# -----------------------------------------------------------------------------
+
+class TestServer(unittest.TestCase):
+    engine = 'pickle'
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.buildroot = os.path.join(self.tmpdir.name, 'build')
+        self.argv = ['fbuild', '--buildroot', self.buildroot,
+            '--database-engine', self.engine]
+        self.contexts = []
+        self.results = []
+        del calls[:]
+
+    def tearDown(self):
+        for ctx in self.contexts:
+            ctx.db.shutdown()
+            ctx.scheduler.shutdown()
+        self.tmpdir.cleanup()
+
+    def make_context(self, *args):
+        ctx = fbuild.context.Context(parse_options(self.argv + list(args)))
+        self.contexts.append(ctx)
+        ctx.create_buildroot()
+        ctx.load_configuration()
+        return ctx
+
+    def build(self, ctx):
+        self.results.append(square(ctx, 3))
+
+    def request(self, *args):
+        return fbuild.server.request(self.argv + list(args), timeout=5)
+
+    def run_clients(self, *requests):
+        """Send the requests to the server from another thread, while the
+        server runs in this one, and return their exit codes."""
+
+        exit_codes = []
+        def run():
+            # Wait for the server to start listening.
+            path = fbuild.server.socket_path(self.argv)
+            deadline = time.time() + 5
+            while not os.path.exists(path) and time.time() < deadline:
+                time.sleep(0.01)
+
+            for args in requests:
+                exit_codes.append(self.request(*args))
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+        ctx = self.make_context('--serve')
+        restart = fbuild.server.serve(ctx, parse_options(self.argv),
+            parse_options, self.build)
+        thread.join(5)
+
+        self.assertFalse(restart)
+        return ctx, exit_codes
+
+    def testNoServer(self):
+        self.assertIsNone(self.request())
+
+    def testBuilds(self):
+        ctx, exit_codes = self.run_clients((), (), ('--stop-server',))
+        self.assertEqual(exit_codes, [0, 0, 0])
+
+        # The second build found the call from the first one.
+        self.assertEqual(self.results, [9, 9])
+        self.assertEqual(calls, [3])
+
+    def testSaveAfterBuild(self):
+        ctx, exit_codes = self.run_clients((), ('--stop-server',))
+        self.assertEqual(exit_codes, [0, 0])
+
+        # A build that starts after the server is killed, without it closing
+        # its database, still finds the call.
+        other = self.make_context()
+        self.build(other)
+        self.assertEqual(self.results, [9, 9])
+        self.assertEqual(calls, [3])
+
+    def testCounters(self):
+        self.argv += ['--artifact-cache',
+            os.path.join(self.tmpdir.name, 'artifacts')]
+
+        ctx, exit_codes = self.run_clients((), (), ('--stop-server',))
+        self.assertEqual(exit_codes, [0, 0, 0])
+
+        # The first build missed the artifact cache, but the second one only
+        # reports its own build, which found the call in the database.
+        cache = ctx.db.artifact_cache
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+class TestSqliteServer(TestServer):
+    # Sqlite only commits the calls every so often.
+    engine = 'sqlite'
+
+# -----------------------------------------------------------------------------
+
+def suite(*args, **kwargs):
+    return unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(TestServer),
+        unittest.TestLoader().loadTestsFromTestCase(TestSqliteServer),
+    ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import unittest
+
+from fbuild.watch import Watcher
+
+# -----------------------------------------------------------------------------
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'needs inotify')
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.watcher = Watcher()
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tmpdir.cleanup()
+
+    def touch(self, name):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'a') as f:
+            print('x', file=f)
+        return path
+
+    def testChanges(self):
+        a = self.touch('a')
+        b = self.touch('b')
+        self.watcher.add(a)
+
+        # Only the watched files are reported.
+        self.touch('a')
+        self.touch('b')
+        self.assertEqual(self.watcher.read_changes(timeout=1), {a})
+        self.assertEqual(self.watcher.read_changes(timeout=0), set())
+
+    def testRemoveDirectory(self):
+        subdir = os.path.join(self.tmpdir.name, 'sub')
+        os.mkdir(subdir)
+        a = self.touch('sub/a')
+        self.watcher.add(a)
+
+        os.remove(a)
+        os.rmdir(subdir)
+
+        changes = set()
+        while True:
+            more_changes = self.watcher.read_changes(timeout=0.1)
+            if not more_changes:
+                break
+            changes.update(more_changes)
+        self.assertEqual(changes, {a})
+
+        # The directory is watched again once we add the file back.
+        os.mkdir(subdir)
+        self.touch('sub/a')
+        self.watcher.add(a)
+        self.touch('sub/a')
+        self.assertEqual(self.watcher.read_changes(timeout=1), {a})
+
+# -----------------------------------------------------------------------------
+
+def suite(*args, **kwargs):
+    return unittest.TestLoader().loadTestsFromTestCase(TestWatcher)
+
+if __name__ == "__main__":
+    unittest.main()